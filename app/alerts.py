@@ -0,0 +1,220 @@
+import bisect
+import datetime
+from typing import Optional, Dict, List, Tuple, Any
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import session
+
+from apihandler import ProductDoesntExist
+from model import Product, Offer, Snapshot, Alert, AlertKind, TriggeredAlert
+
+
+class AlertDoesntExist(RuntimeError):
+    pass
+
+
+def best_price_before(db_session: session, product_id: int, moment: datetime.datetime) -> Optional[int]:
+    """
+    :return: the lowest price of offers in stock of the last snapshot acquired at or before moment, None if there is
+             no such snapshot or nothing was in stock
+    """
+    snapshot = db_session.query(Snapshot.id).filter(
+        Snapshot.product_id == product_id,
+        Snapshot.acquired_on <= moment
+    ).order_by(Snapshot.acquired_on.desc()).first()
+
+    if snapshot is None:
+        return None
+
+    return db_session.query(func.min(Offer.price)).filter(
+        Offer.snapshot_id == snapshot.id,
+        Offer.items_in_stock > 0
+    ).scalar()
+
+
+class AlertIndex:
+    """
+    Active alerts indexed by product, so that a changed snapshot is checked only against alerts of its product and
+    the check doesn't grow with the number of alerts:
+
+    - price_below thresholds are kept sorted, triggered ones are found by bisection,
+    - price_move thresholds are kept sorted for every window, so the historic price is looked up once per window,
+    - back_in_stock alerts are simply listed.
+
+    Alerts are one-shot - triggered alert is deactivated and removed from the index.
+    """
+    _below: Dict[int, List[Tuple[float, int]]]  # product ID -> sorted (threshold, alert ID)
+    _moves: Dict[int, Dict[int, List[Tuple[float, int]]]]  # product ID -> window -> sorted (threshold, alert ID)
+    _stock: Dict[int, List[int]]  # product ID -> alert IDs
+
+    def __init__(self) -> None:
+        self._below = dict()
+        self._moves = dict()
+        self._stock = dict()
+
+    def __len__(self) -> int:
+        return sum(len(alerts) for alerts in self._below.values()) + \
+               sum(len(alerts) for windows in self._moves.values() for alerts in windows.values()) + \
+               sum(len(alerts) for alerts in self._stock.values())
+
+    @classmethod
+    def load(cls, db_session: session) -> "AlertIndex":
+        """
+        Build index of all active alerts with a single query.
+        """
+        index = cls()
+
+        # Core select, ORM query costs twice as much with hundreds of thousands of rows
+        rows = db_session.execute(
+            select([Alert.id, Alert.product_id, Alert.kind, Alert.threshold, Alert.window]).where(Alert.active == True)
+        )
+
+        for alert_id, product_id, kind, threshold, window in rows:
+            index._add(alert_id, product_id, kind, threshold, window)
+
+        for thresholds in index._below.values():
+            thresholds.sort()
+
+        for windows in index._moves.values():
+            for thresholds in windows.values():
+                thresholds.sort()
+
+        return index
+
+    def _add(self, alert_id: int, product_id: int, kind: AlertKind, threshold: Optional[float],
+             window: Optional[int]) -> None:
+        if kind == AlertKind.price_below:
+            self._below.setdefault(product_id, []).append((threshold, alert_id))
+        elif kind == AlertKind.price_move:
+            self._moves.setdefault(product_id, {}).setdefault(window, []).append((threshold, alert_id))
+        else:
+            self._stock.setdefault(product_id, []).append(alert_id)
+
+    def evaluate(self, db_session: session, product_id: int, best_price: Optional[int],
+                 previous_best_price: Optional[int], now: datetime.datetime) -> List[TriggeredAlert]:
+        """
+        Check alerts of product with changed offers. Triggered alerts are added to the session and deactivated, caller
+        commits them.
+
+        :param product_id: of the changed product
+        :param best_price: the lowest price in stock now or None
+        :param previous_best_price: the lowest price in stock before the change or None
+        :param now: time of the snapshot
+
+        :return: triggered alerts
+        """
+        triggered: List[Tuple[int, str]] = []
+
+        below = self._below.get(product_id)
+        if below and best_price is not None:
+            # thresholds above the price are triggered
+            split = bisect.bisect_right(below, (best_price, float("inf")))
+
+            triggered.extend((alert_id, f"Price {best_price} is below {threshold:g}.") for threshold, alert_id in
+                             below[split:])
+            del below[split:]
+
+        windows = self._moves.get(product_id)
+        if windows and best_price is not None:
+            for window, moves in windows.items():
+                old_price = best_price_before(db_session, product_id, now - datetime.timedelta(seconds=window))
+                if not old_price:
+                    continue
+
+                move = (best_price - old_price) / (old_price / 100.0)
+
+                # thresholds up to the size of the move are triggered
+                split = bisect.bisect_right(moves, (abs(move), float("inf")))
+
+                triggered.extend(
+                    (alert_id, f"Price moved by {move:.2f} % (from {old_price} to {best_price}) within {window} s.")
+                    for threshold, alert_id in moves[:split]
+                )
+                del moves[:split]
+
+        if product_id in self._stock and best_price is not None and previous_best_price is None:
+            triggered.extend((alert_id, "Product is back in stock.") for alert_id in self._stock.pop(product_id))
+
+        if not triggered:
+            return []
+
+        db_session.query(Alert).filter(Alert.id.in_([alert_id for alert_id, _ in triggered])).update(
+            {"active": False}, synchronize_session=False
+        )
+
+        result = []
+        for alert_id, message in triggered:
+            triggered_alert = TriggeredAlert(alert_id=alert_id, product_id=product_id, triggered_on=now,
+                                             best_price=best_price, message=message)
+            db_session.add(triggered_alert)
+            result.append(triggered_alert)
+
+        return result
+
+
+def create_alert(db_session: session, product_id: int, kind: AlertKind, threshold: Optional[float] = None,
+                 window: Optional[int] = None) -> int:
+    """
+    Register new alert. It will be evaluated by updater runs started after this.
+
+    :raises ProductDoesntExist: if product doesn't exist or isn't active
+    :raises ValueError: if threshold or window is missing for alert kind, which needs it
+
+    :return: ID of the alert
+    """
+    product = db_session.query(Product).get(product_id)
+
+    if product is None or not product.active:
+        raise ProductDoesntExist(product_id)
+
+    if kind != AlertKind.back_in_stock and threshold is None:
+        raise ValueError("Threshold is required.")
+
+    if kind == AlertKind.price_move and not window:
+        raise ValueError("Window is required.")
+
+    alert = Alert(product_id=product_id, kind=kind, threshold=threshold,
+                  window=window if kind == AlertKind.price_move else None, active=True,
+                  created_on=datetime.datetime.now())
+
+    db_session.add(alert)
+    db_session.commit()
+
+    return alert.id
+
+
+def delete_alert(db_session: session, alert_id: int) -> None:
+    """
+    :raises AlertDoesntExist: if alert doesn't exist or was already triggered or deleted
+    """
+    updated = db_session.query(Alert).filter(Alert.id == alert_id, Alert.active == True).update(
+        {"active": False}, synchronize_session=False
+    )
+
+    db_session.commit()
+
+    if updated == 0:
+        raise AlertDoesntExist(alert_id)
+
+
+def triggered_alerts(db_session: session, product_id: Optional[int] = None, after_id: int = 0,
+                     limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    List triggered alerts ordered by ID, use the ID of the last one as after_id to get the next page.
+    """
+    query = db_session.query(TriggeredAlert).filter(TriggeredAlert.id > after_id)
+
+    if product_id is not None:
+        query = query.filter(TriggeredAlert.product_id == product_id)
+
+    return [
+        {
+            "id": triggered.id,
+            "alert_id": triggered.alert_id,
+            "product_id": triggered.product_id,
+            "triggered_on": triggered.triggered_on,
+            "best_price": triggered.best_price,
+            "message": triggered.message,
+        }
+        for triggered in query.order_by(TriggeredAlert.id).limit(limit)
+    ]
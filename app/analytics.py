@@ -0,0 +1,262 @@
+"""
+Price analytics over offer history of many products at once.
+
+History is loaded by a single grouped query into compact array-backed series (one per product) and statistics are
+computed with bulk operations over whole arrays (builtins and map() with operator functions run in C), instead of
+building ORM objects and dicts for every point. Very large requests are split among worker processes.
+"""
+import array
+import datetime
+import math
+import multiprocessing
+import operator
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, List, Any, Sequence, Iterable
+
+from sqlalchemy import func, case, select, and_
+from sqlalchemy.orm import session
+
+from apihandler import ProductDoesntExist
+from model import Product, Offer, Snapshot
+
+# requests with more points than this are computed in a process pool
+POOL_THRESHOLD = 500_000
+
+# number of worker processes of the pool
+POOL_WORKERS = int(os.getenv("ANALYTICS_WORKERS", "0")) or os.cpu_count() or 1
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+class PriceSeries:
+    """
+    Snapshots of one product: time (POSIX timestamp), the best price in stock (-1 if nothing was in stock) and flag,
+    whether anything was in stock.
+    """
+    __slots__ = ("product_id", "times", "prices", "in_stock")
+
+    product_id: int
+    times: array.array  # 'd'
+    prices: array.array  # 'q'
+    in_stock: array.array  # 'b'
+
+    def __init__(self, product_id: int) -> None:
+        self.product_id = product_id
+        self.times = array.array("d")
+        self.prices = array.array("q")
+        self.in_stock = array.array("b")
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getstate__(self):
+        return self.product_id, self.times, self.prices, self.in_stock
+
+    def __setstate__(self, state) -> None:
+        self.product_id, self.times, self.prices, self.in_stock = state
+
+    def append(self, time: float, best_price: Optional[int]) -> None:
+        self.times.append(time)
+        self.prices.append(-1 if best_price is None else best_price)
+        self.in_stock.append(0 if best_price is None else 1)
+
+
+def load_series(db_session: session, product_ids: Iterable[int], start: datetime.datetime,
+                end: datetime.datetime) -> Dict[int, PriceSeries]:
+    """
+    Load best prices of all snapshots of given products within time range with one grouped query.
+
+    :return: product ID -> series sorted by time, products without snapshots have empty series
+    """
+    result = {product_id: PriceSeries(product_id) for product_id in product_ids}
+
+    offer = Offer.__table__
+    snapshot = Snapshot.__table__
+
+    best_price = func.min(case([(offer.c.items_in_stock > 0, offer.c.price)]))
+
+    rows = db_session.execute(
+        select([snapshot.c.product_id, snapshot.c.acquired_on, best_price]).select_from(
+            snapshot.join(offer, offer.c.snapshot_id == snapshot.c.id)
+        ).where(and_(
+            snapshot.c.product_id.in_(list(result)),
+            snapshot.c.acquired_on >= start,
+            snapshot.c.acquired_on <= end
+        )).group_by(snapshot.c.id).order_by(snapshot.c.product_id, snapshot.c.acquired_on)
+    )
+
+    for product_id, acquired_on, price in rows:
+        result[product_id].append(acquired_on.timestamp(), price)
+
+    return result
+
+
+def _percentile(sorted_values: Sequence[float], percent: float) -> float:
+    # linear interpolation between the closest ranks
+    position = (len(sorted_values) - 1) * percent / 100.0
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def compute(series: PriceSeries, end: float, percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+            moving_averages: Sequence[int] = (5, 20)) -> Dict[str, Any]:
+    """
+    Compute statistics of one series.
+
+    :param series: of the product
+    :param end: POSIX timestamp of the end of the time range - the last snapshot is valid until then
+    :param percentiles: which percentiles of the best price to compute
+    :param moving_averages: lengths (number of the last points in stock) of simple moving averages
+
+    :return: statistics, price statistics are None if nothing was in stock in the whole range
+    """
+    times = series.times
+    count = len(times)
+
+    # time in stock - every snapshot is valid until the next one
+    time_in_stock = None
+    if count:
+        durations = array.array("d", map(operator.sub, times[1:], times[:-1]))
+        durations.append(max(end - times[-1], 0.0))
+
+        total = sum(durations)
+        if total > 0:
+            time_in_stock = 100.0 * sum(map(operator.mul, durations, series.in_stock)) / total
+        else:
+            time_in_stock = 100.0 * series.in_stock[-1]
+
+    prices = array.array("q", (price for price in series.prices if price >= 0)) if count else array.array("q")
+
+    result: Dict[str, Any] = {
+        "product_id": series.product_id,
+        "snapshots": count,
+        "points_in_stock": len(prices),
+        "time_in_stock": time_in_stock,
+        "min": None,
+        "max": None,
+        "mean": None,
+        "volatility": None,
+        "rise_or_fall": None,
+        "percentiles": {},
+        "moving_averages": {},
+    }
+
+    if not prices:
+        return result
+
+    mean = sum(prices) / len(prices)
+    ordered = sorted(prices)
+
+    result["min"] = ordered[0]
+    result["max"] = ordered[-1]
+    result["mean"] = mean
+    result["rise_or_fall"] = (prices[-1] - prices[0]) / (prices[0] / 100.0) if prices[0] else 0.0
+    result["percentiles"] = {str(percent): _percentile(ordered, percent) for percent in percentiles}
+    result["moving_averages"] = {
+        str(length): sum(prices[-length:]) / min(length, len(prices)) for length in moving_averages
+    }
+
+    # volatility - standard deviation of relative price changes between consecutive points, in percent
+    if len(prices) > 1 and all(prices):
+        returns = array.array("d", map(operator.truediv, prices[1:], prices[:-1]))
+        returns_mean = sum(returns) / len(returns)
+        variance = max(sum(map(operator.mul, returns, returns)) / len(returns) - returns_mean ** 2, 0.0)
+
+        result["volatility"] = 100.0 * math.sqrt(variance)
+    else:
+        result["volatility"] = 0.0
+
+    return result
+
+
+def _compute_batch(batch: List[PriceSeries], end: float, percentiles: Sequence[float],
+                   moving_averages: Sequence[int]) -> List[Dict[str, Any]]:
+    return [compute(series, end, percentiles, moving_averages) for series in batch]
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # workers are spawned, forked ones would inherit database connections and locks held by other threads
+                _pool = ProcessPoolExecutor(POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    return _pool
+
+
+def shutdown() -> None:
+    """
+    Stop worker processes of the pool, if it was created. Next large request creates a new one.
+    """
+    global _pool
+
+    with _pool_lock:
+        pool, _pool = _pool, None
+
+    if pool is not None:
+        pool.shutdown()
+
+
+def analyze(db_session: session, product_ids: Sequence[int], start: Optional[datetime.datetime] = None,
+            end: Optional[datetime.datetime] = None, percentiles: Sequence[float] = (5, 25, 50, 75, 95),
+            moving_averages: Sequence[int] = (5, 20)) -> List[Dict[str, Any]]:
+    """
+    Compute price statistics of given products within time range.
+
+    If start is None, it will assume, you want the last 24 hours.
+
+    :param product_ids: of desired products
+    :param start: starting time or None
+    :param end: ending time or None
+
+    :raises ProductDoesntExist: if any of the products doesn't exist or isn't active
+
+    :return: statistics of every product (see compute(...)) in order of product_ids
+    """
+    existing = {product_id for (product_id,) in db_session.query(Product.id).filter(
+        Product.id.in_(product_ids),
+        Product.active == True
+    )}
+
+    for product_id in product_ids:
+        if product_id not in existing:
+            raise ProductDoesntExist(product_id)
+
+    if start is None:
+        end = datetime.datetime.now()
+        start = end - datetime.timedelta(days=1)
+    elif end is None:
+        end = datetime.datetime.now()
+    elif start > end:
+        start, end = end, start
+
+    series = load_series(db_session, product_ids, start, end)
+    end_timestamp = min(end, datetime.datetime.now()).timestamp()
+
+    batch = [series[product_id] for product_id in product_ids]
+
+    if sum(map(len, batch)) <= POOL_THRESHOLD or len(batch) < 2:
+        results = _compute_batch(batch, end_timestamp, percentiles, moving_averages)
+    else:
+        pool = _get_pool()
+        chunk_size = math.ceil(len(batch) / (POOL_WORKERS * 4))
+
+        futures = [
+            pool.submit(_compute_batch, batch[index:index + chunk_size], end_timestamp, percentiles, moving_averages)
+            for index in range(0, len(batch), chunk_size)
+        ]
+
+        results = [result for future in futures for result in future.result()]
+
+    for result in results:
+        result["start"] = start
+        result["end"] = end
+
+    return results
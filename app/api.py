@@ -1,33 +1,98 @@
-import os
+import datetime
+import json
+from typing import Iterator, Optional, List, Tuple
 
-from fastapi import FastAPI, Response, status
+from fastapi import FastAPI, Response, status, Depends, HTTPException, Request, Query
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import session
+from starlette.responses import StreamingResponse
 
+import alerts
+import analytics
+import conditional
+import export
+import freshness
+import history_cache
+import ranking
+import search
 from apihandler import APIHandler, ProductAlreadyExists, ProductDoesntExist
-from database import engine, SessionLocal
-from model import Instance, Base
-from pydantic_model import Product, UpdateProduct, TimeRange
+from bootstrap import Bootstrap
+from compression import CompressionMiddleware
+from feed import ChangeFeed
+from model import AlertKind
+from pydantic_model import Product, UpdateProduct, TimeRange, NewAlert, AnalyticsRequest
+from trends import TrendCache
 
-Base.metadata.create_all(bind=engine)
+# schema check and access token loading are deferred until they are needed, startup only warms them up in background,
+# every request gets its own database session, so that the app can run in several worker processes
+bootstrap = Bootstrap()
+
+# pushes changes committed by updater (or other workers) to clients of /stream
+change_feed = ChangeFeed(bootstrap.new_session)
+
+# recent price trends of products and history responses shared by all requests of this worker
+trend_cache = TrendCache()
+history_responses = history_cache.HistoryCache()
+
+# the last /list-all response - (generation, content)
+list_response: Optional[Tuple[int, bytes]] = None
 
 api = FastAPI(
     title="Offers microservice by Tomáš Čapek",
     description="This API was created as a part of the application process for Python Developer position in Applifting company.",
-    version="1.0"
+    version="1.0",
+    on_startup=[bootstrap.warm_up_in_background],
+    on_shutdown=[change_feed.close, analytics.shutdown]
 )
 
-db_session = SessionLocal()
+# large complete responses are compressed, streams are left alone
+api.add_middleware(CompressionMiddleware)
+
 
-api_url = os.getenv("APPLIFTING_API_URL")
-if api_url is None:
-    raise RuntimeError("No APPLIFTING_API_URL is set.")
+def encode(data) -> bytes:
+    return json.dumps(jsonable_encoder(data), separators=(",", ":")).encode()
 
-handler = APIHandler(db_session, api_url)
 
-instance = db_session.query(Instance).first()
-if instance is None:  # first time start
-    handler.start()
-else:  # we already have a access token
-    handler.start(instance.access_token)
+def not_modified(request: Request, tag: str) -> Response:
+    # the client gets back the tag of the representation it has (e.g. the compressed one), see conditional.matching(...)
+    tag = conditional.matching(request.headers.get("if-none-match"), tag) or tag
+
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": tag})
+
+
+def get_handler() -> Iterator[APIHandler]:
+    db_session = bootstrap.new_session()
+    try:
+        handler = bootstrap.handler(db_session)
+        handler.use_trend_cache(trend_cache)
+
+        yield handler
+    finally:
+        db_session.close()
+
+
+def get_session() -> Iterator[session]:
+    bootstrap.ensure_schema()
+
+    db_session = bootstrap.new_session()
+    try:
+        yield db_session
+    finally:
+        db_session.close()
+
+
+def get_authenticated_handler() -> Iterator[APIHandler]:
+    db_session = bootstrap.new_session()
+    try:
+        try:
+            handler = bootstrap.authenticated_handler(db_session)
+        except RuntimeError as error:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error))
+
+        yield handler
+    finally:
+        db_session.close()
 
 
 @api.post(
@@ -35,7 +100,7 @@ else:  # we already have a access token
     name="Create new product",
     description="This endpoint is used to create new product."
 )
-def create(product: Product, response: Response):
+def create(product: Product, response: Response, handler: APIHandler = Depends(get_authenticated_handler)):
     try:
         handler.create_product(product.name, product.description)
         response.status_code = status.HTTP_201_CREATED
@@ -54,8 +119,24 @@ def create(product: Product, response: Response):
     name="List all products and offers",
     description="This endpoint will list all the available products with their non-zero stocked offers."
 )
-def list_all():
-    return handler.list_products()
+def list_all(request: Request, handler: APIHandler = Depends(get_handler)):
+    global list_response
+
+    # the list changes only with changed offers or product, refresh with the same offers keeps it
+    _, generation, _ = handler.storage.generations()
+    tag = conditional.etag("list", generation)
+
+    if conditional.not_modified(request.headers.get("if-none-match"), tag):
+        return not_modified(request, tag)
+
+    cached = list_response
+    if cached is not None and cached[0] == generation:
+        content = cached[1]
+    else:
+        content = encode(list(handler.list_products()))
+        list_response = (generation, content)
+
+    return Response(content, media_type="application/json", headers={"ETag": tag})
 
 
 @api.post(
@@ -63,7 +144,7 @@ def list_all():
     name="Edit product information",
     description="Change name or description of the given product."
 )
-def change_product(product: UpdateProduct, response: Response):
+def change_product(product: UpdateProduct, response: Response, handler: APIHandler = Depends(get_handler)):
     try:
         handler.update_product(product.product_id, product.name, product.description)
         response.status_code = status.HTTP_200_OK
@@ -84,7 +165,7 @@ def change_product(product: UpdateProduct, response: Response):
     name="Remove product from the Offers microservice",
     description="Will remove given product from this service."
 )
-def delete_product(product_id, response: Response):
+def delete_product(product_id: int, response: Response, handler: APIHandler = Depends(get_handler)):
     try:
         handler.delete_product(product_id)
     except ProductDoesntExist:
@@ -99,11 +180,237 @@ def delete_product(product_id, response: Response):
     name="Get history of offers related to given product.",
     description="Returns history and rise or fall percentage for given product."
 )
-def product_offer_history(product_id: int, time_range: TimeRange, response: Response):
+def product_offer_history(product_id: int, time_range: TimeRange, request: Request, response: Response,
+                          handler: APIHandler = Depends(get_handler)):
     try:
-        return handler.get_history(product_id, time_range.start, time_range.end)
+        if time_range.start is None:
+            # the last 5 minutes move with time, there is no validator
+            return handler.get_history(product_id)
+
+        tag = history_responses.etag(handler.storage, product_id, time_range.start, time_range.end)
+
+        if conditional.not_modified(request.headers.get("if-none-match"), tag):
+            return not_modified(request, tag)
+
+        def compute() -> bytes:
+            return encode(handler.get_history(product_id, time_range.start, time_range.end))
+
+        content = history_responses.get(handler.storage, product_id, time_range.start, time_range.end, compute)
+
+        return Response(content, media_type="application/json", headers={"ETag": tag})
     except ProductDoesntExist:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {
             "message": "Product with this ID doesn't exists."
         }
+
+
+@api.post(
+    "/product-offer-analytics",
+    name="Get price statistics of given products.",
+    description="Returns min, max, mean, percentiles and moving averages of the best price in stock, its volatility "
+                "(standard deviation of relative changes between snapshots, in percent), rise or fall and percentage "
+                "of time in stock for every product. Without `start`, the last 24 hours are used."
+)
+def product_offer_analytics(request: AnalyticsRequest, response: Response,
+                            db_session: session = Depends(get_session)):
+    try:
+        return analytics.analyze(db_session, request.product_ids, request.start, request.end, request.percentiles,
+                                 request.moving_averages)
+    except ProductDoesntExist:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": "Product with this ID doesn't exists."
+        }
+
+
+@api.get(
+    "/ranking/cheapest",
+    name="Cheapest products",
+    description="Active products with the lowest current price in stock, the cheapest first."
+)
+def cheapest(limit: int = Query(50, ge=1, le=1000), db_session: session = Depends(get_session)):
+    return ranking.cheapest(db_session, limit)
+
+
+@api.get(
+    "/ranking/movers",
+    name="Top price movers",
+    description="Active products with the biggest relative change of the best price in stock within the last "
+                "`window_minutes`. `direction` is `drop`, `rise` or `any` (absolute change)."
+)
+def top_movers(response: Response, window_minutes: int = Query(60, ge=1), limit: int = Query(50, ge=1, le=1000),
+               direction: str = "drop", db_session: session = Depends(get_session)):
+    try:
+        return ranking.top_movers(db_session, datetime.timedelta(minutes=window_minutes), limit, direction)
+    except ValueError as error:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": str(error)
+        }
+
+
+@api.get(
+    "/search",
+    name="Search products",
+    description="Full-text search of active products by name and description, the best match first. Every word has to "
+                "match, the last one (and every one ending with `*`) as a prefix. Returns the total number of "
+                "matching products and the requested page of them with their offers in stock and the best price."
+)
+def search_products(response: Response, q: str = Query(..., min_length=1, max_length=256),
+                    limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0),
+                    db_session: session = Depends(get_session)):
+    try:
+        return search.search(db_session, q, limit, offset)
+    except ValueError as error:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": str(error)
+        }
+
+
+@api.get(
+    "/freshness",
+    name="Freshness of offers",
+    description="Staleness (seconds since the last successful refresh) of offers of active products - its "
+                "percentiles and maximum, share of products within the SLO (`slo` seconds, `FRESHNESS_SLO` by default) "
+                "and up to `limit` products violating it, the most stale first. Never refreshed products have "
+                "infinite staleness, reported as null."
+)
+def get_freshness(response: Response, slo: Optional[float] = Query(None, gt=0),
+                  percentile: Optional[List[float]] = Query(None), limit: int = Query(100, ge=0, le=1000),
+                  db_session: session = Depends(get_session)):
+    try:
+        return freshness.report(db_session, freshness.DEFAULT_SLO if slo is None else datetime.timedelta(seconds=slo),
+                                tuple(percentile) if percentile else freshness.PERCENTILES, limit)
+    except ValueError as error:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": str(error)
+        }
+
+
+@api.get(
+    "/export/offers",
+    name="Export offer history",
+    description="Streams offers as `ndjson`, `csv` or `columnar` (JSON object with lists of column values per chunk), "
+                "optionally gzipped. Export covers offers up to the watermark in `X-Export-Watermark` header, pass it "
+                "as `after_id` to the next export to get only the new offers."
+)
+def export_offers(response: Response, format: str = "ndjson", product_id: Optional[List[int]] = Query(None),
+                  start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+                  after_id: int = 0, gzip: bool = False):
+    if format not in export.FORMATS:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": f"Unknown format, use one of {', '.join(export.FORMATS)}."
+        }
+
+    bootstrap.ensure_schema()
+
+    db_session = bootstrap.new_session()
+    try:
+        up_to_id = export.watermark(db_session)
+    except Exception:
+        db_session.close()
+        raise
+
+    def blocks():
+        # the session lives as long as the response is being streamed
+        try:
+            yield from export.export(db_session, format, gzip, product_ids=product_id, start=start, end=end,
+                                     after_id=after_id, up_to_id=up_to_id)
+        finally:
+            db_session.close()
+
+    # gzipped export is a file to be stored as it is, not a transfer encoding
+    return StreamingResponse(blocks(), media_type="application/gzip" if gzip else export.CONTENT_TYPES[format],
+                             headers={"X-Export-Watermark": str(up_to_id)})
+
+
+@api.get(
+    "/stream",
+    name="Stream of changes",
+    description="Server-Sent Events stream of changed offers (`snapshot` events with new offers and best price) and "
+                "changed products (`product` events). Use `product_id` query parameter (repeatable) to receive "
+                "changes of selected products only. Client, which doesn't keep up, gets `resync` event and should "
+                "reload the state from /list-all."
+)
+async def stream(request: Request, product_id: Optional[List[int]] = Query(None)):
+    await run_in_threadpool(bootstrap.ensure_schema)
+
+    last_seen_id = request.headers.get("last-event-id")
+
+    subscription = await change_feed.subscribe(
+        set(product_id) if product_id else None,
+        int(last_seen_id) if last_seen_id and last_seen_id.isdigit() else None
+    )
+
+    async def messages():
+        try:
+            while not await request.is_disconnected():
+                message = await subscription.get(timeout=15.0)
+
+                yield ": keep-alive\n\n" if message is None else message
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return StreamingResponse(messages(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@api.post(
+    "/alerts",
+    name="Register price alert",
+    description="Alert is triggered by the updater, when the best price of the product drops below `threshold` "
+                "(`price_below`), moves by at least `threshold` percent within `window_minutes` (`price_move`) or "
+                "when the product gets back in stock (`back_in_stock`). Each alert is triggered only once."
+)
+def create_alert(alert: NewAlert, response: Response, db_session: session = Depends(get_session)):
+    try:
+        alert_id = alerts.create_alert(
+            db_session,
+            alert.product_id,
+            AlertKind[alert.kind],
+            alert.threshold,
+            alert.window_minutes * 60 if alert.window_minutes else None
+        )
+        response.status_code = status.HTTP_201_CREATED
+        return {
+            "id": alert_id
+        }
+    except ProductDoesntExist:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": "Product with this ID doesn't exists."
+        }
+    except ValueError as error:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": str(error)
+        }
+
+
+@api.delete(
+    "/alerts/{alert_id}",
+    name="Remove price alert",
+    description="Alert won't be triggered anymore."
+)
+def delete_alert(alert_id: int, response: Response, db_session: session = Depends(get_session)):
+    try:
+        alerts.delete_alert(db_session, alert_id)
+    except alerts.AlertDoesntExist:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": "Active alert with this ID doesn't exists."
+        }
+
+
+@api.get(
+    "/alerts/triggered",
+    name="List triggered alerts",
+    description="Triggered alerts ordered by ID, optionally of a single product. Pass ID of the last seen one as "
+                "`after_id` to get only the new ones."
+)
+def triggered_alerts(product_id: Optional[int] = None, after_id: int = 0, limit: int = Query(100, le=1000),
+                     db_session: session = Depends(get_session)):
+    return alerts.triggered_alerts(db_session, product_id, after_id, limit)
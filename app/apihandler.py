@@ -1,34 +1,51 @@
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple, Iterable, Iterator, Callable, Union, TYPE_CHECKING
 import datetime
+import logging
+import time
 
-import requests
 from sqlalchemy.orm import session
 
-from model import Instance, Product, Offer, OfferStatus
+import feed
+from storage import Storage, ProductAlreadyExists, ProductDoesntExist, storage_of
 
+if TYPE_CHECKING:
+    from alerts import AlertIndex
+    from trends import TrendCache
 
-class NotAuthenticated(RuntimeError):
-    pass
+logger = logging.getLogger(__name__)
 
 
-class ProductAlreadyExists(RuntimeError):
+class NotAuthenticated(RuntimeError):
     pass
 
 
-class ProductDoesntExist(RuntimeError):
+class RefreshFailed(RuntimeError):
     product_id: int
+    reason: str
 
-    def __init__(self, product_id: int):
-        super().__init__(f"Product with id {product_id} doesn't exist!")
+    def __init__(self, product_id: int, reason: str):
+        super().__init__(f"Refresh of product {product_id} failed: {reason}.")
+        self.product_id = product_id
+        self.reason = reason
 
 
 class APIHandler:
+    # `requests` is imported inside methods, which talk to the API - it is one of the heaviest imports
+    # and reads served from the database don't need it at all
+
     _base_url: str  # without trailing /
-    _session: session  # database session
+    _storage: Storage
+    _auth_timeout: float = 10.0  # seconds, unreachable API must not block the start forever
+    # seconds, a stalled request is a failed (and retried) refresh - much shorter than the lease of refresh cycle
+    # (120 s by default, see refresh.py), which another updater would take over otherwise
+    _refresh_timeout: float = 10.0
 
     _current_access_token: Optional[str] = None
     _current_instance_id: Optional[int] = None
 
+    _alerts: Optional["AlertIndex"] = None
+    _trends: Optional["TrendCache"] = None
+
     def _check_auth(self) -> bool:
         """
         Checks, whether we are authenticated and ready to send requests to given API.
@@ -38,8 +55,12 @@ class APIHandler:
         if self._current_instance_id is None or self._current_access_token is None:
             raise NotAuthenticated()
 
-    def __init__(self, db_session: session, base_url: str) -> None:
-        self._session = db_session
+    def __init__(self, storage: Union[Storage, session], base_url: str) -> None:
+        """
+        :param storage: storage of products and offers or database session (it is wrapped in SQLStorage then)
+        :param base_url: URL of the API without trailing /
+        """
+        self._storage = storage_of(storage)
         self._base_url = base_url
 
     def start(self, access_token: Optional[str] = None) -> None:
@@ -50,36 +71,70 @@ class APIHandler:
         :param access_token: is valid access token or None, if you want to get one and save it to database
 
         :raises RuntimeError: if not 201 is returned from API.
+        :raises requests.RequestException: if API is unreachable.
         """
         if access_token is None:
-            request = requests.post(self._base_url + "/auth")
+            import requests
+
+            request = requests.post(self._base_url + "/auth", timeout=self._auth_timeout)
 
             if request.status_code == 201:
                 data = request.json()
 
-                instance = Instance(
-                    access_token=data["access_token"],
-                    date=datetime.datetime.now()
-                )
-
-                self._session.add(instance)
-                self._session.flush()
-                self._session.commit()
-
-                self._session.refresh(instance)
+                instance_id = self._storage.add_instance(data["access_token"], datetime.datetime.now())
 
                 self._current_access_token = data["access_token"]
-                self._current_instance_id = instance.id
+                self._current_instance_id = instance_id
             else:
                 raise RuntimeError(f"/auth returned {request.status_code}, which is not 201. Cannot continue.")
         else:
-            instance = self._session.query(Instance).filter(Instance.access_token == access_token).first()
+            instance_id = self._storage.find_instance(access_token)
 
-            if instance is None:
+            if instance_id is None:
                 raise RuntimeError("Invalid access token given.")
             else:
                 self._current_access_token = access_token
-                self._current_instance_id = instance.id
+                self._current_instance_id = instance_id
+
+    def use_credentials(self, instance_id: int, access_token: str) -> None:
+        """
+        Setups inner structures with credentials, which were already verified (e.g. by .start() of another handler),
+        so that no database query nor request is needed.
+
+        :param instance_id: ID of Instance, which owns the access token
+        :param access_token: valid access token
+        """
+        self._current_instance_id = instance_id
+        self._current_access_token = access_token
+
+    @property
+    def credentials(self) -> Optional[Tuple[int, str]]:
+        """
+        :return: (instance ID, access token) or None, if handler isn't started.
+        """
+        if self._current_instance_id is None or self._current_access_token is None:
+            return None
+
+        return self._current_instance_id, self._current_access_token
+
+    @property
+    def storage(self) -> Storage:
+        return self._storage
+
+    def watch_alerts(self, alerts: "AlertIndex") -> None:
+        """
+        Evaluate given alerts against every changed snapshot acquired by .refresh_product(...). Alerts live in the
+        database, so the handler has to work with SQLStorage.
+        """
+        self._alerts = alerts
+
+    def use_trend_cache(self, trends: "TrendCache") -> None:
+        """
+        Serve the default (last 5 minutes) price trend from given cache, whenever it can. The cache follows the change
+        feed in the database, so it is ignored, if the storage has no database session.
+        """
+        if self._storage.session is not None:
+            self._trends = trends
 
     def create_product(self, name: str, description: str) -> int:
         """
@@ -96,27 +151,24 @@ class APIHandler:
         """
         self._check_auth()
 
-        product = Product(name=name, description=description, instance_id=self._current_instance_id)
-
-        query = self._session.query(Product).filter(Product.name == name).first()
+        query = self._storage.find_product(name)
 
         # I was not sure, whether we want the same ID for previously existing product or not,
         # but I decided, that it makes sense to do so
         if query is not None:
             if not query.active:
-                query.active = True
-
-                self._session.commit()
+                self._storage.activate_product(query.id)
+                self._storage.commit()
 
                 product = query
             else:
                 raise ProductAlreadyExists()
         else:
-            self._session.add(product)
-            self._session.flush()
-            self._session.commit()
+            product = self._storage.get_product(
+                self._storage.add_product(name, description, self._current_instance_id)
+            )
 
-            self._session.refresh(product)
+        import requests
 
         request = requests.post(
             self._base_url + "/products/register",
@@ -131,10 +183,14 @@ class APIHandler:
         )
 
         if request.status_code == 201:
+            self._storage.index_product(product.id, product.name, product.description)
+            self._storage.publish_product(product.id, "created", name=name, description=description)
+            self._storage.commit()
+
             return product.id
         else:
-            self._session.query(Product).filter(Product.id == product.id).delete()
-            self._session.commit()
+            self._storage.remove_product(product.id)
+            self._storage.commit()
 
             if request.status_code == 400:
                 raise RuntimeError("Returned 400 BAD REQUEST. Cannot continue.")
@@ -147,22 +203,7 @@ class APIHandler:
 
         :return: Dict with data.
         """
-        for product in self._session.query(Product).filter(Product.active == True).all():
-            data = {
-                "id": product.id,
-                "name": product.name,
-                "description": product.description,
-                "offers": []
-            }
-
-            for offer in product.offers.filter(Offer.status == OfferStatus.active):
-                if offer.items_in_stock > 0:
-                    data["offers"].append({
-                        "price": offer.price,
-                        "items_in_stock": offer.items_in_stock,
-                    })
-
-            yield data
+        return self._storage.list_products()
 
     def update_product(self, product_id: int, name: Optional[str] = None, description: Optional[str] = None) -> None:
         """
@@ -176,23 +217,20 @@ class APIHandler:
         :raises ProductDoesntExists: if given ID isn't present in database.
         """
 
-        product = self._session.query(Product).get(product_id)
-
-        if product is None:
+        if self._storage.get_product(product_id) is None:
             raise ProductDoesntExist(product_id)
 
-        query = self._session.query(Product).filter(Product.name == name).first()
-
-        if query is not None:
+        if name is not None and self._storage.find_product(name) is not None:
             raise ProductAlreadyExists()
 
-        if name is not None:
-            product.name = name
+        product = self._storage.update_product(product_id, name, description)
+
+        if product.active:
+            self._storage.index_product(product_id, product.name, product.description)
 
-        if description is not None:
-            product.description = description
+        self._storage.publish_product(product_id, "updated", name=product.name, description=product.description)
 
-        self._session.commit()
+        self._storage.commit()
 
     def delete_product(self, product_id: int) -> None:
         """
@@ -202,93 +240,197 @@ class APIHandler:
 
         :raises ProductDoesntExist: if product ID doesn't exist in the database.
         """
-        product = self._session.query(Product).get(product_id)
+        product = self._storage.get_product(product_id)
 
         if product is None or not product.active:
             raise ProductDoesntExist(product_id)
 
-        product.active = False
+        self._storage.deactivate_product(product_id)
 
-        self._session.query(Offer).filter(Offer.product_id == product_id, Offer.status == OfferStatus.active).update({
-            "status": OfferStatus.historic
-        })
+        self._storage.unindex_product(product_id)
+        self._storage.publish_product(product_id, "deleted")
 
-        self._session.commit()
+        self._storage.commit()
 
-    def update_offers(self) -> None:
+    def update_offers(self, chunk_size: int = 1000, retries: int = 2, backoff: float = 1.0) -> List[int]:
         """
         Get updated offers from API.
 
+        Products are read in chunks of IDs and the session is cleared after every chunk, so memory doesn't grow with
+        the number of products. Objects of the session loaded by the caller get detached. Failed products keep their
+        previous offers and are retried at the end, see .refresh_products(...).
+
+        :param chunk_size: number of products refreshed between releases of the session
+        :param retries: rounds of retries of failed products
+        :param backoff: seconds before the first round of retries, doubled for every next one
+
         :raises NotAutheticated: If you failed to call .start() in before this.
-        :raises RuntimeError: If non 200 response is received.
+
+        :return: IDs of products, which couldn't be refreshed
         """
         self._check_auth()
 
-        products = self._session.query(Product).where(Product.active == True).all()
+        def product_ids() -> Iterator[int]:
+            last_product_id = 0
+
+            while True:
+                chunk = self._storage.active_product_ids(last_product_id, chunk_size)
+
+                if not chunk:
+                    return
+
+                yield from chunk
+
+                last_product_id = chunk[-1]
+
+                self._storage.release()
 
-        for product in products:
-            # used in case, when there are no active offers, so that we know, that price was refreshed
-            # at the given point - not sure, if necessary, but given API wasn't documented in this regards, so let's
-            # play it safe
-            best_price_obj = product.offers.filter(Offer.status == OfferStatus.active).order_by(Offer.price).first()
+        return self.refresh_products(product_ids(), retries, backoff)
 
-            best_price: int = 0
-            if best_price_obj is not None:
-                best_price = best_price_obj.price
+    def refresh_products(self, product_ids: Iterable[int], retries: int = 2, backoff: float = 1.0,
+                         max_retried: int = 1000, cycle_id: Optional[int] = None,
+                         on_done: Optional[Callable[[int, Optional[bool], int], None]] = None,
+                         sleep: Callable[[float], None] = time.sleep) -> List[int]:
+        """
+        Refresh products one by one, failure of one doesn't stop the others (see .try_refresh_product(...)).
+        Failed products are retried after all the others in `retries` rounds, the first one after `backoff` seconds,
+        every next one after twice as long.
+
+        :param product_ids: products to be refreshed
+        :param retries: rounds of retries
+        :param backoff: seconds before the first round of retries
+        :param max_retried: failed products beyond this number aren't retried (e.g. when the API is down)
+        :param cycle_id: recorded with failures
+        :param on_done: called after every attempt with product ID, its result (None on failure) and attempt number
+        :param sleep: used to wait between rounds
+
+        :return: IDs of products, which failed in all attempts or weren't retried
+        """
+        failed = []
+        skipped = []
+
+        for product_id in product_ids:
+            changed = self.try_refresh_product(product_id, cycle_id)
+
+            if changed is None:
+                (failed if len(failed) < max_retried else skipped).append(product_id)
+
+            if on_done is not None:
+                on_done(product_id, changed, 1)
+
+        for attempt in range(2, retries + 2):
+            if not failed:
+                break
+
+            sleep(backoff * 2 ** (attempt - 2))
+
+            still_failing = []
+
+            for product_id in failed:
+                changed = self.try_refresh_product(product_id, cycle_id, attempt)
+
+                if changed is None:
+                    still_failing.append(product_id)
+
+                if on_done is not None:
+                    on_done(product_id, changed, attempt)
+
+            failed = still_failing
+
+        return failed + skipped
+
+    def try_refresh_product(self, product_id: int, cycle_id: Optional[int] = None, attempt: int = 1) -> Optional[bool]:
+        """
+        Refresh product (see .refresh_product(...)), failure is recorded as RefreshFailure instead of being raised.
+
+        :param cycle_id: ID of RefreshCycle, which the refresh is part of
+        :param attempt: number of the attempt within the cycle
+
+        :return: True if offers differ from the previous ones, None if the refresh failed
+        """
+        try:
+            return self.refresh_product(product_id)
+        except RefreshFailed as error:
+            self._storage.rollback()
+
+            self._storage.record_failure(product_id, cycle_id, datetime.datetime.now(), attempt, error.reason)
+            self._storage.commit()
+
+            logger.warning(f"{error} (attempt {attempt})")
+
+            return None
+
+    def refresh_product(self, product_id: int) -> bool:
+        """
+        Get updated offers of a single product from API. New offers become active, the old ones historic.
 
-            active_offers = product.offers.filter(Offer.status == OfferStatus.active)
+        Offers are fetched first, so when the API fails, nothing changes - the previous offers stay active.
+        Product's last_refreshed_on (and last_changed_on, if the offers changed) is set to the time of acquisition.
 
-            active_offers.update({"status": OfferStatus.historic})
+        :param product_id: ID of product to be refreshed
 
+        :raises NotAutheticated: If you failed to call .start() in before this.
+        :raises RefreshFailed: If the API is unreachable or doesn't return 200 with valid offers.
+
+        :return: True if offers differ from the previous ones
+        """
+        self._check_auth()
+
+        import requests
+
+        try:
             request = requests.get(
-                self._base_url + f"/products/{product.id}/offers",
+                self._base_url + f"/products/{product_id}/offers",
                 data={},
                 headers={
                     "Bearer": self._current_access_token
-                }
+                },
+                timeout=self._refresh_timeout
             )
+        except requests.RequestException as error:
+            raise RefreshFailed(product_id, f"API is unreachable ({error})")
 
-            if request.status_code == 200:
-                response_data = request.json()
+        if request.status_code != 200:
+            raise RefreshFailed(product_id, f"got {request.status_code} instead of 200")
 
-                acquired_on = datetime.datetime.now()
+        try:
+            new_offers = [(int(offer_data["price"]), int(offer_data["items_in_stock"]))
+                          for offer_data in request.json()]
+        except (ValueError, TypeError, KeyError) as error:
+            raise RefreshFailed(product_id, f"invalid offers ({error!r})")
 
-                got_new_offers: bool = False
+        acquired_on = datetime.datetime.now()
 
-                for offer_data in response_data:
-                    got_new_offers = True
+        previous_offers = self._storage.active_offers(product_id)
 
-                    offer = Offer(
-                        price=offer_data["price"],
-                        items_in_stock=offer_data["items_in_stock"],
-                        acquired_on=acquired_on,
-                        status=OfferStatus.active,
-                        product_id=product.id
-                    )
+        # used in case, when there are no active offers, so that we know, that price was refreshed
+        # at the given point - not sure, if necessary, but given API wasn't documented in this regards, so let's
+        # play it safe
+        best_price: int = 0
+        if previous_offers:
+            best_price = previous_offers[0][0]
 
-                    self._session.add(offer)
+        if not new_offers:
+            new_offers.append((best_price, 0))
 
-                if not got_new_offers:
-                    offer = Offer(
-                        price=best_price,
-                        items_in_stock=0,
-                        acquired_on=acquired_on,
-                        status=OfferStatus.active,
-                        product_id=product.id
-                    )
+        self._storage.add_snapshot(product_id, acquired_on, new_offers, previous_offers)
 
-                    self._session.add(offer)
+        changed = sorted(new_offers) != previous_offers
 
-                self._session.commit()
-            else:
-                raise RuntimeError(f"Got {request.status_code} instead od 200.")
+        if changed and self._alerts is not None:
+            self._alerts.evaluate(self._storage.session, product_id, feed.best_price_of(new_offers),
+                                  feed.best_price_of(previous_offers), acquired_on)
+
+        self._storage.commit()
+
+        return changed
 
     def get_price_trend(self, product_id: int, start: Optional[datetime.datetime] = None,
                         end: Optional[datetime.datetime] = None):
         """
         Returns sorted list with history of offer price for given product.
 
-        If start is None, it will assume, you want last 5 minutes.
+        If start is None, it will assume, you want last 5 minutes. If only end is None, it will end now.
 
         :raises: ProductDoesntExists: if Product doesnt exist
 
@@ -297,45 +439,37 @@ class APIHandler:
         :param end: ending time or None
         :return: list of offer history
         """
-        product = self._session.query(Product).get(product_id)
-
-        if product is None or not product.active:
-            raise ProductDoesntExist(product_id)
+        position = None
 
         if start is None:
             now = datetime.datetime.now()
             start = now - datetime.timedelta(minutes=5)
             end = now
+
+            if self._trends is not None:
+                trend = self._trends.trend(self._storage.session, product_id, start, end)
+                if trend is not None:
+                    return trend
+
+                position = self._trends.position(self._storage.session)
         else:
+            if end is None:
+                end = datetime.datetime.now()
+
             if start > end:
                 buffer = end
                 end = start
                 start = buffer
 
-        offers = self._session.query(Offer).filter(Offer.product_id == product_id, Offer.acquired_on >= start,
-                                                   Offer.acquired_on <= end)
+        product = self._storage.get_product(product_id)
 
-        best_offers = dict()
-        for offer in offers.all():
-            if offer.items_in_stock == 0:
-                continue
-
-            if str(offer.acquired_on) not in best_offers:
-                best_offers[str(offer.acquired_on)] = offer.price
-            else:
-                if best_offers[str(offer.acquired_on)] > offer.price:
-                    best_offers[str(offer.acquired_on)] = offer.price
+        if product is None or not product.active:
+            raise ProductDoesntExist(product_id)
 
-        grouped_offers = self._session.query(Offer).filter(Offer.acquired_on >= start,
-                                                           Offer.acquired_on <= end).group_by(Offer.acquired_on)
+        result = self._storage.price_history(product_id, start, end)
 
-        result = list()
-        for offer in grouped_offers.all():
-            if str(offer.acquired_on) in best_offers:
-                result.append({
-                    "price": best_offers[str(offer.acquired_on)],
-                    "acquired_on": offer.acquired_on
-                })
+        if position is not None:
+            self._trends.seed(product_id, start, result, position)
 
         return result
 
@@ -351,11 +485,7 @@ class APIHandler:
         :param end: end time or None
         :return: History, with calculated rise or fall.
         """
-        product = self._session.query(Product).get(product_id)
-
-        if product is None or not product.active:
-            raise ProductDoesntExist(product_id)
-
+        # checks the product as well
         history = self.get_price_trend(product_id, start, end)
 
         if len(history) == 0:
@@ -0,0 +1,74 @@
+"""
+Cold start benchmark of the `api` app.
+
+Every sample is a fresh interpreter, which imports `api`, runs application startup and serves the first `/list-all`
+request. API url points to unroutable address by default, so the numbers also show, that unreachable API doesn't
+block the start.
+
+Launch from `app` directory:
+
+    python -m benchmarks.cold_start --samples 10
+"""
+from typing import Optional, List, Dict
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SAMPLE = """
+import json, time
+from starlette.testclient import TestClient
+
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+
+with TestClient(api.api) as client:
+    ready = time.perf_counter()
+    status_code = client.get("/list-all").status_code
+    served = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "startup_ms": (ready - imported) * 1000,
+    "first_request_ms": (served - ready) * 1000,
+    "ready_ms": (ready - started) * 1000,
+    "status_code": status_code,
+}))
+"""
+
+
+def sample(api_url: str, database: str) -> Dict[str, float]:
+    env = dict(os.environ, APPLIFTING_API_URL=api_url, ABSOLUTE_DATABASE_LOCATION=database)
+
+    output = subprocess.run(
+        [sys.executable, "-c", SAMPLE],
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the Offers microservice.")
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--api-url", default="http://10.255.255.1/api/v1", help="defaults to unroutable address")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [sample(args.api_url, os.path.join(directory, "database.db")) for _ in range(args.samples)]
+
+    for key in ("import_ms", "startup_ms", "ready_ms", "first_request_ms"):
+        values = [result[key] for result in results]
+        print(f"{key:<18} median {statistics.median(values):>9.2f}   max {max(values):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Load generator for the Offers microservice.
+
+Runs concurrent clients against a running instance of the `api` app (e.g. `python -m uvicorn api:api`) and reports
+throughput and p50/p95/p99 latency for every route. Traffic is either generated from a weighted mix of endpoint calls
+or replayed from a captured request log.
+
+Examples (launched from `app` directory):
+
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --mix list-all=6,history=3,create=1 --clients 16
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --mix history-range=3,history-since=1 --clients 16
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --replay captured.jsonl --clients 8
+
+Replay log is a file with one JSON object per line:
+
+    {"method": "POST", "path": "/product-offer-history/1", "json": {"start": null, "end": null}, "offset": 0.25}
+
+`json` and `offset` (seconds since the start of the capture) are optional. Lines of other JSONL files (e.g. the
+`requests.jsonl` backlog of change requests, which has `request_id`, `title` and `body`) aren't requests - they are
+skipped with a warning and the run fails, if nothing is left to replay.
+"""
+from typing import Optional, Dict, List, Any, Iterator, Callable
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# route name -> function, that builds (method, path, json body) of a request
+Scenario = Callable[[random.Random, List[int]], Dict[str, Any]]
+
+
+def _list_all(rng: random.Random, product_ids: List[int]) -> Dict[str, Any]:
+    return {"method": "GET", "path": "/list-all"}
+
+
+def _history(rng: random.Random, product_ids: List[int]) -> Dict[str, Any]:
+    product_id = rng.choice(product_ids) if product_ids else 1
+
+    return {"method": "POST", "path": f"/product-offer-history/{product_id}", "json": {"start": None, "end": None}}
+
+
+def _whole_hour(rng: random.Random) -> datetime.datetime:
+    # ranges start at whole hours of the last day, so that clients ask for the same ranges again
+    now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+
+    return now - datetime.timedelta(hours=rng.randint(1, 24))
+
+
+def _history_range(rng: random.Random, product_ids: List[int]) -> Dict[str, Any]:
+    product_id = rng.choice(product_ids) if product_ids else 1
+    start = _whole_hour(rng)
+
+    return {
+        "method": "POST",
+        "path": f"/product-offer-history/{product_id}",
+        "json": {"start": start.isoformat(), "end": (start + datetime.timedelta(hours=1)).isoformat()}
+    }
+
+
+def _history_since(rng: random.Random, product_ids: List[int]) -> Dict[str, Any]:
+    product_id = rng.choice(product_ids) if product_ids else 1
+
+    return {
+        "method": "POST",
+        "path": f"/product-offer-history/{product_id}",
+        "json": {"start": _whole_hour(rng).isoformat(), "end": None}
+    }
+
+
+def _create(rng: random.Random, product_ids: List[int]) -> Dict[str, Any]:
+    return {
+        "method": "POST",
+        "path": "/create-product",
+        "json": {"name": f"loadtest-{uuid.uuid4().hex}", "description": "Created by load generator."}
+    }
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "list-all": _list_all,
+    "history": _history,  # the last 5 minutes
+    "history-range": _history_range,  # an hour of the last day, historic ranges
+    "history-since": _history_since,  # from an hour of the last day until now
+    "create": _create,
+}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """
+    Parse mix definition like `list-all=6,history=3,create=1`.
+
+    :raises ValueError: if unknown route or non-positive weight is given.
+
+    :return: route name to weight mapping
+    """
+    result = dict()
+
+    for part in mix.split(","):
+        name, _, weight = part.strip().partition("=")
+
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown route {name!r}, choose from {', '.join(SCENARIOS)}.")
+
+        result[name] = int(weight) if weight else 1
+
+        if result[name] <= 0:
+            raise ValueError(f"Weight of {name!r} has to be positive.")
+
+    return result
+
+
+def read_replay_log(path: str) -> List[Dict[str, Any]]:
+    """
+    Load captured requests. Empty lines are skipped, lines, which don't describe request (no `path`), are skipped
+    with a warning.
+
+    :param path: to the JSONL file
+
+    :raises ValueError: if the file contains no request
+
+    :return: list of requests sorted by offset
+    """
+    result = list()
+    skipped = 0
+
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or "path" not in entry:
+                skipped += 1
+                continue
+
+            entry.setdefault("method", "GET")
+            result.append(entry)
+
+    if skipped:
+        logger.warning(f"{skipped} lines of {path} don't describe a request (no `path`), they are skipped.")
+
+    if not result:
+        raise ValueError(f"No request to replay in {path}, lines need at least `path` (see benchmarks/loadtest.py).")
+
+    result.sort(key=lambda entry: entry.get("offset", 0.0))
+
+    return result
+
+
+def route_of(path: str) -> str:
+    """
+    Collapse path parameters, so that `/product-offer-history/1` and `/product-offer-history/2` share statistics.
+    """
+    return "/".join("{id}" if part.isdigit() else part for part in path.split("/"))
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+
+    rank = max(math.ceil(percent / 100.0 * len(sorted_values)) - 1, 0)
+
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Recorder:
+    """
+    Thread safe collector of latencies per route.
+    """
+    _lock: threading.Lock
+    _latencies: Dict[str, List[float]]
+    _errors: Dict[str, int]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies = dict()
+        self._errors = dict()
+
+    def record(self, route: str, latency: float, ok: bool) -> None:
+        with self._lock:
+            self._latencies.setdefault(route, []).append(latency)
+            if not ok:
+                self._errors[route] = self._errors.get(route, 0) + 1
+
+    def report(self, elapsed: float) -> List[Dict[str, Any]]:
+        """
+        :param elapsed: wall clock duration of the whole run in seconds
+        :return: statistics for every route and for all of them together (route `*`)
+        """
+        with self._lock:
+            latencies = {route: sorted(values) for route, values in self._latencies.items()}
+            errors = dict(self._errors)
+
+        latencies["*"] = sorted(itertools.chain.from_iterable(latencies.values()))
+        errors["*"] = sum(errors.values())
+
+        result = list()
+        for route, values in sorted(latencies.items()):
+            result.append({
+                "route": route,
+                "requests": len(values),
+                "errors": errors.get(route, 0),
+                "rps": len(values) / elapsed if elapsed > 0 else 0.0,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            })
+
+        return result
+
+
+def _mixed_requests(mix: Dict[str, int], product_ids: List[int], seed: int) -> Iterator[Dict[str, Any]]:
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    while True:
+        yield SCENARIOS[rng.choices(names, weights)[0]](rng, product_ids)
+
+
+def run(base_url: str, requests_source: Iterator[Dict[str, Any]], clients: int, duration: Optional[float] = None,
+        total: Optional[int] = None, honor_offsets: bool = False, timeout: float = 30.0) -> List[Dict[str, Any]]:
+    """
+    Send requests from the source using given number of concurrent clients.
+
+    :param base_url: of the service without trailing /
+    :param requests_source: iterator of request descriptions ({"method", "path", "json", "offset"})
+    :param clients: number of concurrent clients (threads, each with its own HTTP session)
+    :param duration: stop after this many seconds or None
+    :param total: stop after this many requests or None
+    :param honor_offsets: wait until `offset` of request is reached (replay in original tempo)
+    :param timeout: of a single request in seconds
+    :return: report as returned by Recorder.report(...)
+    """
+    recorder = Recorder()
+    source_lock = threading.Lock()
+    sent = itertools.count()
+    started = time.perf_counter()
+
+    def next_request() -> Optional[Dict[str, Any]]:
+        if duration is not None and time.perf_counter() - started >= duration:
+            return None
+
+        with source_lock:
+            if total is not None and next(sent) >= total:
+                return None
+
+            return next(requests_source, None)
+
+    def client() -> None:
+        http = requests.Session()
+
+        while True:
+            entry = next_request()
+            if entry is None:
+                return
+
+            if honor_offsets:
+                delay = entry.get("offset", 0.0) - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            route = f"{entry['method'].upper()} {route_of(entry['path'])}"
+            request_started = time.perf_counter()
+            try:
+                response = http.request(entry["method"], base_url + entry["path"], json=entry.get("json"),
+                                        timeout=timeout)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+            recorder.record(route, time.perf_counter() - request_started, ok)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(time.perf_counter() - started)
+
+
+def format_report(report: List[Dict[str, Any]]) -> str:
+    lines = [f"{'route':<40} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+
+    for row in report:
+        lines.append(
+            f"{row['route']:<40} {row['requests']:>9} {row['errors']:>7} {row['rps']:>9.1f} "
+            f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}"
+        )
+
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Load generator for the Offers microservice.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the running service")
+    parser.add_argument("--mix", default="list-all=6,history=3,create=1", help="weighted mix of routes")
+    parser.add_argument("--replay", help="replay requests from JSONL log instead of generating the mix")
+    parser.add_argument("--realtime", action="store_true", help="replay in the tempo of the captured offsets")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, help="length of the run in seconds")
+    parser.add_argument("--requests", type=int, help="number of requests to send")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the mix generator")
+    parser.add_argument("--json", action="store_true", help="print report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    base_url = args.url.rstrip("/")
+
+    if args.replay:
+        try:
+            source = iter(read_replay_log(args.replay))
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        if args.duration is None and args.requests is None:
+            args.duration = 30.0
+
+        product_ids = [product["id"] for product in requests.get(base_url + "/list-all").json()]
+        source = _mixed_requests(parse_mix(args.mix), product_ids, args.seed)
+
+    report = run(base_url, source, args.clients, args.duration, args.requests, args.realtime)
+
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Memory benchmark of the refresh cycle.
+
+For every catalog size, a database with that many active products is created and a fresh interpreter runs one refresh
+cycle (RefreshRunner, or APIHandler.update_offers(...) with `--method update-offers`) over it against a fake API
+answering instantly. Peak RSS of the cycle should stay flat as the catalog grows.
+
+Launch from `app` directory:
+
+    python -m benchmarks.refresh_memory --sizes 1000 10000 100000 1000000
+"""
+from typing import Optional, List, Dict
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SAMPLE = """
+import json, resource, sys, time
+from unittest.mock import patch
+
+from apihandler import APIHandler
+from database import SessionLocal
+from refresh import RefreshRunner
+
+
+class Response:
+    status_code = 200
+    calls = 0
+
+    def json(self):
+        Response.calls += 1
+        return [{"id": 1, "price": 100 + Response.calls % 10, "items_in_stock": 1},
+                {"id": 2, "price": 200, "items_in_stock": 0}]
+
+
+def get(url, **kwargs):
+    # plain function - a mock would remember all calls
+    return Response()
+
+
+def rss_kb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+
+
+db_session = SessionLocal()
+handler = APIHandler(db_session, "URL")
+handler.use_credentials(1, "AC_TOKEN")
+
+before = rss_kb()
+started = time.perf_counter()
+
+with patch("requests.get", get):
+    if sys.argv[2] == "cycle":
+        RefreshRunner(handler, db_session, chunk_size=int(sys.argv[1])).run()
+    else:
+        handler.update_offers(chunk_size=int(sys.argv[1]))
+
+print(json.dumps({
+    "products": Response.calls,
+    "seconds": time.perf_counter() - started,
+    "rss_before_mb": before / 1024,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def create_database(path: str, products: int, chunk_size: int = 10000) -> None:
+    from sqlalchemy import create_engine
+
+    from model import Base, Instance, Product
+
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        connection.execute(Instance.__table__.insert(), [{"access_token": "AC_TOKEN",
+                                                          "date": datetime.datetime.now()}])
+
+        for start in range(1, products + 1, chunk_size):
+            connection.execute(Product.__table__.insert(), [
+                {"id": product_id, "name": f"Product {product_id}", "description": "Description", "active": True}
+                for product_id in range(start, min(start + chunk_size, products + 1))
+            ])
+
+    engine.dispose()
+
+
+def sample(database: str, chunk_size: int, method: str) -> Dict[str, float]:
+    env = dict(os.environ, APPLIFTING_API_URL="URL", ABSOLUTE_DATABASE_LOCATION=database)
+
+    output = subprocess.run(
+        [sys.executable, "-c", SAMPLE, str(chunk_size), method],
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Memory benchmark of the refresh cycle.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="numbers of products")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="products refreshed between session releases")
+    parser.add_argument("--method", choices=("cycle", "update-offers"), default="cycle", help="what to run")
+    args = parser.parse_args(argv)
+
+    print(f"{'products':>10} {'seconds':>9} {'products/s':>11} {'RSS before MB':>14} {'peak RSS MB':>12}")
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "database.db")
+
+            create_database(database, size)
+            result = sample(database, args.chunk_size, args.method)
+
+        print(f"{result['products']:>10} {result['seconds']:>9.1f} {result['products'] / result['seconds']:>11.0f} "
+              f"{result['rss_before_mb']:>14.1f} {result['peak_rss_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Optional, Callable, Tuple
+
+from sqlalchemy.engine import Connectable
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import session
+
+import lease
+import migrations
+from apihandler import APIHandler
+from database import engine, SessionLocal
+from model import Base, Instance
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+AUTH_LEASE = "auth-handshake"
+
+
+class Bootstrap:
+    """
+    Lazy initialization of the service shared by api.py and updater.py.
+
+    Nothing happens on import or construction - database schema is checked and access token is loaded (or obtained
+    from /auth) only when it is first needed. Thanks to that, the service is ready to serve in milliseconds and
+    unreachable API blocks only requests, which really need to talk to it.
+
+    Process keeps only the schema flag and credentials, every handler gets its own database session. Authentication
+    handshake is coordinated through a lease in the database, so when several processes (e.g. uvicorn workers) start
+    at once, only one of them calls /auth and the others wait for its Instance.
+
+    Handlers keep products and offers in the database, unless `storage` (e.g. MemoryStorage) is given - it is shared by
+    all handlers then, credentials are still coordinated through the database.
+    """
+    _session_factory: Callable[[], session]
+    _bind: Connectable  # used for schema check
+    _storage: Optional[Storage]  # None for SQLStorage of the session of every handler
+    _base_url: Optional[str]
+    _retry_after: float  # seconds between handshake attempts after failure
+    _wait_timeout: float  # seconds to wait for handshake done by another process
+
+    _lock: threading.RLock
+    _schema_ready: bool = False
+    _credentials: Optional[Tuple[int, str]] = None
+    _last_failure: Optional[float] = None  # time.monotonic() of the last failed handshake
+
+    def __init__(self, base_url: Optional[str] = None, session_factory: Callable[[], session] = SessionLocal,
+                 bind: Connectable = engine, retry_after: float = 5.0, wait_timeout: float = 30.0,
+                 storage: Optional[Storage] = None) -> None:
+        self._base_url = base_url
+        self._session_factory = session_factory
+        self._bind = bind
+        self._storage = storage
+        self._retry_after = retry_after
+        self._wait_timeout = wait_timeout
+        self._lock = threading.RLock()
+
+    @property
+    def base_url(self) -> str:
+        """
+        :raises RuntimeError: if no url was given and APPLIFTING_API_URL is not set.
+        """
+        if self._base_url is None:
+            self._base_url = os.getenv("APPLIFTING_API_URL")
+
+            if self._base_url is None:
+                raise RuntimeError("No APPLIFTING_API_URL is set.")
+
+        return self._base_url
+
+    def new_session(self) -> session:
+        return self._session_factory()
+
+    def ensure_schema(self) -> None:
+        """
+        Creates missing tables and indexes, migrates database of an older version. Done only once per process.
+        """
+        if self._schema_ready:
+            return
+
+        with self._lock:
+            if not self._schema_ready:
+                try:
+                    Base.metadata.create_all(bind=self._bind)
+                except OperationalError:  # another process created some table in the meantime
+                    Base.metadata.create_all(bind=self._bind)
+
+                migrations.migrate(self._bind)
+
+                # create_all doesn't add indexes introduced later to already existing tables
+                for table in Base.metadata.sorted_tables:
+                    for index in table.indexes:
+                        try:
+                            index.create(bind=self._bind, checkfirst=True)
+                        except OperationalError:  # created by another process in the meantime
+                            pass
+
+                self._schema_ready = True
+
+    def handler(self, db_session: session) -> APIHandler:
+        """
+        Returns handler working with given session. It is authenticated only if credentials were already loaded
+        (see .authenticated_handler()).
+
+        :param db_session: database session owned by the caller
+        """
+        self.ensure_schema()
+
+        handler = APIHandler(db_session if self._storage is None else self._storage, self.base_url)
+
+        if self._credentials is not None:
+            handler.use_credentials(*self._credentials)
+
+        return handler
+
+    def authenticated_handler(self, db_session: session) -> APIHandler:
+        """
+        Returns handler ready to communicate with API.
+
+        :param db_session: database session owned by the caller
+
+        :raises RuntimeError: if handshake fails or failed less than `retry_after` seconds ago.
+        """
+        handler = self.handler(db_session)
+
+        if self._credentials is None:
+            handler.use_credentials(*self.credentials())
+
+        return handler
+
+    def credentials(self) -> Tuple[int, str]:
+        """
+        Access token is loaded from database or, if there is none, obtained by authentication handshake. Result is
+        cached for the lifetime of the process.
+
+        :raises RuntimeError: if handshake fails or failed less than `retry_after` seconds ago.
+
+        :return: (instance ID, access token)
+        """
+        if self._credentials is not None:
+            return self._credentials
+
+        with self._lock:
+            if self._credentials is not None:
+                return self._credentials
+
+            if self._last_failure is not None and time.monotonic() - self._last_failure < self._retry_after:
+                raise RuntimeError("Authentication handshake failed recently, try again later.")
+
+            self.ensure_schema()
+
+            db_session = self.new_session()
+            try:
+                self._credentials = self._coordinated_handshake(db_session)
+                self._last_failure = None
+            except Exception as error:
+                self._last_failure = time.monotonic()
+                raise RuntimeError(f"Authentication handshake failed: {error}") from error
+            finally:
+                db_session.close()
+
+        return self._credentials
+
+    def _coordinated_handshake(self, db_session: session) -> Tuple[int, str]:
+        holder = lease.new_holder()
+        deadline = time.monotonic() + self._wait_timeout
+
+        while True:
+            instance = db_session.query(Instance).order_by(Instance.id).first()
+            if instance is not None:  # we already have a access token
+                return instance.id, instance.access_token
+
+            # first time start - only the lease holder talks to /auth, the others wait for its Instance
+            if lease.acquire(db_session, AUTH_LEASE, holder, datetime.timedelta(seconds=self._wait_timeout)):
+                try:
+                    instance = db_session.query(Instance).order_by(Instance.id).first()
+                    if instance is not None:
+                        return instance.id, instance.access_token
+
+                    handler = APIHandler(db_session, self.base_url)
+                    handler.start()
+
+                    return handler.credentials
+                finally:
+                    lease.release(db_session, AUTH_LEASE, holder)
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out while waiting for authentication handshake of another process.")
+
+            db_session.rollback()  # end the transaction, so that the next query sees commits of other processes
+            time.sleep(0.1)
+
+    def warm_up(self) -> None:
+        """
+        Does all the lazy work in advance. Failures are only logged, they will be retried on demand.
+        """
+        try:
+            self.credentials()
+        except Exception:
+            logger.exception("Warm up failed, initialization will be retried on demand.")
+
+    def warm_up_in_background(self) -> threading.Thread:
+        """
+        Starts .warm_up() in daemon thread, so that the caller (e.g. application startup) isn't blocked.
+        """
+        thread = threading.Thread(target=self.warm_up, name="bootstrap-warm-up", daemon=True)
+        thread.start()
+
+        return thread
@@ -0,0 +1,162 @@
+"""
+ASGI middleware compressing complete responses by gzip or brotli (if the `brotli` package is installed), whichever
+the client prefers according to its Accept-Encoding.
+
+Only responses sent in one piece are compressed - streams (SSE, exports) are passed through untouched, so they are
+neither buffered nor delayed, and so are responses with their own Content-Encoding or compressed media type. ETag of
+compressed response gets the suffix of the encoding (e.g. `"list-42-br"`), so that different representations have
+different strong validators, see conditional.py.
+"""
+import gzip
+from typing import Optional, Dict
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is used then
+    brotli = None
+
+# encoding -> suffix of ETag
+SUFFIXES = {
+    "br": "-br",
+    "gzip": "-gzip",
+}
+
+# already compressed or streamed
+SKIPPED_TYPES = ("text/event-stream", "application/gzip", "application/zip", "image/", "video/", "audio/")
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """
+    :return: encoding -> quality (q) parsed from Accept-Encoding header
+    """
+    result = dict()
+
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        name = name.strip().lower()
+
+        if not name:
+            continue
+
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+
+        result[name] = quality
+
+    return result
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    :return: the best supported encoding accepted by the client or None for identity
+    """
+    accepted = accepted_encodings(accept_encoding)
+
+    candidates = []
+    for preference, encoding in enumerate(("br", "gzip")):
+        if encoding == "br" and brotli is None:
+            continue
+
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0.0:
+            # higher quality wins, brotli on tie
+            candidates.append((quality, -preference, encoding))
+
+    return max(candidates)[2] if candidates else None
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class CompressionMiddleware:
+    _app: ASGIApp
+    _minimum_size: int  # smaller responses aren't worth it
+    _level: int
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, level: int = 6) -> None:
+        self._app = app
+        self._minimum_size = minimum_size
+        self._level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+
+        if encoding is None:
+            await self._app(scope, receive, send)
+            return
+
+        await self._app(scope, receive, _Responder(send, encoding, self._minimum_size, self._level))
+
+
+class _Responder:
+    """
+    Holds back the start of the response until its first body message shows, whether it can be compressed.
+    """
+    _send: Send
+    _encoding: str
+    _minimum_size: int
+    _level: int
+
+    _start: Optional[Message] = None
+    _passthrough: bool = False
+
+    def __init__(self, send: Send, encoding: str, minimum_size: int, level: int) -> None:
+        self._send = send
+        self._encoding = encoding
+        self._minimum_size = minimum_size
+        self._level = level
+
+    def _skipped(self, headers: Headers, body: bytes, more_body: bool) -> bool:
+        return more_body or len(body) < self._minimum_size or self._start["status"] in (204, 206, 304) or \
+            "content-encoding" in headers or headers.get("content-type", "").startswith(SKIPPED_TYPES)
+
+    async def __call__(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self._start = message
+            return
+
+        if message["type"] != "http.response.body" or self._passthrough:
+            await self._send(message)
+            return
+
+        self._passthrough = True
+
+        body = message.get("body", b"")
+        headers = MutableHeaders(raw=self._start["headers"])
+
+        if self._skipped(headers, body, message.get("more_body", False)):
+            if "content-encoding" not in headers:
+                headers.add_vary_header("Accept-Encoding")
+
+            await self._send(self._start)
+            await self._send(message)
+            return
+
+        body = compress(body, self._encoding, self._level)
+
+        headers["Content-Encoding"] = self._encoding
+        headers["Content-Length"] = str(len(body))
+        headers.add_vary_header("Accept-Encoding")
+
+        etag = headers.get("etag")
+        if etag is not None and etag.endswith('"'):
+            headers["ETag"] = etag[:-1] + SUFFIXES[self._encoding] + '"'
+
+        await self._send(self._start)
+        await self._send({"type": "http.response.body", "body": body})
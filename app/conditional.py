@@ -0,0 +1,68 @@
+"""
+Strong validators (ETags) of responses derived from the data generation (see feed.generations(...)) and evaluation of
+If-None-Match, so that unchanged responses are answered by 304 Not Modified without computing them.
+
+Validator has to be taken before the response is computed - the response can only be newer than its validator then,
+which at worst costs the client one more full response.
+"""
+import hashlib
+from typing import Optional, Any
+
+from compression import SUFFIXES
+
+
+def etag(kind: str, *parts: Any) -> str:
+    """
+    :param kind: name of the resource, e.g. "list"
+    :param parts: everything the response depends on (generation, parameters)
+
+    :return: quoted strong entity tag
+    """
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+    return f'"{kind}-{digest}"'
+
+
+def matching(if_none_match: Optional[str], tag: str) -> Optional[str]:
+    """
+    :param if_none_match: value of If-None-Match header or None
+    :param tag: current ETag of the response
+
+    :return: tag of the representation the client has (with suffix of its encoding, see compression.py), if it is
+             the current one, or None
+    """
+    if not if_none_match:
+        return None
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+
+        if candidate == "*":
+            return tag
+
+        # If-None-Match uses weak comparison
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+
+        representation = candidate
+
+        # tags of compressed representations
+        for suffix in SUFFIXES.values():
+            if candidate.endswith(suffix + '"'):
+                candidate = candidate[:-len(suffix) - 1] + '"'
+                break
+
+        if candidate == tag:
+            return representation
+
+    return None
+
+
+def not_modified(if_none_match: Optional[str], tag: str) -> bool:
+    """
+    :param if_none_match: value of If-None-Match header or None
+    :param tag: current ETag of the response
+
+    :return: True if the client has the current response, i.e. it can be answered by 304
+    """
+    return matching(if_none_match, tag) is not None
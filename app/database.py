@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -9,7 +9,17 @@ SQLALCHEMY_DATABASE_URL = "sqlite:///./database.db"
 if os.getenv("ABSOLUTE_DATABASE_LOCATION") is not None:
     SQLALCHEMY_DATABASE_URL = "sqlite:///" + os.getenv("ABSOLUTE_DATABASE_LOCATION")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# several processes (API workers, updaters) share the database file - wait for locks instead of failing at once
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets readers work while somebody writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -0,0 +1,200 @@
+"""
+Streaming export of offer history.
+
+Offers are read in chunks by keyset pagination over Offer.id (no OFFSET, no long-lived cursor holding a transaction
+open) and every chunk is encoded and handed over before the next one is read, so memory doesn't grow with the size of
+the export. Export covers offers with ID up to the watermark taken at its start, the next incremental export continues
+after it (see `after_id`).
+
+Formats:
+
+- ndjson - one JSON object per offer,
+- csv - header and one line per offer,
+- columnar - one JSON object per chunk with a list of values for every column.
+
+    python export.py --format csv --product-id 1 --product-id 2 --gzip --output offers.csv.gz
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import sys
+import zlib
+from typing import Optional, List, Iterator, Tuple, Sequence
+
+from sqlalchemy import select, and_, func
+from sqlalchemy.orm import session
+
+from model import Offer, Snapshot
+
+FORMATS = ("ndjson", "csv", "columnar")
+COLUMNS = ("id", "product_id", "price", "items_in_stock", "acquired_on", "status")
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "columnar": "application/x-ndjson",
+}
+
+offer = Offer.__table__
+snapshot = Snapshot.__table__
+
+
+def watermark(db_session: session) -> int:
+    """
+    :return: ID of the newest offer
+    """
+    return db_session.execute(select([func.max(offer.c.id)])).scalar() or 0
+
+
+def iter_chunks(db_session: session, product_ids: Optional[Sequence[int]] = None,
+                start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+                after_id: int = 0, up_to_id: Optional[int] = None, chunk_size: int = 10000) -> Iterator[List[Tuple]]:
+    """
+    :param product_ids: export only offers of these products, None for all of them
+    :param start: export only offers acquired at or after start
+    :param end: export only offers acquired at or before end
+    :param after_id: export only offers with greater ID (watermark of the previous export)
+    :param up_to_id: export only offers with ID up to this one, None for the current watermark
+
+    :return: chunks of rows with COLUMNS, sorted by ID
+    """
+    if up_to_id is None:
+        up_to_id = watermark(db_session)
+
+    conditions = [offer.c.id <= up_to_id]
+
+    if product_ids is not None:
+        conditions.append(offer.c.product_id.in_(product_ids))
+
+    if start is not None:
+        conditions.append(snapshot.c.acquired_on >= start)
+
+    if end is not None:
+        conditions.append(snapshot.c.acquired_on <= end)
+
+    columns = [offer.c.id, offer.c.product_id, offer.c.price, offer.c.items_in_stock, snapshot.c.acquired_on,
+               snapshot.c.status]
+
+    while True:
+        chunk = db_session.execute(
+            select(columns).select_from(
+                offer.join(snapshot, snapshot.c.id == offer.c.snapshot_id)
+            ).where(and_(offer.c.id > after_id, *conditions)).order_by(offer.c.id).limit(chunk_size)
+        ).fetchall()
+
+        # chunk is read, don't keep the read transaction open while the consumer handles it
+        db_session.commit()
+
+        if not chunk:
+            return
+
+        yield [(row[0], row[1], row[2], row[3], row[4].isoformat(), row[5].name) for row in chunk]
+
+        after_id = chunk[-1][0]
+
+
+def _encode_ndjson(chunks: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in chunk).encode()
+
+
+def _encode_csv(chunks: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    writer.writerow(COLUMNS)
+
+    for chunk in chunks:
+        writer.writerows(chunk)
+
+        yield buffer.getvalue().encode()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():  # header of empty export
+        yield buffer.getvalue().encode()
+
+
+def _encode_columnar(chunks: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield (json.dumps(dict(zip(COLUMNS, map(list, zip(*chunk))))) + "\n").encode()
+
+
+def _gzip(blocks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export(db_session: session, export_format: str = "ndjson", compress: bool = False,
+           **kwargs) -> Iterator[bytes]:
+    """
+    Encode offers chunk by chunk.
+
+    :param export_format: one of FORMATS
+    :param compress: gzip the output
+    :param kwargs: passed to iter_chunks(...)
+
+    :raises ValueError: on unknown format
+
+    :return: blocks of the output
+    """
+    encoders = {
+        "ndjson": _encode_ndjson,
+        "csv": _encode_csv,
+        "columnar": _encode_columnar,
+    }
+
+    if export_format not in encoders:
+        raise ValueError(f"Unknown format, use one of {', '.join(FORMATS)}.")
+
+    blocks = encoders[export_format](iter_chunks(db_session, **kwargs))
+
+    return _gzip(blocks) if compress else blocks
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Export offer history.")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson", help="output format")
+    parser.add_argument("--product-id", type=int, action="append", help="export only given product (repeatable)")
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat, help="acquired at or after (ISO format)")
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, help="acquired at or before (ISO format)")
+    parser.add_argument("--after-id", type=int, default=0, help="watermark of the previous export")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="offers read at once")
+    parser.add_argument("--gzip", action="store_true", help="compress the output")
+    parser.add_argument("--output", help="output file, standard output by default")
+    args = parser.parse_args(argv)
+
+    db_session = SessionLocal()
+    try:
+        up_to_id = watermark(db_session)
+
+        blocks = export(db_session, args.format, args.gzip, product_ids=args.product_id, start=args.start,
+                        end=args.end, after_id=args.after_id, up_to_id=up_to_id, chunk_size=args.chunk_size)
+
+        output = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            for block in blocks:
+                output.write(block)
+        finally:
+            if args.output:
+                output.close()
+    finally:
+        db_session.close()
+
+    # the next incremental export continues with --after-id set to this
+    print(f"watermark: {up_to_id}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
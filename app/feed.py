@@ -0,0 +1,280 @@
+"""
+Change feed - every committed snapshot of offers and every change of a product is also stored as a ChangeEvent.
+The table is the cross-process source of changes: updater writes it in the same transaction as the offers, API
+workers tail it and push the changes to their subscribers (see ChangeFeed and /stream endpoint).
+"""
+import asyncio
+import datetime
+import json
+import logging
+from typing import Optional, Dict, List, Any, Set, Iterable, Callable, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import session
+
+from model import ChangeEvent, ChangeKind
+
+logger = logging.getLogger(__name__)
+
+
+def best_price_of(offers: Iterable[Tuple[int, int]]) -> Optional[int]:
+    """
+    :param offers: (price, items in stock) pairs
+    :return: the lowest price of offers in stock or None
+    """
+    return min((price for price, items_in_stock in offers if items_in_stock > 0), default=None)
+
+
+def publish_snapshot(db_session: session, product_id: int, acquired_on: datetime.datetime,
+                     offers: List[Tuple[int, int]], previous_offers: List[Tuple[int, int]]) -> ChangeEvent:
+    """
+    Add event about new snapshot of offers. Caller commits it together with the offers.
+
+    :param offers: new (price, items in stock) pairs
+    :param previous_offers: (price, items in stock) pairs, which were active until now
+    """
+    event = ChangeEvent(
+        kind=ChangeKind.snapshot,
+        product_id=product_id,
+        created_on=acquired_on,
+        changed=sorted(offers) != sorted(previous_offers),
+        best_price=best_price_of(offers),
+        previous_best_price=best_price_of(previous_offers),
+        payload=json.dumps({
+            "acquired_on": acquired_on.isoformat(),
+            "offers": [{"price": price, "items_in_stock": items_in_stock} for price, items_in_stock in offers]
+        })
+    )
+
+    db_session.add(event)
+
+    return event
+
+
+def publish_product(db_session: session, product_id: int, action: str, **data: Any) -> ChangeEvent:
+    """
+    Add event about created, updated or deleted product. Caller commits it together with the change.
+    """
+    event = ChangeEvent(
+        kind=ChangeKind.product,
+        product_id=product_id,
+        created_on=datetime.datetime.now(),
+        changed=True,
+        payload=json.dumps(dict(data, action=action))
+    )
+
+    db_session.add(event)
+
+    return event
+
+
+def prune(db_session: session, older_than: datetime.timedelta) -> int:
+    """
+    Delete old events. The newest event is always kept, so that IDs of new events keep growing (SQLite would reuse
+    them after emptied table), and so are the last changing and product events, so that the data generations never go
+    back, see generations(...).
+
+    :return: number of deleted events
+    """
+    last_id, last_changed_id, last_product_id = generations(db_session)
+
+    deleted = db_session.query(ChangeEvent).filter(
+        ChangeEvent.created_on < datetime.datetime.now() - older_than,
+        ChangeEvent.id < last_id,
+        ChangeEvent.id.notin_([last_changed_id, last_product_id])
+    ).delete(synchronize_session=False)
+
+    db_session.commit()
+
+    return deleted
+
+
+def format_event(event: ChangeEvent) -> str:
+    """
+    :return: event in Server-Sent Events format
+    """
+    data = json.loads(event.payload)
+    data["product_id"] = event.product_id
+
+    if event.kind == ChangeKind.snapshot:
+        data["best_price"] = event.best_price
+        data["previous_best_price"] = event.previous_best_price
+
+    return f"id: {event.id}\nevent: {event.kind.name}\ndata: {json.dumps(data)}\n\n"
+
+
+def fetch_events(db_session: session, after_id: int, limit: int = 1000) -> List[Tuple[int, int, str]]:
+    """
+    :return: (ID, product ID, SSE message) of events with ID greater than after_id, which are worth pushing
+    """
+    events = db_session.query(ChangeEvent).filter(
+        ChangeEvent.id > after_id,
+        ChangeEvent.changed == True
+    ).order_by(ChangeEvent.id).limit(limit)
+
+    return [(event.id, event.product_id, format_event(event)) for event in events]
+
+
+def last_event_id(db_session: session) -> int:
+    last = db_session.query(ChangeEvent.id).order_by(ChangeEvent.id.desc()).first()
+
+    return 0 if last is None else last[0]
+
+
+def generations(db_session: session) -> Tuple[int, int, int]:
+    """
+    Versions of the data - they change, whenever something is committed.
+
+    :return: ID of the last event (changes with every snapshot, even one with the same offers, or product change),
+             ID of the last changing event (changes only when current offers or products change) and ID of the last
+             product event (changes with product created, edited or deleted)
+    """
+    # all are answered by an index without scanning the events
+    last_id, last_changed_id, last_product_id = db_session.query(
+        db_session.query(func.max(ChangeEvent.id)).scalar_subquery(),
+        db_session.query(func.max(ChangeEvent.id)).filter(ChangeEvent.changed == True).scalar_subquery(),
+        db_session.query(func.max(ChangeEvent.id)).filter(ChangeEvent.kind == ChangeKind.product).scalar_subquery()
+    ).one()
+
+    return last_id or 0, last_changed_id or 0, last_product_id or 0
+
+
+class Subscription:
+    """
+    Queue of SSE messages for one client. When the client doesn't keep up and the queue is full, further messages are
+    dropped and the client gets `resync` event once it catches up, so that it knows to reload the full state.
+    """
+    product_ids: Optional[Set[int]]  # None means all products
+    _queue: "asyncio.Queue[str]"
+    _lagging: bool = False
+
+    RESYNC = "event: resync\ndata: {}\n\n"
+
+    def __init__(self, product_ids: Optional[Set[int]], max_pending: int) -> None:
+        self.product_ids = product_ids
+        self._queue = asyncio.Queue(maxsize=max_pending)
+
+    def push(self, message: str) -> None:
+        if self._lagging:
+            return
+
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self._lagging = True
+
+    async def get(self, timeout: float) -> Optional[str]:
+        """
+        :return: next message or None, if there was none within timeout
+        """
+        if self._lagging and self._queue.empty():
+            self._lagging = False
+            return self.RESYNC
+
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ChangeFeed:
+    """
+    Tails change_event table and fans the events out to subscriptions of this process.
+
+    There is one poller per process regardless of the number of clients, every event is formatted once and its
+    message is shared by all subscriptions. Subscriptions are indexed by product ID, so that an event is offered only
+    to subscriptions interested in it. Poller starts with the first subscription and runs until .close().
+    """
+    _session_factory: Callable[[], session]
+    _interval: float  # seconds between polls
+    _max_pending: int  # messages per subscription
+
+    _all: Set[Subscription]
+    _by_product: Dict[int, Set[Subscription]]
+    _last_id: Optional[int] = None
+    _task: Optional["asyncio.Task"] = None
+
+    def __init__(self, session_factory: Callable[[], session], interval: float = 0.5, max_pending: int = 100) -> None:
+        self._session_factory = session_factory
+        self._interval = interval
+        self._max_pending = max_pending
+        self._all = set()
+        self._by_product = dict()
+
+    async def _run_in_thread(self, function: Callable, *args):
+        def run():
+            db_session = self._session_factory()
+            try:
+                return function(db_session, *args)
+            finally:
+                db_session.close()
+
+        return await asyncio.get_event_loop().run_in_executor(None, run)
+
+    async def subscribe(self, product_ids: Optional[Set[int]] = None,
+                        last_seen_id: Optional[int] = None) -> Subscription:
+        """
+        :param product_ids: IDs of products of interest or None for all of them
+        :param last_seen_id: ID of the last event the client has seen (SSE Last-Event-ID) or None for new events only
+        """
+        if self._last_id is None:
+            last_id = await self._run_in_thread(last_event_id)
+
+            if self._last_id is None:  # another subscription could have done it in the meantime
+                self._last_id = last_id
+
+        subscription = Subscription(product_ids, self._max_pending)
+
+        if product_ids is None:
+            self._all.add(subscription)
+        else:
+            for product_id in product_ids:
+                self._by_product.setdefault(product_id, set()).add(subscription)
+
+        if last_seen_id is not None:
+            # events up to _last_id weren't dispatched to this subscription, newer ones will be
+            up_to = self._last_id
+            for event_id, product_id, message in await self._run_in_thread(fetch_events, last_seen_id):
+                if event_id <= up_to and (product_ids is None or product_id in product_ids):
+                    subscription.push(message)
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._poll())
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._all.discard(subscription)
+
+        for product_id in subscription.product_ids or ():
+            subscriptions = self._by_product.get(product_id)
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self._by_product[product_id]
+
+    def dispatch(self, event_id: int, product_id: int, message: str) -> None:
+        for subscription in self._all:
+            subscription.push(message)
+
+        for subscription in self._by_product.get(product_id, ()):
+            subscription.push(message)
+
+        self._last_id = max(self._last_id or 0, event_id)
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                for event in await self._run_in_thread(fetch_events, self._last_id):
+                    self.dispatch(*event)
+            except Exception:
+                logger.exception("Polling of change feed failed.")
+
+            await asyncio.sleep(self._interval)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,106 @@
+"""
+Freshness of offers of active products - how long ago they were refreshed (see Product.last_refreshed_on, set by
+APIHandler.refresh_product(...)), so that it can be checked, that refresh keeps up with the size of the catalog.
+
+Refresh times of all active products are read once in order of the index of `last_refreshed_on` (a single column, a few
+MB for 100 000 products) and counts, percentiles and maximum of staleness are picked from them in Python. Only the most
+stale products violating the SLO are loaded whole. Products never refreshed are infinitely stale - they violate every
+SLO and percentiles, which fall on them, are None.
+"""
+import bisect
+import datetime
+import math
+import os
+from typing import Optional, Dict, Any, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.orm import session
+
+from model import Product
+
+PERCENTILES = (50, 90, 95, 99)
+
+# maximal allowed staleness, by default the same as the maximal staleness of adaptive refresh (see scheduler.py)
+DEFAULT_SLO = datetime.timedelta(seconds=float(os.getenv("FRESHNESS_SLO", "600")))
+
+# fills the column of products refreshed before it existed (see migrations.py) from their active snapshot - the offers
+# of the last refresh, historic snapshots (e.g. imported ones) say nothing about the freshness of the current offers
+FILL_LAST_REFRESHED = "UPDATE product SET last_refreshed_on = (SELECT max(snapshot.acquired_on) FROM snapshot " \
+                      "WHERE snapshot.product_id = product.id AND snapshot.status = 'active') " \
+                      "WHERE last_refreshed_on IS NULL AND EXISTS (SELECT 1 FROM snapshot " \
+                      "WHERE snapshot.product_id = product.id AND snapshot.status = 'active')"
+
+
+def report(db_session: session, slo: datetime.timedelta, percentiles: Tuple[float, ...] = PERCENTILES,
+           limit: int = 100, now: Optional[datetime.datetime] = None) -> Dict[str, Any]:
+    """
+    :param slo: maximal allowed staleness
+    :param percentiles: percentiles of staleness to be reported
+    :param limit: maximal number of listed violating products
+    :param now: time the staleness is measured at, defaults to now
+
+    :raises ValueError: if some percentile isn't within (0, 100]
+
+    :return: number of active products (and of never refreshed ones), staleness percentiles and maximum in seconds,
+             share of products within the SLO and the most stale products violating it
+    """
+    if any(not 0 < percentile <= 100 for percentile in percentiles):
+        raise ValueError("Percentiles have to be within (0, 100].")
+
+    if now is None:
+        now = datetime.datetime.now()
+
+    def staleness(refreshed_on: Optional[datetime.datetime]) -> Optional[float]:
+        return None if refreshed_on is None else (now - refreshed_on).total_seconds()
+
+    active = db_session.query(Product).filter(Product.active == True)
+
+    rows = active.with_entities(Product.last_refreshed_on).order_by(Product.last_refreshed_on).all()
+
+    # the most stale first, never refreshed (NULL) ones are counted apart - databases sort NULL differently
+    refreshed_on = [refreshed_on for (refreshed_on,) in rows if refreshed_on is not None]
+
+    products = len(rows)
+    never_refreshed = products - len(refreshed_on)
+
+    # the freshest first, never refreshed last
+    by_staleness = refreshed_on[::-1] + [None] * never_refreshed
+
+    result = dict()
+    for percentile in percentiles:
+        if products == 0:
+            result[f"{percentile:g}"] = None
+            continue
+
+        # nearest rank
+        rank = max(math.ceil(percentile / 100 * products), 1)
+        result[f"{percentile:g}"] = staleness(by_staleness[rank - 1])
+
+    oldest = None
+    if products and not never_refreshed:
+        oldest = staleness(refreshed_on[0])
+
+    violations = never_refreshed + bisect.bisect_left(refreshed_on, now - slo)
+
+    violating = active.filter(or_(Product.last_refreshed_on == None, Product.last_refreshed_on < now - slo))
+
+    items = [{
+        "id": product.id,
+        "name": product.name,
+        "last_refreshed_on": product.last_refreshed_on,
+        "last_changed_on": product.last_changed_on,
+        "staleness": staleness(product.last_refreshed_on),
+    } for product in violating.order_by(Product.last_refreshed_on, Product.id).limit(limit)]
+
+    return {
+        "products": products,
+        "never_refreshed": never_refreshed,
+        "slo": slo.total_seconds(),
+        "within_slo": (products - violations) / products if products else 1.0,
+        "percentiles": result,
+        "max": oldest,
+        "violations": {
+            "total": violations,
+            "items": items,
+        },
+    }
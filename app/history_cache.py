@@ -0,0 +1,192 @@
+"""
+Cache of encoded /product-offer-history responses keyed by product and normalized time range.
+
+- Ranges reaching the present (open end or end within the last `settle` seconds, snapshots are committed a bit after
+  they were acquired) are valid as long as the data generation (ID of the last change event, see
+  Storage.generations()) is the same - every committed snapshot or product change invalidates them.
+- Fully historic ranges are kept until they are evicted, only product changes (e.g. deletion or history backfilled
+  by importer.py) drop them and change their validators.
+- The default range (no start, the last 5 minutes) moves with time and isn't cached here, see trends.py.
+
+Concurrent requests for the same missing entry wait for a single computation instead of all hitting the database.
+Size of the cache is bounded by the total length of the stored responses, the least recently used ones are evicted.
+Generation is read at most once per `max_lag` seconds, so new data can stay invisible for up to that long.
+"""
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Optional, Callable, Tuple, Dict, Union
+
+from sqlalchemy.orm import session
+
+import conditional
+from storage import Storage, storage_of
+
+Key = Tuple[int, datetime.datetime, Optional[datetime.datetime]]
+
+
+class _Flight:
+    """
+    Computation in progress, which other requests for the same key wait for.
+    """
+    done: threading.Event
+    result: Optional[bytes] = None
+    error: Optional[BaseException] = None
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+
+
+class HistoryCache:
+    _max_bytes: int
+    _max_lag: datetime.timedelta
+    _settle: datetime.timedelta
+
+    _entries: "OrderedDict[Key, Tuple[Optional[int], bytes]]"  # key -> (generation or None if historic, response)
+    _size: int = 0  # bytes of all stored responses
+    _flights: Dict[Key, _Flight]
+
+    _generation: Optional[int] = None
+    _product_generation: Optional[int] = None
+    _checked_on: Optional[datetime.datetime] = None
+
+    _lock: threading.Lock
+
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_lag: float = 1.0, settle: float = 300.0) -> None:
+        self._max_bytes = max_bytes
+        self._max_lag = datetime.timedelta(seconds=max_lag)
+        self._settle = datetime.timedelta(seconds=settle)
+        self._entries = OrderedDict()
+        self._flights = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @staticmethod
+    def normalize(product_id: int, start: datetime.datetime, end: Optional[datetime.datetime]) -> Key:
+        if end is not None and start > end:
+            start, end = end, start
+
+        return product_id, start, end
+
+    def _refresh_generation(self, storage: Union[Storage, session], now: datetime.datetime,
+                            force: bool = False) -> int:
+        if force or self._checked_on is None or now - self._checked_on > self._max_lag:
+            generation, _, product_generation = storage_of(storage).generations()
+
+            with self._lock:
+                if product_generation != self._product_generation:
+                    # product was changed or deleted, historic ranges can't be trusted anymore
+                    self._entries.clear()
+                    self._size = 0
+
+                self._generation = generation
+                self._product_generation = product_generation
+                self._checked_on = now
+
+        return self._generation
+
+    def _store(self, key: Key, generation: Optional[int], response: bytes) -> None:
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous[1])
+
+        if len(response) > self._max_bytes:
+            return
+
+        self._entries[key] = (generation, response)
+        self._size += len(response)
+
+        while self._size > self._max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _historic(self, key: Key, now: datetime.datetime) -> bool:
+        # the generation matters only when the range reaches the present
+        return key[2] is not None and key[2] < now - self._settle
+
+    def etag(self, storage: Union[Storage, session], product_id: int, start: datetime.datetime,
+             end: Optional[datetime.datetime]) -> str:
+        """
+        Strong validator of the response. Current generation is read, .get(...) called right after it returns
+        response at least as new as the validator.
+
+        :param storage: storage (or database session) the data generation is read from
+        :param start: start of the range
+        :param end: end of the range or None for now
+        """
+        now = datetime.datetime.now()
+        key = self.normalize(product_id, start, end)
+
+        generation = self._refresh_generation(storage, now, force=True)
+
+        if self._historic(key, now):
+            return conditional.etag("history", key, "product", self._product_generation)
+
+        return conditional.etag("history", key, generation)
+
+    def get(self, storage: Union[Storage, session], product_id: int, start: datetime.datetime,
+            end: Optional[datetime.datetime], compute: Callable[[], bytes]) -> bytes:
+        """
+        :param storage: storage (or database session) the data generation is read from
+        :param start: start of the range
+        :param end: end of the range or None for now
+        :param compute: computes the encoded response, exceptions are passed to all waiting callers and nothing is
+                        cached
+
+        :return: cached or computed response
+        """
+        now = datetime.datetime.now()
+        key = self.normalize(product_id, start, end)
+
+        generation = self._refresh_generation(storage, now)
+
+        required = None if self._historic(key, now) else generation
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and (entry[0] is None or entry[0] == required):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+                if flight.error is None:
+                    self._store(key, required, flight.result)
+
+            flight.done.set()
+
+        return flight.result
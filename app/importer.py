@@ -0,0 +1,318 @@
+"""
+Bulk import of historical offers from NDJSON or CSV files (optionally gzipped), e.g. the output of export.py.
+
+The file is read as a stream, every row is validated (known product, non-negative integers, ISO time, known status)
+and valid rows are inserted by plain executemany in large batches (snapshots of the offers are created on the way),
+several batches per transaction. Indexes can be dropped for the time of the import and rebuilt once at its end, which
+is much faster than updating them row by row. Rejected rows are counted and the first few of them are logged.
+
+Imported offers change history, which caches and validators of the API otherwise treat as settled, so every product,
+that got some offers, gets a product change event (action `imported`, see feed.py) once the import is committed.
+
+    python importer.py offers.ndjson.gz --defer-indexes
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, List, Iterator, Dict, Any, Set, IO, Tuple, Callable
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connectable, Connection
+from sqlalchemy.orm import Session
+
+import feed
+from model import Product, Offer, OfferStatus, Snapshot
+
+logger = logging.getLogger(__name__)
+
+offer = Offer.__table__
+snapshot = Snapshot.__table__
+
+FORMATS = ("ndjson", "csv")
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def detect_format(path: str) -> str:
+    name = path[:-3] if path.endswith(".gz") else path
+
+    return "csv" if name.endswith(".csv") else "ndjson"
+
+
+def open_source(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", newline="")
+
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_rows(source: IO[str], source_format: str) -> Iterator[Dict[str, Any]]:
+    """
+    :return: raw rows of the file one by one, lines, which aren't valid JSON, as InvalidRow (see validate(...)), so
+             that a corrupt line is rejected instead of stopping the import
+    """
+    if source_format == "csv":
+        yield from csv.DictReader(source)
+    elif source_format == "ndjson":
+        for line in source:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as error:
+                    yield InvalidRow(f"invalid JSON ({error})")
+    else:
+        raise ValueError(f"Unknown format, use one of {', '.join(FORMATS)}.")
+
+
+def validate(row: Dict[str, Any], product_ids: Set[int]) -> Dict[str, Any]:
+    """
+    Imported offers are always historic - the active ones are those of the last refresh, so an active row (e.g. of an
+    export) would add a second active snapshot to its product. Its status is only checked to be known.
+
+    :param row: raw row or InvalidRow read instead of it
+    :param product_ids: IDs of existing products
+
+    :raises InvalidRow: with the reason
+
+    :return: values of new offer
+    """
+    if isinstance(row, InvalidRow):
+        raise row
+
+    try:
+        product_id = int(row["product_id"])
+        price = int(row["price"])
+        items_in_stock = int(row["items_in_stock"])
+        acquired_on = datetime.datetime.fromisoformat(row["acquired_on"])
+        OfferStatus[row.get("status") or "historic"]
+    except KeyError as error:
+        raise InvalidRow(f"missing or unknown value {error}")
+    except (TypeError, ValueError) as error:
+        raise InvalidRow(str(error))
+
+    if product_id not in product_ids:
+        raise InvalidRow(f"product {product_id} doesn't exist")
+
+    if price < 0 or items_in_stock < 0:
+        raise InvalidRow("price and items in stock can't be negative")
+
+    return {
+        "product_id": product_id,
+        "price": price,
+        "items_in_stock": items_in_stock,
+        "acquired_on": acquired_on,
+        "status": OfferStatus.historic,
+    }
+
+
+class _Writer:
+    """
+    Collects valid rows of a batch and inserts them by plain executemany - new snapshots first, then their offers.
+    Bind processors of the columns are looked up once, instead of letting SQLAlchemy process parameters of every row.
+
+    Offers of one snapshot are expected to be close to each other in the file (as in the output of export.py) - the last
+    `remembered` snapshots are reused by the following rows, offers of an older one would get a new snapshot.
+    """
+    _connection: Connection
+    _remembered: int
+    _known: "OrderedDict[Tuple, int]"  # (product ID, time, status) -> snapshot ID
+    _pending: Dict[Tuple, int]  # (product ID, time, status) -> index in _snapshots
+    _snapshots: List[Tuple]  # new snapshots
+    _offers: List[List]  # snapshot ID (or -1 - index of pending snapshot), product ID, price, items in stock
+
+    SNAPSHOT = "INSERT INTO snapshot (product_id, acquired_on, status) VALUES (?, ?, ?)"
+    OFFER = "INSERT INTO offer (snapshot_id, product_id, price, items_in_stock) VALUES (?, ?, ?, ?)"
+
+    def __init__(self, connection: Connection, remembered: int = 100000) -> None:
+        self._connection = connection
+        self._remembered = remembered
+        self._known = OrderedDict()
+        self._pending = dict()
+        self._snapshots = []
+        self._offers = []
+
+        self._encode_time = self._processor(snapshot.c.acquired_on.type, connection.dialect)
+        self._encode_status = self._processor(snapshot.c.status.type, connection.dialect)
+
+    @staticmethod
+    def _processor(column_type, dialect) -> Callable[[Any], Any]:
+        return column_type.dialect_impl(dialect).bind_processor(dialect) or (lambda value: value)
+
+    def __len__(self) -> int:
+        return len(self._offers)
+
+    def add(self, row: Dict[str, Any]) -> None:
+        key = (row["product_id"], row["acquired_on"], row["status"])
+
+        snapshot_id = self._known.get(key)
+        if snapshot_id is None:
+            index = self._pending.get(key)
+
+            if index is None:
+                index = self._pending[key] = len(self._snapshots)
+                self._snapshots.append(
+                    (row["product_id"], self._encode_time(row["acquired_on"]), self._encode_status(row["status"]))
+                )
+
+            snapshot_id = -1 - index
+
+        self._offers.append([snapshot_id, row["product_id"], row["price"], row["items_in_stock"]])
+
+    def flush(self) -> int:
+        """
+        :return: number of inserted offers
+        """
+        if self._snapshots:
+            self._connection.exec_driver_sql(self.SNAPSHOT, self._snapshots)
+
+            # the transaction holds the write lock since the insert, so the new snapshots got the highest IDs in order
+            first_id = self._connection.exec_driver_sql("SELECT max(id) FROM snapshot").scalar() - \
+                len(self._snapshots) + 1
+
+            for offer_row in self._offers:
+                if offer_row[0] < 0:
+                    offer_row[0] = first_id - 1 - offer_row[0]
+
+            for key, index in self._pending.items():
+                self._known[key] = first_id + index
+
+            while len(self._known) > self._remembered:
+                self._known.popitem(last=False)
+
+        self._connection.exec_driver_sql(self.OFFER, [tuple(offer_row) for offer_row in self._offers])
+
+        inserted = len(self._offers)
+
+        self._pending = dict()
+        self._snapshots = []
+        self._offers = []
+
+        return inserted
+
+
+def import_rows(bind: Connectable, rows: Iterator[Dict[str, Any]], batch_size: int = 50000,
+                batches_per_transaction: int = 10, defer_indexes: bool = False,
+                max_logged_errors: int = 10) -> Dict[str, Any]:
+    """
+    Validate and insert rows into snapshot and offer tables. Times of the last refresh of products are left alone -
+    imported offers are historic, they don't make the current ones fresher.
+
+    :param bind: engine (or connection) of the database
+    :param rows: raw rows, see read_rows(...)
+    :param batch_size: rows inserted by one executemany
+    :param batches_per_transaction: batches committed at once
+    :param defer_indexes: drop indexes of snapshot and offer tables during the import and create them at the end
+
+    :return: report - imported and rejected rows, touched products, elapsed seconds and throughput
+    """
+    started = time.perf_counter()
+
+    imported = 0
+    rejected = 0
+    touched: Dict[int, List] = dict()  # product ID -> [the first and the last imported time, number of offers]
+
+    with bind.connect() as connection:
+        writer = _Writer(connection)
+
+        product_ids = {product_id for (product_id,) in connection.execute(select([Product.__table__.c.id]))}
+
+        indexes = list(snapshot.indexes) + list(offer.indexes) if defer_indexes else []
+        for index in indexes:
+            index.drop(bind=connection, checkfirst=True)
+
+        try:
+            transaction = connection.begin()
+            batches = 0
+
+            for line, row in enumerate(rows, start=1):
+                try:
+                    row = validate(row, product_ids)
+                except InvalidRow as error:
+                    rejected += 1
+                    if rejected <= max_logged_errors:
+                        logger.warning(f"Row {line} rejected: {error}.")
+                    continue
+
+                writer.add(row)
+
+                span = touched.get(row["product_id"])
+                if span is None:
+                    touched[row["product_id"]] = [row["acquired_on"], row["acquired_on"], 1]
+                else:
+                    span[0] = min(span[0], row["acquired_on"])
+                    span[1] = max(span[1], row["acquired_on"])
+                    span[2] += 1
+
+                if len(writer) >= batch_size:
+                    imported += writer.flush()
+                    batches += 1
+
+                    if batches % batches_per_transaction == 0:
+                        transaction.commit()
+                        transaction = connection.begin()
+
+                        logger.info(f"{imported} rows imported, "
+                                    f"{imported / (time.perf_counter() - started):.0f} rows/s.")
+
+            if len(writer):
+                imported += writer.flush()
+
+            transaction.commit()
+        finally:
+            for index in indexes:
+                index.create(bind=connection, checkfirst=True)
+
+        # history of the products changed - feeds, caches and validators of the API follow the events
+        if touched:
+            db_session = Session(bind=connection)
+            try:
+                for product_id, (first, last, offers) in sorted(touched.items()):
+                    feed.publish_product(db_session, product_id, "imported", first_acquired_on=first.isoformat(),
+                                         last_acquired_on=last.isoformat(), offers=offers)
+                db_session.commit()
+            finally:
+                db_session.close()
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        "imported": imported,
+        "rejected": rejected,
+        "products": len(touched),
+        "elapsed": elapsed,
+        "rows_per_second": imported / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    parser = argparse.ArgumentParser(description="Import historical offers.")
+    parser.add_argument("path", help="NDJSON or CSV file, optionally gzipped (.gz)")
+    parser.add_argument("--format", choices=FORMATS, help="format of the file, detected from its name by default")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows inserted at once")
+    parser.add_argument("--batches-per-transaction", type=int, default=10, help="batches committed at once")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="rebuild indexes of snapshot and offer tables after the import instead of updating them")
+    args = parser.parse_args(argv)
+
+    with open_source(args.path) as source:
+        report = import_rows(engine, read_rows(source, args.format or detect_format(args.path)), args.batch_size,
+                             args.batches_per_transaction, args.defer_indexes)
+
+    print(f"{report['imported']} rows imported, {report['rejected']} rejected in {report['elapsed']:.1f} s "
+          f"({report['rows_per_second']:.0f} rows/s).")
+
+
+if __name__ == "__main__":
+    main()
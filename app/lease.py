@@ -0,0 +1,60 @@
+import datetime
+import os
+import socket
+import uuid
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import session
+
+from model import Lease
+
+
+def new_holder() -> str:
+    """
+    Returns identity unique for this process (and call), to be used as a lease holder.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire(db_session: session, name: str, holder: str, duration: datetime.timedelta) -> bool:
+    """
+    Try to acquire (or renew) named lease. Lease is granted, if nobody holds it, if it is already held by the same
+    holder or if the previous holder failed to renew it in time. Works across processes and hosts sharing the database,
+    because the decision is made by a single conditional UPDATE.
+
+    :param db_session: database session, it will be committed
+    :param name: of the lease
+    :param holder: identity of the caller, see new_holder()
+    :param duration: how long will the lease be valid without renewal
+
+    :return: True if lease is held by holder now, False otherwise
+    """
+    now = datetime.datetime.now()
+
+    if db_session.query(Lease).get(name) is None:
+        try:
+            db_session.add(Lease(name=name, holder=None, expires_on=now))
+            db_session.commit()
+        except IntegrityError:  # somebody else created it in the meantime
+            db_session.rollback()
+
+    updated = db_session.query(Lease).filter(
+        Lease.name == name,
+        or_(Lease.holder == None, Lease.holder == holder, Lease.expires_on < now)
+    ).update({"holder": holder, "expires_on": now + duration}, synchronize_session=False)
+
+    db_session.commit()
+
+    return updated == 1
+
+
+def release(db_session: session, name: str, holder: str) -> None:
+    """
+    Release lease, if it is held by holder. Does nothing otherwise.
+    """
+    db_session.query(Lease).filter(Lease.name == name, Lease.holder == holder).update(
+        {"holder": None}, synchronize_session=False
+    )
+
+    db_session.commit()
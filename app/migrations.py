@@ -0,0 +1,149 @@
+"""
+Migrations of databases created by older versions, create_all(...) only adds missing tables and can't change existing
+ones. Run by Bootstrap.ensure_schema() after create_all(...).
+
+Every migration checks, whether it is needed, and changes the schema within one exclusive transaction, so a crash
+leaves the database untouched and processes starting at once don't migrate it twice.
+"""
+import logging
+from typing import List
+
+from sqlalchemy.engine import Connectable
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from freshness import FILL_LAST_REFRESHED
+from model import Product, Offer, Snapshot, PRODUCT_SEARCH
+
+logger = logging.getLogger(__name__)
+
+
+def _snapshots_needed(cursor) -> bool:
+    return "acquired_on" in {row[1] for row in cursor.execute("PRAGMA table_info(offer)").fetchall()}
+
+
+def _split_snapshots(cursor, dialect) -> None:
+    """
+    Offers used to carry time and status of their snapshot, now they reference row in snapshot table.
+    """
+    cursor.execute(str(CreateTable(Snapshot.__table__, if_not_exists=True).compile(dialect=dialect)))
+
+    for index in Snapshot.__table__.indexes:
+        cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)))
+
+    # indexes of the old table would collide with the new ones
+    for _, name, _, origin, _ in cursor.execute("PRAGMA index_list(offer)").fetchall():
+        if origin == "c":
+            cursor.execute(f'DROP INDEX "{name}"')
+
+    cursor.execute(
+        "INSERT INTO snapshot (product_id, acquired_on, status) "
+        "SELECT product_id, acquired_on, status FROM offer WHERE product_id IS NOT NULL "
+        "GROUP BY product_id, acquired_on, status ORDER BY min(id)"
+    )
+
+    cursor.execute("ALTER TABLE offer RENAME TO offer_legacy")
+    cursor.execute(str(CreateTable(Offer.__table__).compile(dialect=dialect)))
+
+    cursor.execute(
+        "INSERT INTO offer (id, price, items_in_stock, snapshot_id, product_id) "
+        "SELECT offer_legacy.id, offer_legacy.price, offer_legacy.items_in_stock, snapshot.id, "
+        "offer_legacy.product_id FROM offer_legacy JOIN snapshot ON snapshot.product_id = offer_legacy.product_id "
+        "AND snapshot.acquired_on = offer_legacy.acquired_on AND snapshot.status = offer_legacy.status"
+    )
+
+    cursor.execute("DROP TABLE offer_legacy")
+
+    for index in Offer.__table__.indexes:
+        cursor.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+
+def _search_needed(cursor) -> bool:
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'product_search'").fetchone() is None
+
+
+def _create_search(cursor, dialect) -> None:
+    """
+    Product table created by an older version has no full-text index, see search.py.
+    """
+    cursor.execute(PRODUCT_SEARCH)
+    cursor.execute(
+        "INSERT INTO product_search (rowid, name, description) "
+        "SELECT id, name, coalesce(description, '') FROM product WHERE active"
+    )
+
+
+_FRESHNESS_COLUMNS = ("last_refreshed_on", "last_changed_on")
+
+
+def _freshness_needed(cursor) -> bool:
+    return "last_refreshed_on" not in {row[1] for row in cursor.execute("PRAGMA table_info(product)").fetchall()}
+
+
+def _add_freshness(cursor, dialect) -> None:
+    """
+    Products got times of the last refresh and change, see freshness.py. The last refresh is the newest snapshot, the
+    last change is unknown (offers of every refresh are stored, changed or not) until the next one.
+    """
+    for name in _FRESHNESS_COLUMNS:
+        column = Product.__table__.c[name]
+        cursor.execute(f"ALTER TABLE product ADD COLUMN {name} {column.type.compile(dialect=dialect)}")
+
+    for index in Product.__table__.indexes:
+        if {column.name for column in index.columns} & set(_FRESHNESS_COLUMNS):
+            cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)))
+
+    cursor.execute(FILL_LAST_REFRESHED)
+
+
+# (name, check, migration) in order of application
+MIGRATIONS: List[tuple] = [
+    ("snapshots", _snapshots_needed, _split_snapshots),
+    ("product search", _search_needed, _create_search),
+    ("freshness", _freshness_needed, _add_freshness),
+]
+
+
+def migrate(bind: Connectable) -> List[str]:
+    """
+    Apply needed migrations.
+
+    :param bind: engine or connection of the database with all tables already created
+
+    :return: names of applied migrations
+    """
+    engine = bind.engine
+
+    raw_connection = engine.raw_connection()
+    try:
+        dbapi_connection = raw_connection.connection
+        cursor = dbapi_connection.cursor()
+
+        # explicit transaction - pysqlite doesn't open one for DDL statements on its own
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            if not any(needed(cursor) for _, needed, _ in MIGRATIONS):
+                return []
+
+            cursor.execute("BEGIN IMMEDIATE")
+
+            applied = []
+            try:
+                for name, needed, migration in MIGRATIONS:
+                    # another process could have done it, while we were waiting for the lock
+                    if needed(cursor):
+                        logger.warning(f"Migrating database: {name}.")
+                        migration(cursor, engine.dialect)
+                        applied.append(name)
+
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+            return applied
+        finally:
+            cursor.close()
+            dbapi_connection.isolation_level = isolation_level
+    finally:
+        raw_connection.close()
@@ -1,6 +1,6 @@
 import enum
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Boolean, Float, Index, DDL, event
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -21,22 +21,150 @@ class Product(Base):
     description = Column(String)
     active = Column(Boolean, default=True)
 
+    # time of the last successful refresh of offers and of the last one, which changed them, see freshness.py
+    last_refreshed_on = Column(DateTime, index=True)
+    last_changed_on = Column(DateTime, index=True)
+
     instance_id = Column(Integer, ForeignKey("instance.id"))
     offers = relationship("Offer", lazy="dynamic")
 
 
+# full-text index of names and descriptions of active products (rowid is product ID), see search.py
+PRODUCT_SEARCH = "CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(" \
+                 "name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+
+event.listen(Product.__table__, "after_create", DDL(PRODUCT_SEARCH).execute_if(dialect="sqlite"))
+event.listen(Product.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS product_search").execute_if(dialect="sqlite"))
+
+
 class OfferStatus(enum.Enum):
     active = 0
     historic = 1
     deleted = 2
 
 
+class Snapshot(Base):  # offers of a product acquired at once, they become historic together
+    __tablename__ = "snapshot"
+    __table_args__ = (
+        Index("ix_snapshot_product_id_acquired_on", "product_id", "acquired_on"),  # history of a product
+        Index("ix_snapshot_status_product_id", "status", "product_id"),  # active snapshots of all products
+    )
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False)
+    acquired_on = Column(DateTime, nullable=False)
+    status = Column(Enum(OfferStatus), nullable=False)
+
+    offers = relationship("Offer", back_populates="snapshot")
+
+
 class Offer(Base):
     __tablename__ = "offer"
     id = Column(Integer, primary_key=True)
     price = Column(Integer, nullable=False)
     items_in_stock = Column(Integer, nullable=False)
-    acquired_on = Column(DateTime, nullable=False)
-    status = Column(Enum(OfferStatus), nullable=False)
+
+    snapshot_id = Column(Integer, ForeignKey("snapshot.id"), nullable=False, index=True)
+    snapshot = relationship("Snapshot", back_populates="offers")
 
     product_id = Column(Integer, ForeignKey("product.id"))
+
+
+class Lease(Base):  # named lock shared by all processes using the database, see lease.py
+    __tablename__ = "lease"
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(128))
+    expires_on = Column(DateTime, nullable=False)
+
+
+class CycleStatus(enum.Enum):
+    running = 0  # in progress or interrupted, can be resumed
+    finished = 1
+    skipped = 2  # another cycle was still running
+    abandoned = 3  # interrupted and too old to be resumed
+
+
+class RefreshCycle(Base):
+    __tablename__ = "refresh_cycle"
+    id = Column(Integer, primary_key=True)
+    status = Column(Enum(CycleStatus), nullable=False, index=True)
+    holder = Column(String(128))
+    started_on = Column(DateTime, nullable=False)
+    heartbeat_on = Column(DateTime)  # time of the last recorded progress
+    finished_on = Column(DateTime)
+    delay = Column(Float)  # seconds, how much later than planned did the cycle start
+    resumes = Column(Integer, default=0, nullable=False)
+
+    # cycle refreshes only products with `id % shard_count == shard`
+    shard = Column(Integer, default=0, nullable=False)
+    shard_count = Column(Integer, default=1, nullable=False)
+
+    # products are refreshed in order of their ID, all products up to this one are done
+    last_product_id = Column(Integer, default=0, nullable=False)
+    products_done = Column(Integer, default=0, nullable=False)
+
+
+class RefreshFailure(Base):  # failed refresh of a product, see APIHandler.try_refresh_product(...)
+    __tablename__ = "refresh_failure"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False, index=True)
+    cycle_id = Column(Integer, ForeignKey("refresh_cycle.id"), index=True)  # None outside of refresh cycle
+    failed_on = Column(DateTime, nullable=False, index=True)
+    attempt = Column(Integer, nullable=False)  # 1 for the first try within the cycle, then retries
+    reason = Column(String, nullable=False)
+
+
+class RefreshSchedule(Base):  # see scheduler.py
+    __tablename__ = "refresh_schedule"
+    product_id = Column(Integer, ForeignKey("product.id"), primary_key=True)
+    last_refreshed_on = Column(DateTime, nullable=False)
+    next_due_on = Column(DateTime, nullable=False, index=True)
+
+    # decayed number of observed changes and length of observation in seconds, their ratio estimates change rate
+    changes = Column(Float, nullable=False, default=0.0)
+    observed = Column(Float, nullable=False, default=0.0)
+
+
+class ChangeKind(enum.Enum):
+    snapshot = 0  # new offers of a product were acquired
+    product = 1  # product was created, edited or deleted
+
+
+class ChangeEvent(Base):  # cross-process change feed, see feed.py
+    __tablename__ = "change_event"
+    id = Column(Integer, primary_key=True)
+    kind = Column(Enum(ChangeKind), nullable=False, index=True)  # the last product event, see feed.generations(...)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False)
+    created_on = Column(DateTime, nullable=False, index=True)
+
+    changed = Column(Boolean, nullable=False, index=True)  # snapshot differs from the previous one
+    best_price = Column(Integer)  # the lowest price of offers in stock or NULL
+    previous_best_price = Column(Integer)
+    payload = Column(String, nullable=False)  # JSON
+
+
+class AlertKind(enum.Enum):
+    price_below = 0  # the best price dropped below threshold
+    price_move = 1  # the best price moved by at least threshold percent within window
+    back_in_stock = 2  # product got offers in stock after having none
+
+
+class Alert(Base):  # see alerts.py
+    __tablename__ = "alert"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False, index=True)
+    kind = Column(Enum(AlertKind), nullable=False)
+    threshold = Column(Float)
+    window = Column(Integer)  # seconds, only for price_move
+    active = Column(Boolean, nullable=False, default=True, index=True)
+    created_on = Column(DateTime, nullable=False)
+
+
+class TriggeredAlert(Base):
+    __tablename__ = "triggered_alert"
+    id = Column(Integer, primary_key=True)
+    alert_id = Column(Integer, ForeignKey("alert.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False, index=True)
+    triggered_on = Column(DateTime, nullable=False)
+    best_price = Column(Integer)
+    message = Column(String, nullable=False)
@@ -1,7 +1,9 @@
-from typing import Optional
+from typing import Optional, List
 import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
+
+from model import AlertKind
 
 
 class Product(BaseModel):
@@ -18,3 +20,39 @@ class UpdateProduct(BaseModel):
 class TimeRange(BaseModel):
     start: Optional[datetime.datetime]
     end: Optional[datetime.datetime]
+
+
+class AnalyticsRequest(BaseModel):
+    product_ids: List[int]
+    start: Optional[datetime.datetime]
+    end: Optional[datetime.datetime]
+    percentiles: List[float] = [5, 25, 50, 75, 95]
+    moving_averages: List[int] = [5, 20]  # number of the last points
+
+    @validator("percentiles", each_item=True)
+    def percentile_in_range(cls, percentile):
+        if not 0 <= percentile <= 100:
+            raise ValueError("Percentile has to be between 0 and 100.")
+
+        return percentile
+
+    @validator("moving_averages", each_item=True)
+    def length_is_positive(cls, length):
+        if length < 1:
+            raise ValueError("Length of moving average has to be positive.")
+
+        return length
+
+
+class NewAlert(BaseModel):
+    product_id: int
+    kind: str  # price_below, price_move or back_in_stock
+    threshold: Optional[float]  # price for price_below, percent for price_move
+    window_minutes: Optional[int]  # only for price_move
+
+    @validator("kind")
+    def kind_is_known(cls, kind):
+        if kind not in AlertKind.__members__:
+            raise ValueError(f"Unknown kind, use one of {', '.join(AlertKind.__members__)}.")
+
+        return kind
@@ -0,0 +1,146 @@
+"""
+Rankings across the whole catalog - the cheapest products and the biggest price movers.
+
+Current best prices of all active products are computed by a grouped SQL aggregate over the active snapshots, best
+prices at a past moment by a lookup of the last snapshot of every active product in its history index (driven from the
+product table, so the cost grows with the catalog, not with the length of the history). Ranking is done over a single
+row per product in a bounded heap of size `limit`.
+"""
+import datetime
+import heapq
+from typing import Optional, Dict, List, Any
+
+from sqlalchemy import func, select, and_
+from sqlalchemy.orm import session
+
+from model import Product, Offer, OfferStatus, Snapshot
+
+# plain table columns - the ORM would process every row of the result, which costs more than the query itself
+offer = Offer.__table__
+snapshot = Snapshot.__table__
+product = Product.__table__
+
+DIRECTIONS = ("drop", "rise", "any")
+
+
+def current_best_prices(db_session: session) -> Dict[int, int]:
+    """
+    :return: active product ID -> the lowest price of its active offers in stock, products without anything in
+             stock are left out
+    """
+    rows = db_session.execute(
+        select([snapshot.c.product_id, func.min(offer.c.price)]).select_from(
+            snapshot.join(offer, offer.c.snapshot_id == snapshot.c.id).join(
+                product, product.c.id == snapshot.c.product_id
+            )
+        ).where(and_(
+            snapshot.c.status == OfferStatus.active,
+            offer.c.items_in_stock > 0,
+            product.c.active == True
+        )).group_by(snapshot.c.product_id)
+    )
+
+    return dict(rows.fetchall())
+
+
+def best_prices_at(db_session: session, moment: datetime.datetime) -> Dict[int, int]:
+    """
+    :return: active product ID -> the lowest price in stock of its last snapshot acquired at or before moment,
+             products without such snapshot or without anything in stock are left out
+    """
+    # one backward step in (product_id, acquired_on) index per product instead of grouping the whole history
+    last_snapshot = select([snapshot.c.id]).where(and_(
+        snapshot.c.product_id == product.c.id,
+        snapshot.c.acquired_on <= moment
+    )).order_by(snapshot.c.acquired_on.desc()).limit(1).scalar_subquery()
+
+    last = select([product.c.id.label("product_id"), last_snapshot.label("snapshot_id")]).where(
+        product.c.active == True
+    ).subquery()
+
+    rows = db_session.execute(
+        select([last.c.product_id, func.min(offer.c.price)]).select_from(
+            last.join(offer, offer.c.snapshot_id == last.c.snapshot_id)
+        ).where(offer.c.items_in_stock > 0).group_by(last.c.product_id)
+    )
+
+    return dict(rows.fetchall())
+
+
+def _names(db_session: session, product_ids: List[int]) -> Dict[int, str]:
+    rows = db_session.execute(select([product.c.id, product.c.name]).where(product.c.id.in_(product_ids)))
+
+    return dict(rows.fetchall())
+
+
+def cheapest(db_session: session, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    :return: at most `limit` active products with the lowest current best price, the cheapest first
+    """
+    best = heapq.nsmallest(limit, ((price, product_id) for product_id, price in
+                                   current_best_prices(db_session).items()))
+
+    names = _names(db_session, [product_id for _, product_id in best])
+
+    return [
+        {
+            "product_id": product_id,
+            "name": names[product_id],
+            "price": price
+        }
+        for price, product_id in best
+    ]
+
+
+def top_movers(db_session: session, window: datetime.timedelta, limit: int = 50, direction: str = "drop",
+               now: Optional[datetime.datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Rank active products by the relative change of their best price within the window.
+
+    :param window: how far to look back
+    :param limit: maximal number of products
+    :param direction: drop (the biggest drops first), rise (the biggest rises first) or any (the biggest absolute
+                      changes first)
+    :param now: current time or None
+
+    :raises ValueError: on unknown direction
+
+    :return: ranked products with their price at the start of the window, now and the change in percent
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Unknown direction, use one of {', '.join(DIRECTIONS)}.")
+
+    if now is None:
+        now = datetime.datetime.now()
+
+    current = current_best_prices(db_session)
+    before = best_prices_at(db_session, now - window)
+
+    sign = {"drop": -1.0, "rise": 1.0}.get(direction)
+
+    def moves():
+        for product_id, price in current.items():
+            old_price = before.get(product_id)
+            if not old_price or old_price == price:
+                continue
+
+            change = (price - old_price) / (old_price / 100.0)
+            score = abs(change) if sign is None else sign * change
+
+            if score > 0:
+                yield score, product_id, old_price, price, change
+
+    ranked = heapq.nlargest(limit, moves())
+
+    names = _names(db_session, [product_id for _, product_id, _, _, _ in ranked])
+
+    return [
+        {
+            "product_id": product_id,
+            "name": names[product_id],
+            "old_price": old_price,
+            "price": price,
+            "change": change
+        }
+        for _, product_id, old_price, price, change in ranked
+    ]
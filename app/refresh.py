@@ -0,0 +1,323 @@
+import datetime
+import logging
+import random
+import time
+from typing import List, Optional, Iterator, Callable
+
+from sqlalchemy.orm import session
+
+import lease
+from apihandler import APIHandler
+from model import Product, RefreshCycle, CycleStatus, RefreshFailure
+from scheduler import RefreshScheduler
+
+logger = logging.getLogger(__name__)
+
+CYCLE_LEASE = "refresh-cycle"
+
+
+def cycle_lease(shard: int, shard_count: int) -> str:
+    """
+    :return: name of the lease guarding cycles of given shard
+    """
+    if shard_count == 1:
+        return CYCLE_LEASE
+
+    return f"{CYCLE_LEASE}-{shard}-of-{shard_count}"
+
+
+class RefreshRunner:
+    """
+    Runs refresh cycle of offers of active products (see APIHandler.refresh_products(...)).
+
+    Only one cycle runs at a time - runner has to hold a lease, which is renewed after every product. When the lease
+    is held by somebody else, the run is recorded as skipped. Progress is committed after every product, so a cycle
+    cut short (crash, error, killed container) is resumed by the next run instead of being started over.
+
+    Products can be split into `shard_count` shards by their ID (`Product.id % shard_count`). Every shard has its own
+    lease and cycles, so several updater processes can refresh different shards at the same time, see run_sharded(...).
+    Membership is evaluated at the start of every cycle, so new products are picked up by their shard immediately.
+
+    With a scheduler, cycle refreshes only products picked by it instead of all of them.
+
+    Products are processed in chunks of `chunk_size` IDs read by keyset pagination and the session is cleared after
+    every chunk, so memory of the updater doesn't grow with the size of the catalog.
+
+    Failure of a product (API error, invalid response) doesn't stop the cycle - it is recorded as RefreshFailure, the
+    product keeps its previous offers and is retried `retries` times with exponential backoff after all the others,
+    see APIHandler.refresh_products(...). Products failed even then are left to the next cycle.
+    """
+    _handler: APIHandler
+    _session: session  # has to be the session of the handler
+    _period: datetime.timedelta  # planned time between starts of two cycles
+    _lease_duration: datetime.timedelta  # how long can the holder stay silent before losing the lease
+    _resume_window: datetime.timedelta  # interrupted cycle silent for longer than this is abandoned, not resumed
+    _shard: int
+    _shard_count: int
+    _scheduler: Optional[RefreshScheduler]
+    _chunk_size: int
+    _retries: int
+    _retry_backoff: float  # seconds before the first round of retries
+    _sleep: Callable[[float], None]
+    _holder: str
+
+    def __init__(self, handler: APIHandler, db_session: session, period: float = 60.0, lease_duration: float = 120.0,
+                 resume_window: float = 600.0, shard: int = 0, shard_count: int = 1,
+                 scheduler: Optional[RefreshScheduler] = None, chunk_size: int = 1000, retries: int = 2,
+                 retry_backoff: float = 1.0, sleep: Callable[[float], None] = time.sleep) -> None:
+        if not 0 <= shard < shard_count:
+            raise ValueError(f"Shard {shard} is out of range of {shard_count} shards.")
+
+        self._handler = handler
+        self._session = db_session
+        self._period = datetime.timedelta(seconds=period)
+        self._lease_duration = datetime.timedelta(seconds=lease_duration)
+        self._resume_window = datetime.timedelta(seconds=resume_window)
+        self._shard = shard
+        self._shard_count = shard_count
+        self._scheduler = scheduler
+        self._chunk_size = chunk_size
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._sleep = sleep
+        self._holder = lease.new_holder()
+
+    @property
+    def _lease(self) -> str:
+        return cycle_lease(self._shard, self._shard_count)
+
+    def run(self) -> RefreshCycle:
+        """
+        Run (or resume) the cycle.
+
+        :raises RuntimeError: if the lease is lost (or on unexpected error), cycle is left to be resumed.
+
+        :return: finished or skipped cycle
+        """
+        cycle = self.try_run(skip_if_done=False)
+
+        if cycle is None:
+            cycle = record_skipped(self._session, self._holder, self._shard, self._shard_count)
+
+        return cycle
+
+    def try_run(self, skip_if_done: bool = True) -> Optional[RefreshCycle]:
+        """
+        Run (or resume) the cycle, if nobody else is running it.
+
+        :param skip_if_done: don't start new cycle, if the previous one started less than half of `period` ago
+                             (i.e. another process has already done it in this period)
+
+        :raises RuntimeError: if the lease is lost (or on unexpected error), cycle is left to be resumed.
+
+        :return: finished cycle or None, if the lease is held by somebody else or there was nothing to do
+        """
+        now = datetime.datetime.now()
+
+        if not lease.acquire(self._session, self._lease, self._holder, self._lease_duration):
+            return None
+
+        try:
+            cycle = self._resume_or_start(now, skip_if_done)
+            if cycle is None:
+                return None
+
+            self._process(cycle)
+
+            cycle.status = CycleStatus.finished
+            cycle.finished_on = datetime.datetime.now()
+            self._session.commit()
+
+            logger.info(f"Refresh cycle {cycle.id} of shard {self._shard}/{self._shard_count} finished, "
+                        f"{cycle.products_done} products refreshed "
+                        f"in {(cycle.finished_on - cycle.started_on).total_seconds():.1f} s.")
+
+            return cycle
+        except Exception:
+            self._session.rollback()
+            logger.exception("Refresh cycle was cut short, the next run will resume it.")
+            raise
+        finally:
+            lease.release(self._session, self._lease, self._holder)
+
+    def _cycles(self):
+        return self._session.query(RefreshCycle).filter(
+            RefreshCycle.shard == self._shard,
+            RefreshCycle.shard_count == self._shard_count
+        )
+
+    def _resume_or_start(self, now: datetime.datetime, skip_if_done: bool) -> Optional[RefreshCycle]:
+        interrupted: List[RefreshCycle] = self._cycles().filter(
+            RefreshCycle.status == CycleStatus.running
+        ).order_by(RefreshCycle.id.desc()).all()
+
+        for cycle in interrupted[1:]:
+            cycle.status = CycleStatus.abandoned
+
+        if interrupted:
+            cycle = interrupted[0]
+            last_sign_of_life = cycle.heartbeat_on or cycle.started_on
+
+            if now - last_sign_of_life <= self._resume_window:
+                cycle.holder = self._holder
+                cycle.resumes += 1
+                self._session.commit()
+
+                logger.warning(f"Resuming interrupted refresh cycle {cycle.id} after product {cycle.last_product_id}.")
+
+                return cycle
+
+            cycle.status = CycleStatus.abandoned
+            logger.warning(f"Refresh cycle {cycle.id} was interrupted too long ago, starting over.")
+
+        previous = self._cycles().filter(
+            RefreshCycle.status.in_([CycleStatus.finished, CycleStatus.abandoned])
+        ).order_by(RefreshCycle.started_on.desc()).first()
+
+        delay = 0.0
+        if previous is not None:
+            if skip_if_done and previous.status == CycleStatus.finished and now - previous.started_on < self._period / 2:
+                self._session.commit()
+                return None
+
+            delay = max((now - previous.started_on - self._period).total_seconds(), 0.0)
+
+            if delay > self._period.total_seconds() / 2:
+                logger.warning(f"Refresh cycle of shard {self._shard}/{self._shard_count} is delayed by {delay:.1f} s.")
+
+        cycle = RefreshCycle(status=CycleStatus.running, holder=self._holder, started_on=now, heartbeat_on=now,
+                             delay=delay, resumes=0, shard=self._shard, shard_count=self._shard_count,
+                             last_product_id=0, products_done=0)
+        self._session.add(cycle)
+        self._session.commit()
+
+        return cycle
+
+    def _chunks(self, cycle: RefreshCycle) -> Iterator[List[int]]:
+        """
+        :return: chunks of IDs of products to be refreshed, sorted by ID
+        """
+        query = self._session.query(Product.id).filter(Product.active == True)
+
+        if self._shard_count > 1:
+            query = query.filter(Product.id % self._shard_count == self._shard)
+
+        if self._scheduler is not None:
+            # at most `budget` products
+            product_ids = self._scheduler.select(query.filter(Product.id > cycle.last_product_id))
+
+            for start in range(0, len(product_ids), self._chunk_size):
+                yield product_ids[start:start + self._chunk_size]
+
+            return
+
+        while True:
+            # cycle.last_product_id is the last processed product
+            product_ids = [product_id for (product_id,) in query.filter(
+                Product.id > cycle.last_product_id
+            ).order_by(Product.id).limit(self._chunk_size)]
+
+            if not product_ids:
+                return
+
+            yield product_ids
+
+    def _product_ids(self, cycle: RefreshCycle) -> Iterator[int]:
+        for product_ids in self._chunks(cycle):
+            yield from product_ids
+
+            # everything is committed, release objects of the chunk - only the cycle stays
+            self._session.expunge_all()
+            self._session.add(cycle)
+
+    def _process(self, cycle: RefreshCycle) -> None:
+        def done(product_id: int, changed: Optional[bool], attempt: int) -> None:
+            if attempt == 1:
+                cycle.last_product_id = product_id
+
+            if changed is not None:
+                cycle.products_done += 1
+
+                if self._scheduler is not None:
+                    self._scheduler.record(product_id, changed)
+
+            cycle.heartbeat_on = datetime.datetime.now()
+
+            # renewal commits the progress as well
+            if not lease.acquire(self._session, self._lease, self._holder, self._lease_duration):
+                raise RuntimeError("Refresh cycle lease was lost.")
+
+        failed = self._handler.refresh_products(self._product_ids(cycle), self._retries, self._retry_backoff,
+                                                cycle_id=cycle.id, on_done=done, sleep=self._sleep)
+
+        if failed:
+            logger.warning(f"Refresh of {len(failed)} products failed in cycle {cycle.id}, they keep their previous "
+                           f"offers until the next cycle.")
+
+
+def record_skipped(db_session: session, holder: str, shard: int = 0, shard_count: int = 1,
+                   reason: str = "the previous one is still running") -> RefreshCycle:
+    now = datetime.datetime.now()
+
+    cycle = RefreshCycle(status=CycleStatus.skipped, holder=holder, started_on=now, finished_on=now, resumes=0,
+                         shard=shard, shard_count=shard_count, last_product_id=0, products_done=0)
+    db_session.add(cycle)
+    db_session.commit()
+
+    logger.warning(f"Refresh cycle of shard {shard}/{shard_count} skipped, {reason}.")
+
+    return cycle
+
+
+def prune_failures(db_session: session, older_than: datetime.timedelta) -> int:
+    """
+    Delete old records of failed refreshes.
+
+    :return: number of deleted records
+    """
+    deleted = db_session.query(RefreshFailure).filter(
+        RefreshFailure.failed_on < datetime.datetime.now() - older_than
+    ).delete(synchronize_session=False)
+
+    db_session.commit()
+
+    return deleted
+
+
+def run_sharded(handler: APIHandler, db_session: session, shard_count: int, **kwargs) -> List[RefreshCycle]:
+    """
+    Refresh every shard, which isn't being refreshed by another process and wasn't refreshed in this period yet.
+    Every updater process runs this, processes coordinate through shard leases - a single process refreshes all shards,
+    N processes split them among themselves and shards of a crashed process are picked up (and resumed) by others.
+
+    Failure of one shard doesn't stop the others, it is logged and the shard is resumed by the next run.
+
+    :param handler: authenticated handler
+    :param db_session: session of the handler
+    :param shard_count: number of shards, has to be the same for all processes
+    :param kwargs: passed to RefreshRunner
+
+    :return: finished cycles, or the skipped one, if there was no shard to work on
+    """
+    cycles = []
+
+    # start with random shard, so that processes launched at once don't fight for the same shards
+    offset = random.randrange(shard_count)
+
+    for index in range(shard_count):
+        shard = (offset + index) % shard_count
+        runner = RefreshRunner(handler, db_session, shard=shard, shard_count=shard_count, **kwargs)
+
+        try:
+            cycle = runner.try_run()
+        except Exception:
+            continue  # already logged
+
+        if cycle is not None:
+            cycles.append(cycle)
+
+    if not cycles:
+        cycles.append(record_skipped(db_session, lease.new_holder(), shard_count=shard_count,
+                                     reason="all shards are running or were refreshed in this period"))
+
+    return cycles
@@ -0,0 +1,125 @@
+import datetime
+import heapq
+import math
+from typing import List, Optional, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.orm import session, Query
+
+from model import Product, RefreshSchedule
+
+
+class RefreshScheduler:
+    """
+    Decides, which products are worth refreshing, so that the upstream calls budget is spent on products, whose offers
+    most likely changed.
+
+    Offers of every product are modeled as changing randomly with an estimated rate (changes per second). After every
+    refresh, the estimate is updated and the product is planned for the moment, when its offers changed with
+    `target_probability` - volatile products come back soon, stable ones later, but never later than
+    `max_staleness` seconds. Every cycle takes due products (index on next_due_on), the ones violating max staleness
+    (or never refreshed) go first, the rest is ordered by probability of change in a bounded heap.
+    """
+    _session: session
+    _budget: int  # upstream calls per cycle
+    _max_staleness: float  # seconds
+    _min_interval: float  # seconds
+    _target_probability: float
+    _decay: float  # weight of the old observations after each new one
+
+    # prior belief - one change per ten minutes, worth one observation
+    PRIOR_CHANGES: float = 1.0
+    PRIOR_OBSERVED: float = 600.0
+
+    def __init__(self, db_session: session, budget: int, max_staleness: float = 600.0, min_interval: float = 60.0,
+                 target_probability: float = 0.5, decay: float = 0.9) -> None:
+        self._session = db_session
+        self._budget = budget
+        self._max_staleness = max_staleness
+        self._min_interval = min_interval
+        self._target_probability = target_probability
+        self._decay = decay
+
+    def _rate(self, changes: float, observed: float) -> float:
+        return (changes + self.PRIOR_CHANGES) / (observed + self.PRIOR_OBSERVED)
+
+    def _keep(self, heap: List[Tuple[float, int]], item: Tuple[float, int]) -> None:
+        if len(heap) < self._budget:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def select(self, products: Query, now: Optional[datetime.datetime] = None) -> List[int]:
+        """
+        Pick products to be refreshed in this cycle.
+
+        :param products: query of Product.id, which are candidates (e.g. active products of a shard)
+        :param now: current time or None
+
+        :return: at most `budget` product IDs sorted by ID
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        due = products.outerjoin(RefreshSchedule, RefreshSchedule.product_id == Product.id).add_columns(
+            RefreshSchedule.last_refreshed_on,
+            RefreshSchedule.changes,
+            RefreshSchedule.observed
+        ).filter(
+            or_(RefreshSchedule.next_due_on == None, RefreshSchedule.next_due_on <= now)
+        )
+
+        # only the best `budget` of both kinds are kept (min-heaps), memory doesn't grow with the number of products
+        overdue = []  # (staleness, product ID), never refreshed products have infinite staleness
+        candidates = []  # (probability of change, product ID)
+
+        for product_id, last_refreshed_on, changes, observed in due.yield_per(1000):
+            if last_refreshed_on is None:
+                self._keep(overdue, (math.inf, product_id))
+                continue
+
+            staleness = (now - last_refreshed_on).total_seconds()
+
+            if staleness >= self._max_staleness:
+                self._keep(overdue, (staleness, product_id))
+            else:
+                probability = 1.0 - math.exp(-self._rate(changes, observed) * staleness)
+                self._keep(candidates, (probability, product_id))
+
+        selected = overdue
+
+        if len(selected) < self._budget:
+            selected.extend(heapq.nlargest(self._budget - len(selected), candidates))
+
+        return sorted(product_id for _, product_id in selected)
+
+    def record(self, product_id: int, changed: bool, now: Optional[datetime.datetime] = None) -> RefreshSchedule:
+        """
+        Update change rate estimate of refreshed product and plan its next refresh. Caller commits.
+
+        :param product_id: of refreshed product
+        :param changed: whether its offers changed since the previous refresh
+        :param now: time of the refresh or None
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        schedule = self._session.query(RefreshSchedule).get(product_id)
+
+        if schedule is None:
+            schedule = RefreshSchedule(product_id=product_id, changes=0.0, observed=0.0)
+            self._session.add(schedule)
+        else:
+            elapsed = (now - schedule.last_refreshed_on).total_seconds()
+
+            schedule.changes = schedule.changes * self._decay + (1.0 if changed else 0.0)
+            schedule.observed = schedule.observed * self._decay + elapsed
+
+        # time, when the offers changed with target probability
+        interval = -math.log(1.0 - self._target_probability) / self._rate(schedule.changes, schedule.observed)
+        interval = min(max(interval, self._min_interval), self._max_staleness)
+
+        schedule.last_refreshed_on = now
+        schedule.next_due_on = now + datetime.timedelta(seconds=interval)
+
+        return schedule
@@ -0,0 +1,129 @@
+"""
+Full-text search of active products by name and description.
+
+Products are indexed in SQLite FTS5 table `product_search` (see model.PRODUCT_SEARCH), which is kept in sync by
+APIHandler - created and edited products are (re)indexed, deleted ones removed, in the same transaction as the change.
+Existing databases get the index filled on startup, see migrations.py.
+
+Every word of the query has to match (diacritics and case are ignored), the last word matches as a prefix (so results
+can be shown while typing) and so does every word ending with `*`. Results are ranked by BM25 with matches in the name
+weighted more than in the description.
+"""
+import re
+from typing import Optional, Dict, Any
+
+from sqlalchemy import text
+from sqlalchemy.orm import session
+
+from model import Offer, Snapshot, OfferStatus
+
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+_WORD = re.compile(r"(\w+)(\*?)")
+
+_SEARCH = text(
+    "SELECT product.id, product.name, product.description FROM product_search "
+    "JOIN product ON product.id = product_search.rowid "
+    "WHERE product_search MATCH :expression AND product.active = 1 "
+    "ORDER BY bm25(product_search, :name_weight, :description_weight), product.id LIMIT :limit OFFSET :offset"
+)
+
+_COUNT = text(
+    "SELECT count(*) FROM product_search JOIN product ON product.id = product_search.rowid "
+    "WHERE product_search MATCH :expression AND product.active = 1"
+)
+
+
+def match_expression(query: str) -> str:
+    """
+    Translate user query to FTS5 expression - words are quoted, so that no FTS5 syntax can be injected.
+
+    :raises ValueError: if the query contains no word
+    """
+    words = _WORD.findall(query)
+
+    if not words:
+        raise ValueError("Query has to contain at least one word.")
+
+    terms = []
+    for index, (word, star) in enumerate(words):
+        prefix = star or index == len(words) - 1
+        terms.append(f'"{word}"' + ("*" if prefix else ""))
+
+    return " ".join(terms)
+
+
+def index_product(db_session: session, product_id: int, name: str, description: Optional[str]) -> None:
+    """
+    Add product to the index or replace its indexed values. Caller commits it together with the change.
+    """
+    unindex_product(db_session, product_id)
+
+    db_session.execute(
+        text("INSERT INTO product_search (rowid, name, description) VALUES (:id, :name, :description)"),
+        {"id": product_id, "name": name, "description": description or ""}
+    )
+
+
+def unindex_product(db_session: session, product_id: int) -> None:
+    """
+    Remove product from the index. Caller commits it together with the change.
+    """
+    db_session.execute(text("DELETE FROM product_search WHERE rowid = :id"), {"id": product_id})
+
+
+def search(db_session: session, query: str, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+    """
+    :param query: words to be searched for
+    :param limit: page size
+    :param offset: number of skipped results
+
+    :raises ValueError: if the query contains no word
+
+    :return: total number of matching products and the page of them, the best match first, with offers in stock
+    """
+    parameters = {
+        "expression": match_expression(query),
+        "name_weight": NAME_WEIGHT,
+        "description_weight": DESCRIPTION_WEIGHT,
+        "limit": limit,
+        "offset": offset,
+    }
+
+    rows = db_session.execute(_SEARCH, parameters).fetchall()
+
+    if offset == 0 and len(rows) < limit:
+        total = len(rows)
+    else:
+        total = db_session.execute(_COUNT, parameters).scalar()
+
+    items = [{
+        "id": product_id,
+        "name": name,
+        "description": description,
+        "best_price": None,
+        "offers": [],
+    } for product_id, name, description in rows]
+
+    if items:
+        by_id = {item["id"]: item for item in items}
+
+        # current offers of all products of the page at once
+        offers = db_session.query(Offer.product_id, Offer.price, Offer.items_in_stock).join(Snapshot).filter(
+            Snapshot.product_id.in_(list(by_id)),
+            Snapshot.status == OfferStatus.active,
+            Offer.items_in_stock > 0
+        ).order_by(Offer.id)
+
+        for product_id, price, items_in_stock in offers:
+            item = by_id[product_id]
+            item["offers"].append({"price": price, "items_in_stock": items_in_stock})
+
+            if item["best_price"] is None or price < item["best_price"]:
+                item["best_price"] = price
+
+    return {
+        "total": total,
+        "items": items,
+    }
@@ -0,0 +1,618 @@
+"""
+Storage of instances, products, their offers and price history used by APIHandler.
+
+SQLStorage keeps everything in the database through SQLAlchemy session - it is the storage of the service, as the
+change feed, search index, alerts and everything else read by the API live in the same database. MemoryStorage keeps
+the same data in process memory for ephemeral and cache deployments and for fast tests and benchmarks. Both behave
+the same (see tests/test_storage.py), only MemoryStorage has no change feed nor search index and its changes take
+effect immediately - .commit() and .rollback() do nothing.
+
+Products are returned as objects with `id`, `name`, `description` and `active` attributes, offers as
+(price, items in stock) pairs. Reads of unknown product return None or nothing, changes of it raise
+ProductDoesntExist.
+"""
+import abc
+import array
+import bisect
+import collections
+import datetime
+import threading
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Union
+
+from sqlalchemy import func, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import session
+
+import feed
+import search
+from model import Instance, Product, Offer, OfferStatus, Snapshot, RefreshFailure
+from trends import to_micros, from_micros
+
+
+class ProductAlreadyExists(RuntimeError):
+    pass
+
+
+class ProductDoesntExist(RuntimeError):
+    product_id: int
+
+    def __init__(self, product_id: int):
+        super().__init__(f"Product with id {product_id} doesn't exist!")
+
+
+class Storage(abc.ABC):
+    session: Optional[session] = None  # database session of features built on the database (alerts, trends)
+
+    @abc.abstractmethod
+    def commit(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def rollback(self) -> None:
+        pass
+
+    def release(self) -> None:
+        """
+        Forget objects loaded so far, so that memory doesn't grow during long runs. Call it only after commit.
+        """
+
+    @abc.abstractmethod
+    def generations(self) -> Tuple[int, int, int]:
+        """
+        Versions of the data, see feed.generations(...).
+
+        :return: version changed by every snapshot or product change, version changed by changed offers or product
+                 change and version changed by product change only
+        """
+
+    @abc.abstractmethod
+    def add_instance(self, access_token: str, date: datetime.datetime) -> int:
+        """
+        :return: ID of the new instance, it is committed
+        """
+
+    @abc.abstractmethod
+    def find_instance(self, access_token: str) -> Optional[int]:
+        """
+        :return: ID of instance with given access token or None
+        """
+
+    @abc.abstractmethod
+    def get_product(self, product_id: int) -> Optional[Any]:
+        pass
+
+    @abc.abstractmethod
+    def find_product(self, name: str) -> Optional[Any]:
+        pass
+
+    @abc.abstractmethod
+    def add_product(self, name: str, description: Optional[str], instance_id: Optional[int]) -> int:
+        """
+        :raises ProductAlreadyExists: if product of the same name exists
+
+        :return: ID of the new active product, it is committed
+        """
+
+    @abc.abstractmethod
+    def update_product(self, product_id: int, name: Optional[str] = None, description: Optional[str] = None) -> Any:
+        """
+        Change name and/or description of existing product (None keeps the value).
+
+        :raises ProductDoesntExist: if there is no such product
+        :raises ProductAlreadyExists: if another product has the new name
+
+        :return: the changed product
+        """
+
+    @abc.abstractmethod
+    def activate_product(self, product_id: int) -> None:
+        """
+        :raises ProductDoesntExist: if there is no such product
+        """
+
+    @abc.abstractmethod
+    def deactivate_product(self, product_id: int) -> None:
+        """
+        Mark existing product inactive, its active offers become historic.
+
+        :raises ProductDoesntExist: if there is no such product
+        """
+
+    @abc.abstractmethod
+    def remove_product(self, product_id: int) -> None:
+        """
+        Delete product without any offers (e.g. one, which failed to register), unknown product is ignored.
+        """
+
+    @abc.abstractmethod
+    def active_product_ids(self, after_id: int, limit: int) -> List[int]:
+        """
+        :return: up to `limit` IDs of active products greater than `after_id` in ascending order
+        """
+
+    @abc.abstractmethod
+    def list_products(self) -> Iterator[Dict[str, Any]]:
+        """
+        :return: active products (by ID) with their active offers in stock, see APIHandler.list_products()
+        """
+
+    @abc.abstractmethod
+    def active_offers(self, product_id: int) -> List[Tuple[int, int]]:
+        """
+        :return: sorted active offers of the product
+        """
+
+    @abc.abstractmethod
+    def add_snapshot(self, product_id: int, acquired_on: datetime.datetime, offers: List[Tuple[int, int]],
+                     previous_offers: List[Tuple[int, int]]) -> None:
+        """
+        Given offers become active, the previous ones historic. Product's last_refreshed_on (and last_changed_on,
+        if the offers differ from `previous_offers`) is set to `acquired_on`.
+
+        :raises ProductDoesntExist: if there is no such product
+        """
+
+    @abc.abstractmethod
+    def price_history(self, product_id: int, start: datetime.datetime,
+                      end: datetime.datetime) -> List[Dict[str, Any]]:
+        """
+        :return: the lowest price in stock of every snapshot acquired within the range (inclusive), the oldest first
+        """
+
+    @abc.abstractmethod
+    def record_failure(self, product_id: int, cycle_id: Optional[int], failed_on: datetime.datetime, attempt: int,
+                       reason: str) -> None:
+        pass
+
+    # the change feed and search index - storage without them ignores the changes
+
+    def index_product(self, product_id: int, name: str, description: Optional[str]) -> None:
+        pass
+
+    def unindex_product(self, product_id: int) -> None:
+        pass
+
+    def publish_product(self, product_id: int, action: str, **data: Any) -> None:
+        pass
+
+
+def storage_of(storage: Union[Storage, session]) -> Storage:
+    """
+    :return: given storage or SQLStorage of given database session
+    """
+    return storage if isinstance(storage, Storage) else SQLStorage(storage)
+
+
+class SQLStorage(Storage):
+    """
+    Storage in the database, the caller owns the session.
+    """
+
+    def __init__(self, db_session: session) -> None:
+        self.session = db_session
+
+    def commit(self) -> None:
+        self.session.commit()
+
+    def rollback(self) -> None:
+        self.session.rollback()
+
+    def release(self) -> None:
+        self.session.expunge_all()
+
+    def generations(self) -> Tuple[int, int, int]:
+        return feed.generations(self.session)
+
+    def add_instance(self, access_token: str, date: datetime.datetime) -> int:
+        instance = Instance(access_token=access_token, date=date)
+
+        self.session.add(instance)
+        self.session.flush()
+        self.session.commit()
+
+        self.session.refresh(instance)
+
+        return instance.id
+
+    def find_instance(self, access_token: str) -> Optional[int]:
+        instance = self.session.query(Instance).filter(Instance.access_token == access_token).first()
+
+        return None if instance is None else instance.id
+
+    def get_product(self, product_id: int) -> Optional[Product]:
+        return self.session.query(Product).get(product_id)
+
+    def find_product(self, name: str) -> Optional[Product]:
+        return self.session.query(Product).filter(Product.name == name).first()
+
+    def _flush(self) -> None:
+        try:
+            self.session.flush()
+        except IntegrityError:  # the only unique column is the name
+            self.session.rollback()
+            raise ProductAlreadyExists()
+
+    def _product(self, product_id: int) -> Product:
+        product = self.session.query(Product).get(product_id)
+
+        if product is None:
+            raise ProductDoesntExist(product_id)
+
+        return product
+
+    def add_product(self, name: str, description: Optional[str], instance_id: Optional[int]) -> int:
+        product = Product(name=name, description=description, instance_id=instance_id)
+
+        self.session.add(product)
+        self._flush()
+        self.session.commit()
+
+        self.session.refresh(product)
+
+        return product.id
+
+    def update_product(self, product_id: int, name: Optional[str] = None, description: Optional[str] = None) -> Product:
+        product = self._product(product_id)
+
+        if name is not None:
+            product.name = name
+
+        if description is not None:
+            product.description = description
+
+        self._flush()
+
+        return product
+
+    def activate_product(self, product_id: int) -> None:
+        self._product(product_id).active = True
+
+    def deactivate_product(self, product_id: int) -> None:
+        self._product(product_id).active = False
+
+        self.session.query(Snapshot).filter(Snapshot.product_id == product_id,
+                                            Snapshot.status == OfferStatus.active).update({
+            "status": OfferStatus.historic
+        })
+
+    def remove_product(self, product_id: int) -> None:
+        self.session.query(Product).filter(Product.id == product_id).delete()
+
+    def active_product_ids(self, after_id: int, limit: int) -> List[int]:
+        return [product_id for (product_id,) in self.session.query(Product.id).filter(
+            Product.active == True,
+            Product.id > after_id
+        ).order_by(Product.id).limit(limit)]
+
+    def list_products(self) -> Iterator[Dict[str, Any]]:
+        # one query for all products - active snapshot and its offers in stock are outer-joined to every product
+        rows = self.session.query(
+            Product.id, Product.name, Product.description, Offer.price, Offer.items_in_stock
+        ).outerjoin(
+            Snapshot, and_(Snapshot.product_id == Product.id, Snapshot.status == OfferStatus.active)
+        ).outerjoin(
+            Offer, and_(Offer.snapshot_id == Snapshot.id, Offer.items_in_stock > 0)
+        ).filter(
+            Product.active == True
+        ).order_by(Product.id, Offer.id)
+
+        data = None
+
+        for product_id, name, description, price, items_in_stock in rows:
+            if data is None or data["id"] != product_id:
+                if data is not None:
+                    yield data
+
+                data = {
+                    "id": product_id,
+                    "name": name,
+                    "description": description,
+                    "offers": []
+                }
+
+            if price is not None:
+                data["offers"].append({
+                    "price": price,
+                    "items_in_stock": items_in_stock,
+                })
+
+        if data is not None:
+            yield data
+
+    def active_offers(self, product_id: int) -> List[Tuple[int, int]]:
+        return sorted(
+            self.session.query(Offer.price, Offer.items_in_stock).join(Snapshot).filter(
+                Snapshot.product_id == product_id,
+                Snapshot.status == OfferStatus.active
+            )
+        )
+
+    def add_snapshot(self, product_id: int, acquired_on: datetime.datetime, offers: List[Tuple[int, int]],
+                     previous_offers: List[Tuple[int, int]]) -> None:
+        freshness = {"last_refreshed_on": acquired_on}
+        if sorted(offers) != sorted(previous_offers):
+            freshness["last_changed_on"] = acquired_on
+
+        if not self.session.query(Product).filter(Product.id == product_id).update(freshness):
+            raise ProductDoesntExist(product_id)
+
+        self.session.query(Snapshot).filter(Snapshot.product_id == product_id,
+                                            Snapshot.status == OfferStatus.active).update({
+            "status": OfferStatus.historic
+        })
+
+        snapshot = Snapshot(product_id=product_id, acquired_on=acquired_on, status=OfferStatus.active)
+        self.session.add(snapshot)
+
+        for price, items_in_stock in offers:
+            offer = Offer(
+                price=price,
+                items_in_stock=items_in_stock,
+                snapshot=snapshot,
+                product_id=product_id
+            )
+
+            self.session.add(offer)
+
+        feed.publish_snapshot(self.session, product_id, acquired_on, offers, previous_offers)
+
+    def price_history(self, product_id: int, start: datetime.datetime,
+                      end: datetime.datetime) -> List[Dict[str, Any]]:
+        snapshots = self.session.query(Snapshot.acquired_on, func.min(Offer.price)).join(Offer).filter(
+            Snapshot.product_id == product_id,
+            Snapshot.acquired_on >= start,
+            Snapshot.acquired_on <= end,
+            Offer.items_in_stock > 0
+        ).group_by(Snapshot.id).order_by(Snapshot.acquired_on)
+
+        return [{"price": price, "acquired_on": acquired_on} for acquired_on, price in snapshots]
+
+    def record_failure(self, product_id: int, cycle_id: Optional[int], failed_on: datetime.datetime, attempt: int,
+                       reason: str) -> None:
+        self.session.add(RefreshFailure(product_id=product_id, cycle_id=cycle_id, failed_on=failed_on,
+                                        attempt=attempt, reason=reason))
+
+    def index_product(self, product_id: int, name: str, description: Optional[str]) -> None:
+        search.index_product(self.session, product_id, name, description)
+
+    def unindex_product(self, product_id: int) -> None:
+        search.unindex_product(self.session, product_id)
+
+    def publish_product(self, product_id: int, action: str, **data: Any) -> None:
+        feed.publish_product(self.session, product_id, action, **data)
+
+
+class StoredProduct:
+    """
+    Product kept by MemoryStorage with its active offers and price history - times (in microseconds, see trends.py)
+    and the lowest prices in stock of its snapshots in typed arrays, in order of acquisition.
+    """
+    __slots__ = ("id", "name", "description", "active", "instance_id", "last_refreshed_on", "last_changed_on",
+                 "offers", "times", "prices")
+
+    id: int
+    name: str
+    description: Optional[str]
+    active: bool
+    instance_id: Optional[int]
+    last_refreshed_on: Optional[datetime.datetime]
+    last_changed_on: Optional[datetime.datetime]
+    offers: Tuple[Tuple[int, int], ...]  # active offers, empty if they are historic
+    times: array.array  # 'q'
+    prices: array.array  # 'q'
+
+    def __init__(self, product_id: int, name: str, description: Optional[str], instance_id: Optional[int]) -> None:
+        self.id = product_id
+        self.name = name
+        self.description = description
+        self.active = True
+        self.instance_id = instance_id
+        self.last_refreshed_on = None
+        self.last_changed_on = None
+        self.offers = ()
+        self.times = array.array("q")
+        self.prices = array.array("q")
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in process memory, shared by all handlers of the process and lost with it.
+
+    Products are kept by ID and by name, history of a product takes 16 bytes per snapshot with offers in stock and
+    ranges of it are found by bisection. Snapshots are expected in order of acquisition (as the refresh makes them),
+    an older one is inserted at its place in the history. Generations are counters of changes instead of IDs of change
+    events.
+    """
+    _lock: threading.Lock  # guards changes of the indexes
+    _instances: Dict[str, int]  # access token -> ID
+    _products: Dict[int, StoredProduct]  # in order of IDs
+    _names: Dict[str, int]  # name -> product ID
+    _ids: array.array  # 'q', IDs of all products in ascending order
+    _last_product_id: int
+    _generations: List[int]  # see .generations()
+    failures: collections.deque  # the latest (product ID, cycle ID, failed on, attempt, reason)
+
+    def __init__(self, max_failures: int = 10000) -> None:
+        self._lock = threading.Lock()
+        self._instances = dict()
+        self._products = dict()
+        self._names = dict()
+        self._ids = array.array("q")
+        self._last_product_id = 0
+        self._generations = [0, 0, 0]
+        self.failures = collections.deque(maxlen=max_failures)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def generations(self) -> Tuple[int, int, int]:
+        return tuple(self._generations)
+
+    def _changed(self, offers_changed: bool = True, product_changed: bool = True) -> None:
+        with self._lock:
+            self._generations[0] += 1
+
+            if offers_changed or product_changed:
+                self._generations[1] = self._generations[0]
+
+            if product_changed:
+                self._generations[2] = self._generations[0]
+
+    def _product(self, product_id: int) -> StoredProduct:
+        product = self._products.get(product_id)
+
+        if product is None:
+            raise ProductDoesntExist(product_id)
+
+        return product
+
+    def add_instance(self, access_token: str, date: datetime.datetime) -> int:
+        with self._lock:
+            return self._instances.setdefault(access_token, len(self._instances) + 1)
+
+    def find_instance(self, access_token: str) -> Optional[int]:
+        return self._instances.get(access_token)
+
+    def get_product(self, product_id: int) -> Optional[StoredProduct]:
+        return self._products.get(product_id)
+
+    def find_product(self, name: str) -> Optional[StoredProduct]:
+        product_id = self._names.get(name)
+
+        return None if product_id is None else self._products[product_id]
+
+    def add_product(self, name: str, description: Optional[str], instance_id: Optional[int]) -> int:
+        with self._lock:
+            if name in self._names:
+                raise ProductAlreadyExists()
+
+            self._last_product_id += 1
+            product = StoredProduct(self._last_product_id, name, description, instance_id)
+
+            self._products[product.id] = product
+            self._names[name] = product.id
+            self._ids.append(product.id)
+
+        self._changed()
+
+        return product.id
+
+    def update_product(self, product_id: int, name: Optional[str] = None,
+                       description: Optional[str] = None) -> StoredProduct:
+        product = self._product(product_id)
+
+        with self._lock:
+            if name is not None and name != product.name:
+                if name in self._names:
+                    raise ProductAlreadyExists()
+
+                del self._names[product.name]
+                self._names[name] = product_id
+                product.name = name
+
+        if description is not None:
+            product.description = description
+
+        self._changed()
+
+        return product
+
+    def activate_product(self, product_id: int) -> None:
+        self._product(product_id).active = True
+        self._changed()
+
+    def deactivate_product(self, product_id: int) -> None:
+        product = self._product(product_id)
+
+        product.active = False
+        product.offers = ()
+
+        self._changed()
+
+    def remove_product(self, product_id: int) -> None:
+        with self._lock:
+            product = self._products.pop(product_id, None)
+
+            if product is not None:
+                del self._names[product.name]
+                del self._ids[bisect.bisect_left(self._ids, product_id)]
+
+        if product is not None:
+            self._changed()
+
+    def active_product_ids(self, after_id: int, limit: int) -> List[int]:
+        result = []
+
+        with self._lock:
+            ids = self._ids[bisect.bisect_right(self._ids, after_id):]
+
+        for product_id in ids:
+            product = self._products.get(product_id)
+
+            if product is not None and product.active:
+                result.append(product_id)
+
+                if len(result) == limit:
+                    break
+
+        return result
+
+    def list_products(self) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            products = list(self._products.values())
+
+        for product in products:
+            if product.active:
+                yield {
+                    "id": product.id,
+                    "name": product.name,
+                    "description": product.description,
+                    "offers": [{"price": price, "items_in_stock": items_in_stock}
+                               for price, items_in_stock in product.offers if items_in_stock > 0]
+                }
+
+    def active_offers(self, product_id: int) -> List[Tuple[int, int]]:
+        product = self._products.get(product_id)
+
+        return [] if product is None else sorted(product.offers)
+
+    def add_snapshot(self, product_id: int, acquired_on: datetime.datetime, offers: List[Tuple[int, int]],
+                     previous_offers: List[Tuple[int, int]]) -> None:
+        product = self._product(product_id)
+        changed = sorted(offers) != sorted(previous_offers)
+
+        product.offers = tuple(offers)
+        product.last_refreshed_on = acquired_on
+        if changed:
+            product.last_changed_on = acquired_on
+
+        best_price = feed.best_price_of(offers)
+        if best_price is not None:
+            time = to_micros(acquired_on)
+
+            # after every snapshot of the same time, as the database orders them by insertion
+            index = bisect.bisect_right(product.times, time)
+            product.times.insert(index, time)
+            product.prices.insert(index, best_price)
+
+        self._changed(changed, False)
+
+    def price_history(self, product_id: int, start: datetime.datetime,
+                      end: datetime.datetime) -> List[Dict[str, Any]]:
+        product = self._products.get(product_id)
+
+        if product is None:
+            return []
+
+        first = bisect.bisect_left(product.times, to_micros(start))
+        last = bisect.bisect_right(product.times, to_micros(end))
+
+        return [{"price": product.prices[index], "acquired_on": from_micros(product.times[index])}
+                for index in range(first, last)]
+
+    def record_failure(self, product_id: int, cycle_id: Optional[int], failed_on: datetime.datetime, attempt: int,
+                       reason: str) -> None:
+        self.failures.append((product_id, cycle_id, failed_on, attempt, reason))
@@ -1,16 +1,32 @@
 import datetime
+from unittest.mock import MagicMock
 
 import pytest
 from sqlalchemy.orm import sessionmaker, session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from starlette.testclient import TestClient
 
+import api
 import model
+from bootstrap import Bootstrap
+from history_cache import HistoryCache
+from trends import TrendCache
 
 Session = sessionmaker()
 
 @pytest.fixture(scope="session")
 def connection():
     engine = create_engine('sqlite:///test-database.db')
+
+    # pysqlite handles transactions on its own, which breaks SAVEPOINTs used by session fixture
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
     yield engine.connect()
     # connection.close() # removed, because SQLite
 
@@ -27,6 +43,16 @@ def create_structure(connection):
 def session(create_structure, connection):
     transaction = connection.begin()
     session = Session(bind=connection)
+
+    # code under test can commit and rollback, it works within a SAVEPOINT, which is restarted after each of them
+    nested = connection.begin_nested()
+
+    @event.listens_for(session, "after_transaction_end")
+    def restart_savepoint(session, ended_transaction):
+        nonlocal nested
+        if not nested.is_active:
+            nested = connection.begin_nested()
+
     yield session
     session.close()
     transaction.rollback()
@@ -39,11 +65,61 @@ def create_offer(
     date: datetime.datetime,
     status: model.OfferStatus
 ):
+    # offers of the same product, time and status belong to the same snapshot
+    snapshot = session.query(model.Snapshot).filter_by(product_id=product_id, acquired_on=date, status=status).first()
+
+    if snapshot is None:
+        snapshot = model.Snapshot(product_id=product_id, acquired_on=date, status=status)
+        session.add(snapshot)
+
     offer = model.Offer(
         product_id=product_id,
         price=price,
         items_in_stock=stock,
-        acquired_on=date,
-        status=status
+        snapshot=snapshot
     )
-    session.add(offer)
\ No newline at end of file
+    session.add(offer)
+
+
+def offers(*pairs) -> MagicMock:
+    """
+    :param pairs: (price, items in stock) of offers
+    :return: response of the API with given offers
+    """
+    return MagicMock(status_code=200, json=MagicMock(return_value=[
+        {"id": index, "price": price, "items_in_stock": items_in_stock}
+        for index, (price, items_in_stock) in enumerate(pairs, start=1)
+    ]))
+
+
+@pytest.fixture()
+def api_engine(tmp_path):
+    """
+    Engine of a new database file used by the `client` - a module can override it, e.g. by a prepared database.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}", connect_args={"check_same_thread": False})
+    model.Base.metadata.create_all(bind=engine)
+
+    yield engine
+
+    engine.dispose()
+
+
+@pytest.fixture()
+def client(request, api_engine, monkeypatch) -> TestClient:
+    """
+    Test client of the API working with `api_engine` and empty caches. Parametrize it indirectly by a storage factory
+    (e.g. MemoryStorage) to keep products in other storage than the database.
+    """
+    storage = getattr(request, "param", None)
+
+    bootstrap = Bootstrap("URL", sessionmaker(bind=api_engine), bind=api_engine,
+                          storage=None if storage is None else storage())
+    bootstrap.ensure_schema()
+
+    monkeypatch.setattr(api, "bootstrap", bootstrap)
+    monkeypatch.setattr(api, "trend_cache", TrendCache())
+    monkeypatch.setattr(api, "history_responses", HistoryCache())
+    monkeypatch.setattr(api, "list_response", None)
+
+    return TestClient(api.api)
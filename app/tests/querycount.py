@@ -0,0 +1,40 @@
+from typing import List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connectable
+
+# transaction control, e.g. SAVEPOINTs of the session fixture, isn't a query
+IGNORED = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+class QueryCounter:
+    """
+    Records SQL statements executed through given engine (by any of its connections) within the `with` block.
+
+        with QueryCounter(session.bind) as queries:
+            handler.get_price_trend(1)
+
+        assert len(queries) <= 2, queries.report()
+    """
+    statements: List[str]
+
+    def __init__(self, bind: Connectable) -> None:
+        self._engine = bind.engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if not statement.lstrip().upper().startswith(IGNORED):
+            self.statements.append(statement)
+
+    def __enter__(self) -> "QueryCounter":
+        event.listen(self._engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        event.remove(self._engine, "before_cursor_execute", self._record)
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    def report(self) -> str:
+        return f"{len(self.statements)} queries:\n" + "\n".join(self.statements)
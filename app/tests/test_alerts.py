@@ -0,0 +1,67 @@
+import datetime
+from unittest.mock import patch
+
+from pytest import raises
+
+import alerts
+from alerts import AlertIndex
+from apihandler import APIHandler, ProductDoesntExist
+from model import Instance, Product, OfferStatus, AlertKind, Alert
+from .fixtures import session, create_structure, connection, create_offer, offers
+
+
+@patch("requests.get")
+def test_alerts_are_triggered_once(requests_get, session):
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+    session.add(Product(name="Product 1", description="Description"))
+    session.add(Product(name="Product 2", description="Description"))
+    session.commit()
+
+    # an hour ago, the price was 100
+    create_offer(session, 1, 100, 1, datetime.datetime.now() - datetime.timedelta(hours=1), OfferStatus.historic)
+    session.commit()
+
+    below_90 = alerts.create_alert(session, 1, AlertKind.price_below, 90)
+    below_50 = alerts.create_alert(session, 1, AlertKind.price_below, 50)
+    drop_10_percent = alerts.create_alert(session, 1, AlertKind.price_move, 10, window=1800)
+    drop_30_percent = alerts.create_alert(session, 1, AlertKind.price_move, 30, window=1800)
+    in_stock = alerts.create_alert(session, 1, AlertKind.back_in_stock)
+    other_product = alerts.create_alert(session, 2, AlertKind.price_below, 1000)
+
+    with raises(ProductDoesntExist):
+        alerts.create_alert(session, 3, AlertKind.back_in_stock)
+
+    with raises(ValueError):
+        alerts.create_alert(session, 1, AlertKind.price_move, 10)
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+    handler.watch_alerts(AlertIndex.load(session))
+
+    requests_get.side_effect = [offers((80, 0)), offers((80, 2)), offers((70, 0), (75, 1)), offers((40, 1))]
+
+    handler.refresh_product(1)  # nothing in stock
+    assert alerts.triggered_alerts(session) == []
+
+    handler.refresh_product(1)  # back in stock for 80, 20 % drop
+
+    triggered = alerts.triggered_alerts(session)
+    assert {alert["alert_id"] for alert in triggered} == {below_90, drop_10_percent, in_stock}
+    assert all(alert["best_price"] == 80 for alert in triggered)
+
+    handler.refresh_product(1)  # 75, no new alert - the triggered ones are one-shot
+    assert len(alerts.triggered_alerts(session)) == 3
+
+    handler.refresh_product(1)  # 40 - 60 % drop
+
+    triggered = alerts.triggered_alerts(session, product_id=1, after_id=triggered[-1]["id"])
+    assert {alert["alert_id"] for alert in triggered} == {below_50, drop_30_percent}
+
+    assert [alert.id for alert in session.query(Alert).filter(Alert.active == True)] == [other_product]
+
+    alerts.delete_alert(session, other_product)
+
+    with raises(alerts.AlertDoesntExist):
+        alerts.delete_alert(session, other_product)
+
+    assert len(AlertIndex.load(session)) == 0
@@ -0,0 +1,102 @@
+import datetime
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+from pytest import raises, approx
+
+import analytics
+from apihandler import ProductDoesntExist
+from model import Product, OfferStatus
+from .fixtures import session, create_structure, connection, create_offer
+
+
+def test_statistics_of_several_products(session):
+    session.add(Product(name="Product 1", description="Description"))
+    session.add(Product(name="Product 2", description="Description"))
+    session.add(Product(name="Product 3", description="Description"))
+    session.commit()
+
+    start = datetime.datetime(2021, 6, 1, 12, 0)
+
+    # best prices in stock: 100, 110, nothing in stock, 99 - every snapshot lasts a minute
+    for minute, offers in enumerate([[(100, 1), (120, 5)], [(110, 2), (90, 0)], [(80, 0)], [(99, 3)]]):
+        for price, stock in offers:
+            create_offer(session, 1, price, stock, start + datetime.timedelta(minutes=minute), OfferStatus.historic)
+
+    create_offer(session, 2, 50, 0, start, OfferStatus.historic)
+    session.commit()
+
+    first, second, third = analytics.analyze(session, [1, 2, 3], start, start + datetime.timedelta(minutes=4),
+                                             percentiles=[0, 50, 100], moving_averages=[2, 10])
+
+    assert first["snapshots"] == 4
+    assert first["points_in_stock"] == 3
+    assert first["time_in_stock"] == approx(75.0)
+    assert (first["min"], first["max"]) == (99, 110)
+    assert first["mean"] == approx(103.0)
+    assert first["percentiles"] == {"0": 99, "50": 100, "100": 110}
+    assert first["moving_averages"] == {"2": approx(104.5), "10": approx(103.0)}
+    assert first["rise_or_fall"] == approx(-1.0)
+    # relative changes +10 % and -10 %
+    assert first["volatility"] == approx(10.0)
+
+    # never in stock
+    assert second["time_in_stock"] == 0.0
+    assert second["min"] is None and second["volatility"] is None
+
+    # no snapshots at all
+    assert third["snapshots"] == 0
+    assert third["time_in_stock"] is None
+
+    with raises(ProductDoesntExist):
+        analytics.analyze(session, [1, 4])
+
+
+def test_large_requests_are_computed_in_pool(session):
+    for index in range(3):
+        session.add(Product(name=f"Product {index}", description="Description"))
+    session.commit()
+
+    start = datetime.datetime(2021, 6, 1, 12, 0)
+    for product_id in (1, 2, 3):
+        for minute in range(5):
+            create_offer(session, product_id, 100 + product_id * minute, 1, start + datetime.timedelta(minutes=minute),
+                         OfferStatus.historic)
+    session.commit()
+
+    end = start + datetime.timedelta(minutes=5)
+    sequential = analytics.analyze(session, [1, 2, 3], start, end)
+
+    with patch.object(analytics, "POOL_THRESHOLD", 0):
+        pooled = analytics.analyze(session, [1, 2, 3], start, end)
+
+    assert pooled == sequential
+    assert [result["max"] for result in pooled] == [104, 108, 112]
+
+    analytics.shutdown()
+    assert analytics._pool is None
+
+
+def test_pool_is_created_once():
+    def slow_pool(*args, **kwargs):
+        time.sleep(0.05)  # let the other threads reach the check
+        return MagicMock()
+
+    with patch.object(analytics, "ProcessPoolExecutor", side_effect=slow_pool) as executor:
+        threads = [threading.Thread(target=analytics._get_pool) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pool = analytics._get_pool()
+
+        assert executor.call_count == 1
+        assert executor.call_args[1]["mp_context"].get_start_method() == "spawn"
+
+    analytics.shutdown()
+    analytics.shutdown()  # nothing to stop anymore
+
+    pool.shutdown.assert_called_once_with()
+    assert analytics._pool is None
@@ -25,7 +25,7 @@ def test_new_auth(requests_post, session):
     handler = APIHandler(session, "URL")
     handler.start()
 
-    requests_post.assert_called_with("URL/auth")
+    requests_post.assert_called_with("URL/auth", timeout=10.0)
     assert session.query(Instance).first().access_token == "AC_TOKEN"
     assert handler._current_instance_id == 1
     assert handler._current_access_token == "AC_TOKEN"
@@ -244,8 +244,8 @@ def test_update_offers(requests_get, requests_post, session):
     handler.update_offers()
 
     requests_get.assert_has_calls([
-        call("URL/products/1/offers", data={}, headers={"Bearer": "AC_TOKEN"}),
-        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}),
+        call("URL/products/1/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
     ])
     assert list(handler.list_products()) == [
         {
@@ -307,8 +307,8 @@ def test_update_offers(requests_get, requests_post, session):
     handler.update_offers()
 
     requests_get.assert_has_calls([
-        call("URL/products/1/offers", data={}, headers={"Bearer": "AC_TOKEN"}),
-        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}),
+        call("URL/products/1/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
     ])
     assert list(handler.list_products()) == [
         {
@@ -0,0 +1,84 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+import requests
+from pytest import raises
+
+import lease
+from bootstrap import Bootstrap, AUTH_LEASE
+from model import Instance
+from .fixtures import session, create_structure, connection
+
+
+def test_nothing_happens_before_first_use():
+    with patch("model.Base.metadata.create_all") as create_all:
+        Bootstrap()
+
+    create_all.assert_not_called()
+
+
+@patch("requests.post")
+def test_unreachable_api(requests_post, session, connection):
+    requests_post.side_effect = requests.ConnectionError("unreachable")
+
+    bootstrap = Bootstrap("URL", session_factory=lambda: session, bind=connection, retry_after=60.0)
+
+    # local data are available even without API
+    assert list(bootstrap.handler(session).list_products()) == []
+
+    with raises(RuntimeError):
+        bootstrap.authenticated_handler(session)
+
+    # failure is remembered, so that dead API isn't hammered by every request
+    with raises(RuntimeError):
+        bootstrap.authenticated_handler(session)
+
+    assert requests_post.call_count == 1
+
+    requests_post.side_effect = None
+    requests_post.return_value = MagicMock(status_code=201, json=MagicMock(return_value={"access_token": "AC_TOKEN"}))
+    bootstrap._last_failure = None
+
+    handler = bootstrap.authenticated_handler(session)
+
+    assert handler.credentials == (1, "AC_TOKEN")
+    assert session.query(Instance).first().access_token == "AC_TOKEN"
+
+    # credentials are cached, next handlers don't need any query nor request
+    assert bootstrap.handler(session).credentials == (1, "AC_TOKEN")
+    assert requests_post.call_count == 2
+
+
+def test_lease(session):
+    minute = datetime.timedelta(minutes=1)
+
+    assert lease.acquire(session, "lease", "first", minute)
+    assert lease.acquire(session, "lease", "first", minute)  # renewal
+    assert not lease.acquire(session, "lease", "second", minute)
+
+    lease.release(session, "lease", "second")  # not a holder, nothing happens
+    assert not lease.acquire(session, "lease", "second", minute)
+
+    lease.release(session, "lease", "first")
+    assert lease.acquire(session, "lease", "second", minute)
+
+    # holder, which didn't renew the lease in time, loses it
+    assert lease.acquire(session, "expired", "first", -minute)
+    assert lease.acquire(session, "expired", "second", minute)
+
+
+@patch("requests.post")
+def test_handshake_done_by_another_process(requests_post, session, connection):
+    # another worker is in the middle of the handshake
+    assert lease.acquire(session, AUTH_LEASE, "another worker", datetime.timedelta(minutes=1))
+
+    def finish_handshake(seconds):
+        session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+        session.commit()
+
+    bootstrap = Bootstrap("URL", session_factory=lambda: session, bind=connection)
+
+    with patch("time.sleep", side_effect=finish_handshake):
+        assert bootstrap.credentials() == (1, "AC_TOKEN")
+
+    requests_post.assert_not_called()
@@ -0,0 +1,162 @@
+import datetime
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.testclient import TestClient
+
+import compression
+import conditional
+import feed
+import importer
+from compression import CompressionMiddleware
+from model import Product, OfferStatus
+from .fixtures import create_offer, api_engine, client
+
+
+def test_negotiate(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("br;q=1.0, gzip;q=0.5") == "gzip"  # brotli isn't installed
+    assert compression.negotiate("gzip;q=0, identity") is None
+    assert compression.negotiate("*") == "gzip"
+    assert compression.negotiate("") is None
+
+    monkeypatch.setattr(compression, "brotli", object())
+
+    assert compression.negotiate("gzip, br") == "br"
+    assert compression.negotiate("br;q=0.5, gzip") == "gzip"
+
+
+def test_not_modified():
+    tag = conditional.etag("list", 42)
+
+    assert tag == conditional.etag("list", 42)
+    assert tag != conditional.etag("list", 43)
+
+    assert conditional.not_modified(tag, tag)
+    assert conditional.not_modified(f'"other", W/{tag}', tag)
+    assert conditional.not_modified(tag[:-1] + '-gzip"', tag)
+    assert conditional.not_modified("*", tag)
+    assert not conditional.not_modified(None, tag)
+    assert not conditional.not_modified('"other"', tag)
+
+
+def test_compression_middleware():
+    app = Starlette()
+
+    @app.route("/large")
+    def large(request):
+        return Response(b"x" * 2000, media_type="text/plain", headers={"ETag": '"tag"'})
+
+    @app.route("/small")
+    def small(request):
+        return Response(b"x" * 10, media_type="text/plain")
+
+    @app.route("/stream")
+    def stream(request):
+        return StreamingResponse(iter([b"x" * 2000, b"y" * 2000]), media_type="application/x-ndjson")
+
+    client = TestClient(CompressionMiddleware(app))
+
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < 100
+    assert response.headers["etag"] == '"tag-gzip"'
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == b"x" * 2000  # decompressed by the client
+
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] == '"tag"'
+
+    for path in ("/small", "/stream"):
+        response = client.get(path, headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+
+    assert client.get("/stream").content == b"x" * 2000 + b"y" * 2000
+
+
+@pytest.fixture()
+def database(api_engine):
+    db_session = sessionmaker(bind=api_engine)()
+
+    for index in range(1, 51):
+        db_session.add(Product(name=f"Product {index}", description="Description " * 5))
+    db_session.commit()
+
+    create_offer(db_session, 1, 100, 1, datetime.datetime(2021, 7, 1, 12, 0), OfferStatus.historic)
+    create_offer(db_session, 1, 90, 1, datetime.datetime(2021, 7, 1, 12, 1), OfferStatus.active)
+    feed.publish_product(db_session, 1, "created", name="Product 1", description="Description")
+    db_session.commit()
+
+    yield db_session
+
+    db_session.close()
+
+
+def test_list_all(client, database):
+    response = client.get("/list-all")
+    tag = response.headers["etag"]
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"  # the test client accepts gzip
+    assert len(response.json()) == 50
+
+    response = client.get("/list-all", headers={"If-None-Match": tag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == tag  # tag of the compressed representation the client has
+
+    # refresh with the same offers doesn't change the list
+    feed.publish_snapshot(database, 1, datetime.datetime.now(), [(90, 1)], [(90, 1)])
+    database.commit()
+
+    response = client.get("/list-all", headers={"If-None-Match": tag})
+    assert response.status_code == 304
+
+    # any change makes a new generation
+    feed.publish_product(database, 2, "updated", name="Product 2", description="Changed")
+    database.commit()
+
+    response = client.get("/list-all", headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != tag
+
+
+def test_history(client, database):
+    time_range = {"start": "2021-07-01T11:00:00", "end": "2021-07-01T13:00:00"}
+
+    response = client.post("/product-offer-history/1", json=time_range)
+    tag = response.headers["etag"]
+
+    assert response.status_code == 200
+    assert [point["price"] for point in response.json()["history"]] == [100, 90]
+
+    response = client.post("/product-offer-history/1", json=time_range, headers={"If-None-Match": tag})
+    assert response.status_code == 304
+
+    # historic range depends only on product changes
+    feed.publish_snapshot(database, 2, datetime.datetime.now(), [(10, 1)], [])
+    database.commit()
+
+    response = client.post("/product-offer-history/1", json=time_range, headers={"If-None-Match": tag})
+    assert response.status_code == 304
+
+    response = client.post("/product-offer-history/1", json={"start": "2021-07-01T11:00:00"},
+                           headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != tag
+
+    # backfilled history changes the historic range too
+    report = importer.import_rows(database.get_bind(), iter([
+        {"product_id": 1, "price": 80, "items_in_stock": 1, "acquired_on": "2021-07-01T12:30:00"}
+    ]))
+    assert report["imported"] == 1
+
+    response = client.post("/product-offer-history/1", json=time_range, headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != tag
+    assert [point["price"] for point in response.json()["history"]] == [100, 90, 80]
@@ -0,0 +1,70 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+
+from pytest import raises
+
+import export
+from model import Product, OfferStatus
+from .fixtures import session, create_structure, connection, create_offer
+
+
+def create_history(session) -> datetime.datetime:
+    session.add(Product(name="Product 1", description="Description"))
+    session.add(Product(name="Product 2", description="Description"))
+    session.commit()
+
+    start = datetime.datetime(2021, 6, 1, 12, 0)
+    for minute in range(5):
+        for product_id in (1, 2):
+            create_offer(session, product_id, 100 + minute, minute, start + datetime.timedelta(minutes=minute),
+                         OfferStatus.historic)
+    session.commit()
+
+    return start
+
+
+def test_formats_and_filters(session):
+    start = create_history(session)
+
+    rows = [json.loads(line) for line in b"".join(export.export(session, "ndjson", chunk_size=3)).splitlines()]
+    assert [row["id"] for row in rows] == list(range(1, 11))
+    assert rows[0] == {"id": 1, "product_id": 1, "price": 100, "items_in_stock": 0,
+                       "acquired_on": "2021-06-01T12:00:00", "status": "historic"}
+
+    filtered = b"".join(export.export(session, "csv", product_ids=[2], start=start + datetime.timedelta(minutes=3),
+                                      chunk_size=1))
+    assert list(csv.reader(io.StringIO(filtered.decode()))) == [
+        list(export.COLUMNS),
+        ["8", "2", "103", "3", "2021-06-01T12:03:00", "historic"],
+        ["10", "2", "104", "4", "2021-06-01T12:04:00", "historic"],
+    ]
+
+    empty = b"".join(export.export(session, "csv", product_ids=[3]))
+    assert empty.decode().splitlines() == [",".join(export.COLUMNS)]
+
+    columnar = [json.loads(line) for line in
+                gzip.decompress(b"".join(export.export(session, "columnar", True, chunk_size=4))).splitlines()]
+    assert [len(batch["id"]) for batch in columnar] == [4, 4, 2]
+    assert columnar[2]["price"] == [104, 104]
+
+    with raises(ValueError):
+        list(export.export(session, "xml"))
+
+
+def test_incremental_export(session):
+    start = create_history(session)
+
+    up_to_id = export.watermark(session)
+    first = b"".join(export.export(session, up_to_id=up_to_id))
+
+    # offers added during or after the export belong to the next one
+    create_offer(session, 1, 200, 1, start + datetime.timedelta(minutes=10), OfferStatus.active)
+    session.commit()
+
+    assert len(first.splitlines()) == 10
+
+    second = [json.loads(line) for line in b"".join(export.export(session, after_id=up_to_id)).splitlines()]
+    assert [(row["id"], row["price"]) for row in second] == [(11, 200)]
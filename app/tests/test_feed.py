@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import json
+from unittest.mock import patch, AsyncMock
+
+import feed
+from apihandler import APIHandler
+from feed import ChangeFeed, Subscription
+from model import Instance, Product
+from .fixtures import session, create_structure, connection, offers
+
+
+@patch("requests.get")
+def test_snapshots_are_published(requests_get, session):
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+    session.add(Product(name="Product", description="Description"))
+    session.commit()
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+
+    requests_get.side_effect = [offers((20, 1), (10, 1)), offers((10, 1), (20, 1)), offers((5, 1))]
+
+    assert handler.refresh_product(1)
+    assert not handler.refresh_product(1)  # the same offers
+    assert handler.refresh_product(1)
+
+    events = feed.fetch_events(session, 0)
+
+    assert len(events) == 2  # unchanged snapshot isn't worth pushing
+
+    event_id, product_id, message = events[-1]
+    assert product_id == 1
+    assert message.startswith(f"id: {event_id}\nevent: snapshot\n")
+
+    data = json.loads(message.split("data: ")[1])
+    assert data["best_price"] == 5
+    assert data["previous_best_price"] == 10
+    assert data["offers"] == [{"price": 5, "items_in_stock": 1}]
+    assert feed.last_event_id(session) == event_id
+
+
+def test_generations_and_prune(session):
+    session.add(Product(name="Product", description="Description"))
+    session.commit()
+
+    past = datetime.datetime.now() - datetime.timedelta(hours=2)
+
+    product_event = feed.publish_product(session, 1, "created", name="Product", description="Description")
+    changed = feed.publish_snapshot(session, 1, past, [(10, 1)], [])
+    unchanged = feed.publish_snapshot(session, 1, past, [(10, 1)], [(10, 1)])
+    session.commit()
+
+    # snapshot with the same offers moves only the first generation
+    assert feed.generations(session) == (unchanged.id, changed.id, product_event.id)
+
+    product_event.created_on = past
+    session.commit()
+
+    # the last events of every generation are kept
+    assert feed.prune(session, datetime.timedelta(hours=1)) == 0
+    assert feed.generations(session) == (unchanged.id, changed.id, product_event.id)
+
+
+@patch.object(ChangeFeed, "_poll", new_callable=AsyncMock)
+@patch.object(ChangeFeed, "_run_in_thread", new_callable=AsyncMock, return_value=0)
+def test_fan_out(run_in_thread, poll):
+    async def scenario():
+        change_feed = ChangeFeed(session_factory=None, max_pending=2)
+
+        everything = await change_feed.subscribe()
+        product_1 = await change_feed.subscribe({1})
+        product_2 = await change_feed.subscribe({2})
+
+        change_feed.dispatch(1, 1, "first")
+        change_feed.dispatch(2, 1, "second")
+        change_feed.dispatch(3, 1, "third")  # queues of two subscriptions are full
+
+        assert await product_2.get(timeout=0.01) is None
+
+        assert await product_1.get(timeout=0.01) == "first"
+        assert await product_1.get(timeout=0.01) == "second"
+        assert await product_1.get(timeout=0.01) == Subscription.RESYNC  # third was dropped
+
+        assert await everything.get(timeout=0.01) == "first"
+        assert await everything.get(timeout=0.01) == "second"
+        assert await everything.get(timeout=0.01) == Subscription.RESYNC
+
+        change_feed.unsubscribe(product_1)
+        change_feed.dispatch(4, 1, "fourth")
+
+        assert await everything.get(timeout=0.01) == "fourth"
+        assert await product_1.get(timeout=0.01) is None
+
+    asyncio.run(scenario())
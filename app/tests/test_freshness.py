@@ -0,0 +1,105 @@
+import datetime
+from unittest.mock import patch
+
+from pytest import raises
+
+import freshness
+from apihandler import APIHandler
+from model import Instance, Product, OfferStatus
+from .fixtures import session, create_structure, connection, create_offer, offers
+from .querycount import QueryCounter
+
+NOW = datetime.datetime(2021, 7, 1, 12, 0)
+
+
+@patch("requests.get")
+def test_refresh_updates_freshness(requests_get, session):
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+    session.add(Product(id=1, name="Product 1", description="Description"))
+    session.commit()
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+
+    requests_get.return_value = offers((10, 1))
+    handler.refresh_product(1)
+
+    product = session.query(Product).get(1)
+    first_refresh = product.last_refreshed_on
+    assert first_refresh is not None
+    assert product.last_changed_on == first_refresh
+
+    # the same offers - refreshed, but not changed
+    handler.refresh_product(1)
+
+    session.refresh(product)
+    assert product.last_refreshed_on > first_refresh
+    assert product.last_changed_on == first_refresh
+
+    requests_get.return_value = offers((20, 1))
+    handler.refresh_product(1)
+
+    session.refresh(product)
+    assert product.last_changed_on == product.last_refreshed_on
+
+
+def test_report(session):
+    # staleness 0, 60, ..., 540 seconds
+    for index in range(10):
+        session.add(Product(name=f"Product {index}", last_refreshed_on=NOW - datetime.timedelta(minutes=index)))
+
+    session.add(Product(name="Deleted", active=False))
+    session.commit()
+
+    with QueryCounter(session.bind) as queries:
+        report = freshness.report(session, datetime.timedelta(minutes=5), (50, 90, 100), limit=2, now=NOW)
+
+    # refresh times once, the most stale violating products once - independently of the number of percentiles
+    assert len(queries) == 2, queries.report()
+
+    assert report["products"] == 10
+    assert report["never_refreshed"] == 0
+    assert report["percentiles"] == {"50": 240.0, "90": 480.0, "100": 540.0}
+    assert report["max"] == 540.0
+    assert report["within_slo"] == 0.6
+    assert report["violations"]["total"] == 4
+    assert [(item["name"], item["staleness"]) for item in report["violations"]["items"]] == [
+        ("Product 9", 540.0), ("Product 8", 480.0)
+    ]
+
+    # never refreshed product is the most stale one
+    session.add(Product(name="New"))
+    session.commit()
+
+    report = freshness.report(session, datetime.timedelta(minutes=5), (50, 100), limit=1, now=NOW)
+
+    assert report["never_refreshed"] == 1
+    assert report["percentiles"] == {"50": 300.0, "100": None}
+    assert report["max"] is None
+    assert report["violations"]["total"] == 5
+    assert [item["name"] for item in report["violations"]["items"]] == ["New"]
+
+    with raises(ValueError):
+        freshness.report(session, datetime.timedelta(minutes=5), (0,))
+
+
+def test_fill_last_refreshed(session):
+    for index in range(1, 4):
+        session.add(Product(name=f"Product {index}"))
+    session.commit()
+
+    session.query(Product).filter(Product.id == 3).update({"last_refreshed_on": NOW})
+
+    create_offer(session, 1, 10, 1, NOW - datetime.timedelta(minutes=2), OfferStatus.historic)
+    create_offer(session, 1, 10, 1, NOW - datetime.timedelta(minutes=1), OfferStatus.active)
+    create_offer(session, 2, 10, 1, NOW, OfferStatus.historic)  # e.g. imported
+    create_offer(session, 3, 10, 1, NOW + datetime.timedelta(minutes=1), OfferStatus.historic)
+    session.commit()
+
+    session.execute(freshness.FILL_LAST_REFRESHED)
+    session.commit()
+
+    # only never refreshed products with the offers of a refresh, historic snapshots aren't refreshes
+    assert [product.last_refreshed_on for product in session.query(Product).order_by(Product.id)] == [
+        NOW - datetime.timedelta(minutes=1), None, NOW
+    ]
@@ -0,0 +1,102 @@
+import datetime
+import threading
+import time
+
+from pytest import raises
+
+import feed
+from history_cache import HistoryCache
+from model import Product
+from .fixtures import session, create_structure, connection
+
+
+def publish_snapshot(session, product_id: int) -> None:
+    feed.publish_snapshot(session, product_id, datetime.datetime.now(), [(100, 1)], [])
+    session.commit()
+
+
+def test_invalidation_by_generation(session):
+    session.add(Product(name="Product 1", description="Description"))
+    session.commit()
+
+    cache = HistoryCache(max_lag=0.0)
+    computed = []
+
+    def compute(result: bytes):
+        def run():
+            computed.append(result)
+            return result
+
+        return run
+
+    now = datetime.datetime.now()
+    day_ago = now - datetime.timedelta(days=1)
+    hour_ago = now - datetime.timedelta(hours=1)
+
+    assert cache.get(session, 1, day_ago, None, compute(b"present")) == b"present"
+    assert cache.get(session, 1, hour_ago, day_ago, compute(b"historic")) == b"historic"
+
+    # normalized range, nothing changed
+    assert cache.get(session, 1, day_ago, None, compute(b"other")) == b"present"
+    assert cache.get(session, 1, day_ago, hour_ago, compute(b"other")) == b"historic"
+
+    publish_snapshot(session, 1)
+
+    assert cache.get(session, 1, day_ago, None, compute(b"present again")) == b"present again"
+    assert cache.get(session, 1, day_ago, hour_ago, compute(b"other")) == b"historic"
+
+    # product change drops historic ranges as well
+    feed.publish_product(session, 1, "deleted")
+    session.commit()
+
+    assert cache.get(session, 1, day_ago, hour_ago, compute(b"historic again")) == b"historic again"
+
+    assert computed == [b"present", b"historic", b"present again", b"historic again"]
+    assert (cache.hits, cache.misses) == (3, 4)
+
+
+def test_memory_bound_and_errors(session):
+    cache = HistoryCache(max_bytes=10, max_lag=60.0)
+    start = datetime.datetime(2021, 1, 1)
+
+    for day in range(4):
+        cache.get(session, 1, start + datetime.timedelta(days=day), start, lambda: b"1234")
+
+    # the least recently used one was evicted
+    assert len(cache) == 2
+    assert cache.size == 8
+
+    def fail():
+        raise RuntimeError("Database is down.")
+
+    with raises(RuntimeError):
+        cache.get(session, 2, start, start, fail)
+
+    assert len(cache) == 2
+
+
+def test_concurrent_misses_are_computed_once(session):
+    cache = HistoryCache(max_lag=60.0)
+    start = datetime.datetime(2021, 1, 1)
+    end = datetime.datetime(2021, 1, 2)
+
+    cache.get(session, 2, start, end, lambda: b"")  # reads the generation, so threads don't need the session
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return b"history"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(session, 1, start, end, compute)))
+               for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [b"history"] * 8
+    assert len(calls) == 1
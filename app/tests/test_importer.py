@@ -0,0 +1,111 @@
+import csv
+import datetime
+import gzip
+import json
+
+from sqlalchemy import create_engine, inspect, select, func
+from sqlalchemy.engine import Engine
+
+import importer
+import model
+from model import OfferStatus
+
+
+def create_database(path) -> Engine:
+    engine = create_engine(f"sqlite:///{path}")
+    model.Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        connection.execute(model.Product.__table__.insert(), [
+            {"id": 1, "name": "Product 1", "description": "Description", "active": True},
+            {"id": 2, "name": "Product 2", "description": "Description", "active": True},
+        ])
+
+    return engine
+
+
+def test_import_of_ndjson_with_deferred_indexes(tmp_path):
+    engine = create_database(tmp_path / "database.db")
+
+    start = datetime.datetime(2020, 1, 1)
+    path = tmp_path / "offers.ndjson.gz"
+
+    with gzip.open(path, "wt") as file:
+        for index in range(1000):
+            file.write(json.dumps({"product_id": 1 + index % 2, "price": index, "items_in_stock": 1,
+                                   "acquired_on": (start + datetime.timedelta(minutes=index)).isoformat()}) + "\n")
+
+        file.write(json.dumps({"product_id": 3, "price": 1, "items_in_stock": 1,
+                               "acquired_on": start.isoformat()}) + "\n")
+        file.write(json.dumps({"product_id": 1, "price": -1, "items_in_stock": 1,
+                               "acquired_on": start.isoformat()}) + "\n")
+        file.write(json.dumps({"product_id": 1, "price": 1}) + "\n")
+        file.write('{"product_id": 1, "price": 1, "items_in' + "\n")
+
+    with importer.open_source(str(path)) as source:
+        report = importer.import_rows(engine, importer.read_rows(source, importer.detect_format(str(path))),
+                                      batch_size=64, batches_per_transaction=3, defer_indexes=True)
+
+    assert (report["imported"], report["rejected"], report["products"]) == (1000, 4, 2)
+
+    offer = model.Offer.__table__
+    snapshot = model.Snapshot.__table__
+    with engine.connect() as connection:
+        assert connection.execute(select([func.count()]).select_from(offer)).scalar() == 1000
+        assert connection.execute(select([func.count()]).select_from(snapshot)).scalar() == 1000
+        assert connection.execute(select([func.max(offer.c.price)]).where(offer.c.product_id == 2)).scalar() == 999
+        assert {status for (status,) in connection.execute(select([snapshot.c.status]))} == {OfferStatus.historic}
+
+        # every offer belongs to the snapshot of its product and time
+        assert connection.execute(
+            select([func.count()]).select_from(offer.join(snapshot, snapshot.c.id == offer.c.snapshot_id)).where(
+                snapshot.c.product_id == offer.c.product_id
+            )
+        ).scalar() == 1000
+
+    # indexes are back
+    for table in (offer, snapshot):
+        assert {index["name"] for index in inspect(engine).get_indexes(table.name)} == \
+               {index.name for index in table.indexes}
+
+
+def test_import_of_csv(tmp_path):
+    engine = create_database(tmp_path / "database.db")
+
+    # rows of an export - offers active at the time are imported as historic
+    path = tmp_path / "offers.csv"
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["id", "product_id", "price", "items_in_stock", "acquired_on", "status"])
+        writer.writerow([7, 2, 150, 0, "2020-01-01T12:00:00", "active"])
+        writer.writerow([8, 2, "cheap", 0, "2020-01-01T12:00:00", "active"])
+        writer.writerow([9, 2, 160, 3, "2020-01-01T12:00:00", "active"])
+
+    with importer.open_source(str(path)) as source:
+        report = importer.import_rows(engine, importer.read_rows(source, importer.detect_format(str(path))))
+
+    assert (report["imported"], report["rejected"], report["products"]) == (2, 1, 1)
+
+    with engine.connect() as connection:
+        assert connection.execute(select([model.Snapshot.__table__])).fetchall() == [
+            (1, 2, datetime.datetime(2020, 1, 1, 12), OfferStatus.historic)
+        ]
+        assert connection.execute(select([model.Offer.__table__])).fetchall() == [
+            (1, 150, 0, 1, 2),
+            (2, 160, 3, 1, 2),
+        ]
+
+        product = model.Product.__table__
+        assert connection.execute(
+            select([product.c.id, product.c.last_refreshed_on]).order_by(product.c.id)
+        ).fetchall() == [(1, None), (2, None)]  # imported offers aren't a refresh
+
+        # the touched product got an event, so that caches and validators of its history are dropped
+        event = model.ChangeEvent.__table__
+        events = connection.execute(
+            select([event.c.kind, event.c.product_id, event.c.changed, event.c.payload])
+        ).fetchall()
+        assert [(kind, product_id, changed) for kind, product_id, changed, _ in events] == \
+               [(model.ChangeKind.product, 2, True)]
+        assert json.loads(events[0][3]) == {"action": "imported", "first_acquired_on": "2020-01-01T12:00:00",
+                                            "last_acquired_on": "2020-01-01T12:00:00", "offers": 2}
@@ -0,0 +1,87 @@
+import datetime
+import json
+import random
+from unittest.mock import patch, MagicMock
+
+from pytest import raises
+
+from benchmarks.loadtest import parse_mix, percentile, route_of, read_replay_log, run, main, SCENARIOS
+
+
+def test_parse_mix():
+    assert parse_mix("list-all=6,history=3,create") == {"list-all": 6, "history": 3, "create": 1}
+
+    with raises(ValueError):
+        parse_mix("unknown=1")
+
+    with raises(ValueError):
+        parse_mix("list-all=0")
+
+
+def test_history_scenarios():
+    rng = random.Random(0)
+    now = datetime.datetime.now()
+
+    for _ in range(10):
+        body = SCENARIOS["history-range"](rng, [7])["json"]
+        start, end = datetime.datetime.fromisoformat(body["start"]), datetime.datetime.fromisoformat(body["end"])
+
+        assert end - start == datetime.timedelta(hours=1)
+        assert now - datetime.timedelta(hours=25) < start and end <= now
+
+        body = SCENARIOS["history-since"](rng, [7])["json"]
+        assert datetime.datetime.fromisoformat(body["start"]) < now and body["end"] is None
+
+    assert SCENARIOS["history-range"](rng, [7])["path"] == "/product-offer-history/7"
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 99) == 0.0
+
+
+def test_route_of():
+    assert route_of("/product-offer-history/15") == "/product-offer-history/{id}"
+    assert route_of("/list-all") == "/list-all"
+
+
+def test_replay(tmp_path, caplog):
+    log = tmp_path / "captured.jsonl"
+    log.write_text("\n".join([
+        json.dumps({"method": "POST", "path": "/product-offer-history/2", "json": {}, "offset": 0.2}),
+        json.dumps({"request_id": "not a request"}),
+        "",
+        json.dumps({"path": "/list-all", "offset": 0.1}),
+    ]))
+
+    entries = read_replay_log(str(log))
+
+    assert [entry["path"] for entry in entries] == ["/list-all", "/product-offer-history/2"]
+    assert entries[0]["method"] == "GET"
+    assert "1 lines" in caplog.text
+
+    # e.g. the backlog of change requests isn't a capture of requests
+    backlog = tmp_path / "requests.jsonl"
+    backlog.write_text(json.dumps({"request_id": "user-001", "title": "Title", "body": "Body"}))
+
+    with raises(ValueError):
+        read_replay_log(str(backlog))
+
+    with raises(SystemExit) as exit_info:
+        main(["--replay", str(backlog)])
+
+    assert exit_info.value.code != 0
+
+    with patch("requests.Session") as http_session:
+        http_session.return_value.request.side_effect = [MagicMock(status_code=200), MagicMock(status_code=500)]
+
+        report = run("URL", iter(entries), clients=1)
+
+    rows = {row["route"]: row for row in report}
+    assert rows["GET /list-all"]["requests"] == 1
+    assert rows["POST /product-offer-history/{id}"]["errors"] == 1
+    assert rows["*"]["requests"] == 2
@@ -0,0 +1,70 @@
+import datetime
+
+from sqlalchemy import create_engine, inspect
+
+import migrations
+import search
+from apihandler import APIHandler
+from bootstrap import Bootstrap
+from model import Product, Snapshot, OfferStatus
+from sqlalchemy.orm import sessionmaker
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE instance (id INTEGER PRIMARY KEY, access_token VARCHAR UNIQUE, date DATETIME NOT NULL)",
+    "CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(256) NOT NULL UNIQUE, description VARCHAR, "
+    "active BOOLEAN, instance_id INTEGER REFERENCES instance (id))",
+    "CREATE TABLE offer (id INTEGER PRIMARY KEY, price INTEGER NOT NULL, items_in_stock INTEGER NOT NULL, "
+    "acquired_on DATETIME NOT NULL, status VARCHAR(8) NOT NULL, product_id INTEGER REFERENCES product (id))",
+    "CREATE INDEX ix_offer_product_id_acquired_on ON offer (product_id, acquired_on)",
+    "INSERT INTO product VALUES (1, 'Product 1', 'Description', 1, NULL)",
+    "INSERT INTO offer VALUES (1, 100, 1, '2021-07-01 12:00:00.000000', 'historic', 1)",
+    "INSERT INTO offer VALUES (2, 90, 0, '2021-07-01 12:00:00.000000', 'historic', 1)",
+    "INSERT INTO offer VALUES (3, 80, 2, '2021-07-01 12:01:00.000000', 'active', 1)",
+    "INSERT INTO offer VALUES (4, 70, 2, '2021-07-01 12:01:00.000000', 'active', 1)",
+]
+
+
+def test_offers_are_split_into_snapshots(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+
+    with engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.exec_driver_sql(statement)
+
+    Bootstrap("URL", bind=engine).ensure_schema()
+
+    assert "acquired_on" not in {column["name"] for column in inspect(engine).get_columns("offer")}
+    assert migrations.migrate(engine) == []
+
+    db_session = sessionmaker(bind=engine)()
+    try:
+        snapshots = db_session.query(Snapshot).order_by(Snapshot.id).all()
+
+        assert [(snapshot.acquired_on, snapshot.status, sorted(offer.id for offer in snapshot.offers))
+                for snapshot in snapshots] == [
+            (datetime.datetime(2021, 7, 1, 12, 0), OfferStatus.historic, [1, 2]),
+            (datetime.datetime(2021, 7, 1, 12, 1), OfferStatus.active, [3, 4]),
+        ]
+
+        handler = APIHandler(db_session, "URL")
+
+        assert handler.get_price_trend(1, datetime.datetime(2021, 7, 1), datetime.datetime(2021, 7, 2)) == [
+            {"price": 100, "acquired_on": datetime.datetime(2021, 7, 1, 12, 0)},
+            {"price": 70, "acquired_on": datetime.datetime(2021, 7, 1, 12, 1)},
+        ]
+        assert list(handler.list_products())[0]["offers"] == [
+            {"price": 80, "items_in_stock": 2},
+            {"price": 70, "items_in_stock": 2},
+        ]
+
+        # existing products were indexed for full-text search
+        assert [item["id"] for item in search.search(db_session, "product")["items"]] == [1]
+
+        # the last refresh is the newest snapshot, the last change is unknown
+        product = db_session.query(Product).get(1)
+        assert product.last_refreshed_on == datetime.datetime(2021, 7, 1, 12, 1)
+        assert product.last_changed_on is None
+        assert {"ix_product_last_refreshed_on", "ix_product_last_changed_on"} <= \
+            {index["name"] for index in inspect(engine).get_indexes("product")}
+    finally:
+        db_session.close()
@@ -0,0 +1,127 @@
+"""
+Number of queries of handler methods and API routes mustn't grow with the number of products (N+1 queries).
+"""
+import datetime
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from apihandler import APIHandler
+from model import Base, Instance, Product, Snapshot, Offer, OfferStatus
+from .fixtures import client, offers
+from .querycount import QueryCounter
+
+SIZES = [10, 1000, 10000]
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda size: f"{size} products")
+def database(request, tmp_path_factory):
+    """
+    Every product has a historic snapshot from an hour ago and an active one from a minute ago, two offers each.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('budget') / 'database.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+
+    size = request.param
+    now = datetime.datetime.now()
+
+    with engine.begin() as connection:
+        connection.execute(Instance.__table__.insert(), [{"access_token": "AC_TOKEN", "date": now}])
+        connection.execute(Product.__table__.insert(), [
+            {"id": product_id, "name": f"Product {product_id}", "description": "Description", "active": True}
+            for product_id in range(1, size + 1)
+        ])
+        connection.execute(Snapshot.__table__.insert(), [
+            {"id": 2 * product_id - 1 + active, "product_id": product_id,
+             "acquired_on": now - datetime.timedelta(minutes=1 if active else 60),
+             "status": OfferStatus.active if active else OfferStatus.historic}
+            for product_id in range(1, size + 1) for active in (0, 1)
+        ])
+        connection.execute(Offer.__table__.insert(), [
+            {"snapshot_id": snapshot_id, "product_id": (snapshot_id + 1) // 2, "price": 100 + snapshot_id % 7 + offer,
+             "items_in_stock": offer}
+            for snapshot_id in range(1, 2 * size + 1) for offer in (0, 1)
+        ])
+
+    yield engine
+
+    engine.dispose()
+
+
+@pytest.fixture()
+def handler(database):
+    db_session = sessionmaker(bind=database)()
+
+    handler = APIHandler(db_session, "URL")
+    handler.use_credentials(1, "AC_TOKEN")
+
+    yield handler
+
+    db_session.close()
+
+
+@pytest.fixture()
+def api_engine(database):
+    return database  # of the client
+
+
+# handler methods ------------------------------------------------------
+
+def test_list_products(handler, database):
+    with QueryCounter(database) as queries:
+        products = list(handler.list_products())
+
+    assert len(products) == database.execute("SELECT count(*) FROM product").scalar()
+    assert products[0]["offers"] == [{"price": 103, "items_in_stock": 1}]
+    assert len(queries) <= 1, queries.report()
+
+
+def test_get_price_trend(handler, database):
+    with QueryCounter(database) as queries:
+        handler.get_history(1, datetime.datetime.now() - datetime.timedelta(days=1))
+
+    assert len(queries) <= 2, queries.report()
+
+
+@patch("requests.get")
+def test_refresh_product(requests_get, handler, database):
+    requests_get.return_value = offers((90, 3))
+
+    with QueryCounter(database) as queries:
+        handler.refresh_product(3)
+
+    assert len(queries) <= 7, queries.report()
+
+
+def test_update_and_delete_product(handler, database):
+    with QueryCounter(database) as queries:
+        handler.update_product(4, description="Changed")
+
+    assert len(queries) <= 6, queries.report()
+
+    with QueryCounter(database) as queries:
+        handler.delete_product(5)
+
+    assert len(queries) <= 5, queries.report()
+
+
+# API routes -------------------------------------------------------------
+
+@pytest.mark.parametrize("method, url, body, budget", [
+    ("GET", "/list-all", None, 2),
+    ("POST", "/product-offer-history/1", {}, 3),
+    ("POST", "/product-offer-history/1", {"start": "2000-01-01T00:00:00"}, 3),
+    ("POST", "/product-offer-analytics", {"product_ids": [1, 2, 3]}, 2),
+    ("GET", "/ranking/cheapest?limit=10", None, 2),
+    ("GET", "/ranking/movers?limit=10&direction=any", None, 3),
+    ("GET", "/alerts/triggered", None, 1),
+])
+def test_route(client, database, method, url, body, budget):
+    with QueryCounter(database) as queries:
+        response = client.request(method, url, json=body)
+
+    assert response.status_code == 200, response.text
+    assert len(queries) <= budget, queries.report()
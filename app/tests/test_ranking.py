@@ -0,0 +1,73 @@
+import datetime
+
+from pytest import raises
+
+import ranking
+from model import Product, OfferStatus
+from .fixtures import session, create_structure, connection, create_offer
+
+
+def test_cheapest_and_movers(session):
+    for index in range(1, 6):
+        session.add(Product(name=f"Product {index}", description="Description"))
+    session.commit()
+
+    now = datetime.datetime.now()
+    hour_ago = now - datetime.timedelta(hours=1)
+    minute_ago = now - datetime.timedelta(minutes=1)
+
+    # product -> (price an hour ago, current offers)
+    history = {
+        1: (100, [(50, 1), (40, 0)]),  # -50 %
+        2: (100, [(90, 3)]),  # -10 %
+        3: (100, [(130, 1)]),  # +30 %
+        4: (None, [(10, 1)]),  # no history
+        5: (100, [(5, 0)]),  # nothing in stock
+    }
+
+    for product_id, (old_price, offers) in history.items():
+        if old_price is not None:
+            create_offer(session, product_id, old_price, 1, hour_ago, OfferStatus.historic)
+
+        for price, stock in offers:
+            create_offer(session, product_id, price, stock, minute_ago, OfferStatus.active)
+
+    session.query(Product).filter(Product.id == 2).one().active = False
+    session.commit()
+
+    assert [(item["product_id"], item["price"]) for item in ranking.cheapest(session, 3)] == \
+           [(4, 10), (1, 50), (3, 130)]
+
+    window = datetime.timedelta(minutes=30)
+
+    drops = ranking.top_movers(session, window, 10, "drop", now)
+    assert [(item["product_id"], item["change"]) for item in drops] == [(1, -50.0)]
+
+    rises = ranking.top_movers(session, window, 10, "rise", now)
+    assert [(item["product_id"], item["old_price"], item["price"]) for item in rises] == [(3, 100, 130)]
+
+    assert [item["product_id"] for item in ranking.top_movers(session, window, 10, "any", now)] == [1, 3]
+    assert [item["product_id"] for item in ranking.top_movers(session, window, 1, "any", now)] == [1]
+
+    with raises(ValueError):
+        ranking.top_movers(session, window, 10, "sideways", now)
+
+
+def test_best_prices_at(session):
+    for index in range(1, 4):
+        session.add(Product(name=f"Product {index}", description="Description"))
+    session.commit()
+
+    start = datetime.datetime(2021, 7, 1, 12, 0)
+
+    for minute, price in enumerate((100, 90, 80)):
+        create_offer(session, 1, price, 1, start + datetime.timedelta(minutes=minute), OfferStatus.historic)
+
+    create_offer(session, 2, 50, 0, start, OfferStatus.historic)  # nothing in stock
+    create_offer(session, 3, 40, 1, start + datetime.timedelta(minutes=5), OfferStatus.active)  # too late
+    session.commit()
+
+    # the last snapshot at or before the moment, later ones are ignored
+    assert ranking.best_prices_at(session, start + datetime.timedelta(minutes=1, seconds=30)) == {1: 90}
+    assert ranking.best_prices_at(session, start + datetime.timedelta(minutes=5)) == {1: 80, 3: 40}
+    assert ranking.best_prices_at(session, start - datetime.timedelta(minutes=1)) == {}
@@ -0,0 +1,179 @@
+import datetime
+from unittest.mock import patch, MagicMock, call
+
+import requests
+from pytest import raises
+
+import lease
+from apihandler import APIHandler
+from model import Instance, Product, Offer, OfferStatus, Snapshot, RefreshCycle, CycleStatus, RefreshFailure
+from refresh import RefreshRunner, CYCLE_LEASE, cycle_lease, run_sharded
+from .fixtures import session, create_structure, connection, create_offer, offers
+
+
+def prepare(session, products: int = 3) -> APIHandler:
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+
+    for index in range(1, products + 1):
+        session.add(Product(name=f"Product {index}", description="Description"))
+
+    session.commit()
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+
+    return handler
+
+
+@patch("requests.get")
+def test_skipped_while_another_cycle_runs(requests_get, session):
+    handler = prepare(session)
+
+    assert lease.acquire(session, CYCLE_LEASE, "another updater", datetime.timedelta(minutes=1))
+
+    cycle = RefreshRunner(handler, session).run()
+
+    assert cycle.status == CycleStatus.skipped
+    requests_get.assert_not_called()
+
+
+@patch("requests.get")
+def test_interrupted_cycle_is_resumed(requests_get, session):
+    handler = prepare(session)
+
+    # unexpected error (unlike failure of the API) interrupts the cycle
+    requests_get.side_effect = [offers((10, 1)), RuntimeError("Database is gone.")]
+
+    with raises(RuntimeError):
+        RefreshRunner(handler, session).run()
+
+    cycle = session.query(RefreshCycle).one()
+    assert cycle.status == CycleStatus.running
+    assert cycle.last_product_id == 1
+    # offers of the interrupted product weren't retired
+    assert session.query(Offer).join(Snapshot).filter(Snapshot.status == OfferStatus.historic).count() == 0
+
+    requests_get.reset_mock()
+    requests_get.side_effect = [offers((20, 1)), offers((30, 1))]
+
+    cycle = RefreshRunner(handler, session).run()
+
+    assert cycle.status == CycleStatus.finished
+    assert cycle.resumes == 1
+    assert cycle.products_done == 3
+    requests_get.assert_has_calls([
+        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+        call("URL/products/3/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+    ])
+    assert requests_get.call_count == 2
+
+    # the next run is a new cycle again
+    requests_get.side_effect = [offers((40, 1)), offers((50, 1)), offers((60, 1))]
+
+    cycle = RefreshRunner(handler, session).run()
+
+    assert cycle.status == CycleStatus.finished
+    assert cycle.products_done == 3
+    assert session.query(RefreshCycle).count() == 2
+
+
+@patch("requests.get")
+def test_failed_products_are_retried(requests_get, session):
+    handler = prepare(session)
+    create_offer(session, 3, 5, 1, datetime.datetime.now(), OfferStatus.active)
+    sleep = MagicMock()
+
+    # product 2 fails once, product 3 fails every time
+    requests_get.side_effect = [
+        offers((10, 1)), MagicMock(status_code=500), requests.ConnectionError("Connection refused."),
+        offers((20, 1)), MagicMock(status_code=503),
+        requests.Timeout("Timed out."),
+    ]
+
+    cycle = RefreshRunner(handler, session, sleep=sleep, chunk_size=2).run()
+
+    # the cycle isn't stopped by failures
+    assert cycle.status == CycleStatus.finished
+    assert cycle.last_product_id == 3
+    assert cycle.products_done == 2
+    sleep.assert_has_calls([call(1.0), call(2.0)])
+
+    # products 1 and 2 got new offers, product 3 keeps its previous ones
+    active = session.query(Snapshot.product_id, Offer.price).join(Offer).filter(Snapshot.status == OfferStatus.active)
+    assert sorted(active) == [(1, 10), (2, 20), (3, 5)]
+
+    failures = session.query(RefreshFailure).order_by(RefreshFailure.id).all()
+    assert [(failure.product_id, failure.attempt) for failure in failures] == [(2, 1), (3, 1), (3, 2), (3, 3)]
+    assert all(failure.cycle_id == cycle.id for failure in failures)
+    assert failures[0].reason == "got 500 instead of 200"
+    assert "Timed out." in failures[-1].reason
+
+
+@patch("requests.get")
+def test_update_offers_returns_failed_products(requests_get, session):
+    handler = prepare(session)
+
+    requests_get.side_effect = [offers((10, 1)), MagicMock(status_code=500), offers((30, 1)),
+                                MagicMock(status_code=500)]
+
+    assert handler.update_offers(retries=1, backoff=0.0) == [2]
+    assert session.query(RefreshFailure).filter_by(cycle_id=None).count() == 2
+
+
+@patch("requests.get")
+def test_sharded_refresh(requests_get, session):
+    handler = prepare(session, products=4)
+
+    # another updater works on shard 1 (odd IDs)
+    assert lease.acquire(session, cycle_lease(1, 2), "another updater", datetime.timedelta(minutes=1))
+
+    requests_get.side_effect = [offers((10, 1)), offers((20, 1))]
+
+    cycles = run_sharded(handler, session, shard_count=2)
+
+    assert [(cycle.shard, cycle.status, cycle.products_done) for cycle in cycles] == [(0, CycleStatus.finished, 2)]
+    requests_get.assert_has_calls([
+        call("URL/products/2/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+        call("URL/products/4/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+    ])
+
+    # shard 0 was already refreshed in this period, shard 1 is still held
+    cycles = run_sharded(handler, session, shard_count=2)
+
+    assert [cycle.status for cycle in cycles] == [CycleStatus.skipped]
+    assert requests_get.call_count == 2
+
+    # the other updater died, its shard is taken over
+    lease.release(session, cycle_lease(1, 2), "another updater")
+    requests_get.side_effect = [offers((30, 1)), offers((40, 1))]
+
+    cycles = run_sharded(handler, session, shard_count=2)
+
+    assert [(cycle.shard, cycle.products_done) for cycle in cycles] == [(1, 2)]
+    requests_get.assert_has_calls([
+        call("URL/products/1/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+        call("URL/products/3/offers", data={}, headers={"Bearer": "AC_TOKEN"}, timeout=10.0),
+    ])
+
+
+@patch("requests.get")
+def test_chunked_refresh(requests_get, session):
+    handler = prepare(session, products=5)
+
+    # product added while the cycle runs is picked up by the next chunk
+    def respond(url, **kwargs):
+        if url == "URL/products/2/offers":
+            session.add(Product(id=6, name="Product 6", description="Description"))
+
+        return offers((10, 1))
+
+    requests_get.side_effect = respond
+
+    cycle = RefreshRunner(handler, session, chunk_size=2).run()
+
+    assert cycle.status == CycleStatus.finished
+    assert cycle.products_done == 6
+    assert [args[0] for args, _ in requests_get.call_args_list] == [f"URL/products/{index}/offers"
+                                                                   for index in range(1, 7)]
+    # objects of processed chunks were released
+    assert list(session.identity_map.values()) == [cycle]
@@ -0,0 +1,53 @@
+import datetime
+
+from model import Product, RefreshSchedule
+from scheduler import RefreshScheduler
+from .fixtures import session, create_structure, connection
+
+
+def add_products(session, count: int) -> None:
+    for index in range(1, count + 1):
+        session.add(Product(name=f"Product {index}", description="Description"))
+
+    session.commit()
+
+
+def test_changing_products_are_refreshed_sooner(session):
+    add_products(session, 2)
+
+    scheduler = RefreshScheduler(session, budget=10, max_staleness=3600.0, min_interval=60.0)
+    now = datetime.datetime(2021, 7, 1, 12, 0, 0)
+
+    for minute in range(10):
+        time = now + datetime.timedelta(minutes=minute)
+        scheduler.record(1, changed=True, now=time)
+        scheduler.record(2, changed=False, now=time)
+
+    session.commit()
+
+    volatile = session.query(RefreshSchedule).get(1)
+    stable = session.query(RefreshSchedule).get(2)
+
+    assert datetime.timedelta(seconds=60) <= volatile.next_due_on - volatile.last_refreshed_on  # min interval
+    assert volatile.next_due_on - volatile.last_refreshed_on < datetime.timedelta(minutes=2)
+    assert stable.next_due_on - stable.last_refreshed_on > datetime.timedelta(minutes=10)
+    assert stable.next_due_on - stable.last_refreshed_on <= datetime.timedelta(hours=1)  # max staleness
+
+
+def test_select_respects_budget_and_staleness(session):
+    add_products(session, 5)
+
+    scheduler = RefreshScheduler(session, budget=3, max_staleness=600.0, min_interval=60.0)
+    now = datetime.datetime(2021, 7, 1, 12, 0, 0)
+
+    scheduler.record(1, changed=False, now=now - datetime.timedelta(minutes=20))  # too stale
+    scheduler.record(2, changed=False, now=now - datetime.timedelta(minutes=9))
+    scheduler.record(3, changed=False, now=now - datetime.timedelta(minutes=8))
+    scheduler.record(4, changed=False, now=now - datetime.timedelta(seconds=10))  # not due yet
+    # product 5 was never refreshed
+    session.commit()
+
+    products = session.query(Product.id).filter(Product.active == True)
+
+    # never refreshed and too stale first, then the one more likely to have changed
+    assert scheduler.select(products, now) == [1, 2, 5]
@@ -0,0 +1,95 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+from pytest import raises
+
+import search
+from apihandler import APIHandler
+from model import Instance, OfferStatus
+from .fixtures import session, create_structure, connection, create_offer
+
+
+def prepare(session) -> APIHandler:
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+    session.commit()
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+
+    return handler
+
+
+def names(result) -> list:
+    return [item["name"] for item in result["items"]]
+
+
+def test_match_expression():
+    assert search.match_expression("red shoe") == '"red" "shoe"*'
+    assert search.match_expression("run* fast") == '"run"* "fast"*'
+    # FTS5 syntax is quoted
+    assert search.match_expression('NEAR("x" OR y) -') == '"NEAR" "x" "OR" "y"*'
+
+    with raises(ValueError):
+        search.match_expression(" *-\" ")
+
+
+@patch("requests.post")
+def test_index_is_kept_in_sync(requests_post, session):
+    requests_post.return_value = MagicMock(status_code=201)
+    handler = prepare(session)
+
+    shoe = handler.create_product("Red running shoe", "Lightweight shoe for running.")
+    handler.create_product("Blue T-shirt", "Cotton shirt, great for running in summer.")
+    handler.create_product("Čajová konvice", "Porcelánová konvice na čaj.")
+
+    # matches in name are ranked higher than in description
+    assert names(search.search(session, "running")) == ["Red running shoe", "Blue T-shirt"]
+    # prefix, case and diacritics
+    assert names(search.search(session, "RUN")) == ["Red running shoe", "Blue T-shirt"]
+    assert names(search.search(session, "cajova konv")) == ["Čajová konvice"]
+    assert names(search.search(session, "cotton runn")) == ["Blue T-shirt"]
+    assert search.search(session, "nothing") == {"total": 0, "items": []}
+
+    handler.update_product(shoe, name="Green trail shoe", description="Shoe for trails.")
+
+    assert names(search.search(session, "running")) == ["Blue T-shirt"]
+    assert names(search.search(session, "trail")) == ["Green trail shoe"]
+
+    handler.delete_product(shoe)
+
+    assert search.search(session, "shoe")["total"] == 0
+
+    # re-created product is found again
+    handler.create_product("Green trail shoe", "Whatever")
+
+    assert names(search.search(session, "shoe")) == ["Green trail shoe"]
+
+
+@patch("requests.post")
+def test_pages_and_offers(requests_post, session):
+    requests_post.return_value = MagicMock(status_code=201)
+    handler = prepare(session)
+
+    for index in range(1, 6):
+        handler.create_product(f"Lamp {index}", "Desk lamp")
+
+    now = datetime.datetime.now()
+    create_offer(session, 2, 300, 1, now, OfferStatus.active)
+    create_offer(session, 2, 250, 4, now, OfferStatus.active)
+    create_offer(session, 2, 100, 0, now, OfferStatus.active)
+    create_offer(session, 2, 50, 1, now - datetime.timedelta(minutes=1), OfferStatus.historic)
+    session.commit()
+
+    first = search.search(session, "lamp", limit=2)
+    second = search.search(session, "lamp", limit=2, offset=2)
+
+    assert first["total"] == second["total"] == 5
+    assert names(first) + names(second) == ["Lamp 1", "Lamp 2", "Lamp 3", "Lamp 4"]
+    assert first["items"][1] == {
+        "id": 2,
+        "name": "Lamp 2",
+        "description": "Desk lamp",
+        "best_price": 250,
+        "offers": [{"price": 300, "items_in_stock": 1}, {"price": 250, "items_in_stock": 4}],
+    }
+    assert first["items"][0]["offers"] == []
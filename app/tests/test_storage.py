@@ -0,0 +1,258 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+import pytest
+from pytest import raises
+
+from apihandler import APIHandler
+from model import Instance
+from storage import Storage, SQLStorage, MemoryStorage, ProductAlreadyExists, ProductDoesntExist
+from .fixtures import session, create_structure, connection, offers, api_engine, client
+
+START = datetime.datetime(2021, 7, 1, 12, 0)
+
+
+@pytest.fixture(params=["sql", "memory"])
+def storage(request):
+    if request.param == "sql":
+        return SQLStorage(request.getfixturevalue("session"))
+
+    return MemoryStorage()
+
+
+@pytest.fixture()
+def handler(storage) -> APIHandler:
+    instance_id = storage.add_instance("AC_TOKEN", datetime.datetime.now())
+
+    handler = APIHandler(storage, "URL")
+    handler.start("AC_TOKEN")
+
+    assert handler.credentials == (instance_id, "AC_TOKEN")
+
+    return handler
+
+
+def test_instances(storage):
+    instance_id = storage.add_instance("AC_TOKEN", datetime.datetime.now())
+
+    assert storage.find_instance("AC_TOKEN") == instance_id
+    assert storage.find_instance("OTHER") is None
+
+    with raises(RuntimeError):
+        APIHandler(storage, "URL").start("OTHER")
+
+
+@patch("requests.post")
+def test_products(requests_post, handler, storage):
+    requests_post.return_value = MagicMock(status_code=201)
+
+    first = handler.create_product("Product 1", "Description")
+    second = handler.create_product("Product 2", None)
+
+    with raises(ProductAlreadyExists):
+        handler.create_product("Product 1", "Description")
+
+    handler.update_product(first, description="Changed")
+
+    with raises(ProductAlreadyExists):
+        handler.update_product(first, name="Product 2")
+
+    with raises(ProductDoesntExist):
+        handler.update_product(42, name="Product 42")
+
+    assert list(handler.list_products()) == [
+        {"id": first, "name": "Product 1", "description": "Changed", "offers": []},
+        {"id": second, "name": "Product 2", "description": None, "offers": []},
+    ]
+
+    handler.delete_product(first)
+
+    with raises(ProductDoesntExist):
+        handler.delete_product(first)
+
+    with raises(ProductDoesntExist):
+        handler.get_history(first)
+
+    assert [product["id"] for product in handler.list_products()] == [second]
+    assert storage.active_product_ids(0, 10) == [second]
+
+    # deleted product comes back with its ID
+    assert handler.create_product("Product 1", "Description") == first
+    assert storage.active_product_ids(0, 10) == [first, second]
+    assert storage.active_product_ids(first, 10) == [second]
+    assert storage.active_product_ids(0, 1) == [first]
+
+    # product, which failed to register, is removed
+    requests_post.return_value = MagicMock(status_code=400)
+
+    with raises(RuntimeError):
+        handler.create_product("Product 3", "Description")
+
+    assert storage.find_product("Product 3") is None
+    assert storage.active_product_ids(0, 10) == [first, second]
+
+
+@patch("requests.get")
+def test_offers_and_history(requests_get, handler, storage):
+    product_id = storage.add_product("Product 1", "Description", None)
+
+    snapshots = [[(100, 1), (90, 0)], [(100, 1), (90, 0)], [(80, 2), (70, 1)], [(70, 0)]]
+    for minute, snapshot in enumerate(snapshots):
+        storage.add_snapshot(product_id, START + datetime.timedelta(minutes=minute), snapshot,
+                             storage.active_offers(product_id))
+        storage.commit()
+
+    product = storage.get_product(product_id)
+    assert product.last_refreshed_on == START + datetime.timedelta(minutes=3)
+    assert product.last_changed_on == START + datetime.timedelta(minutes=3)
+
+    # empty response keeps the last price out of stock
+    requests_get.return_value = offers()
+    assert handler.refresh_product(product_id) is False
+    assert storage.active_offers(product_id) == [(70, 0)]
+
+    requests_get.return_value = offers((80, 2), (70, 1))
+    assert handler.refresh_product(product_id)
+
+    assert storage.active_offers(product_id) == [(70, 1), (80, 2)]
+    assert list(handler.list_products())[0]["offers"] == [
+        {"price": 80, "items_in_stock": 2},
+        {"price": 70, "items_in_stock": 1},
+    ]
+
+    product = storage.get_product(product_id)
+    assert product.last_refreshed_on > START + datetime.timedelta(minutes=3)
+    assert product.last_changed_on == product.last_refreshed_on
+
+    # snapshots without offers in stock aren't in the history
+    assert handler.get_history(product_id, START, START + datetime.timedelta(minutes=10)) == {
+        "history": [
+            {"price": 100, "acquired_on": START},
+            {"price": 100, "acquired_on": START + datetime.timedelta(minutes=1)},
+            {"price": 70, "acquired_on": START + datetime.timedelta(minutes=2)},
+        ],
+        "rise_or_fall": -30.0,
+    }
+    assert handler.get_price_trend(product_id, START + datetime.timedelta(minutes=2),
+                                   START + datetime.timedelta(minutes=1)) == [
+        {"price": 100, "acquired_on": START + datetime.timedelta(minutes=1)},
+        {"price": 70, "acquired_on": START + datetime.timedelta(minutes=2)},
+    ]
+
+    handler.delete_product(product_id)
+
+    assert storage.active_offers(product_id) == []
+
+
+@patch("requests.get")
+def test_update_offers(requests_get, handler, storage):
+    for index in range(1, 5):
+        storage.add_product(f"Product {index}", "Description", None)
+    storage.commit()
+
+    requests_get.side_effect = [offers((10, 1)), MagicMock(status_code=500), offers((30, 1)), offers((40, 1)),
+                                MagicMock(status_code=500)]
+
+    assert handler.update_offers(chunk_size=3, retries=1, backoff=0.0) == [2]
+    assert [product["offers"] for product in handler.list_products()] == [
+        [{"price": 10, "items_in_stock": 1}],
+        [],
+        [{"price": 30, "items_in_stock": 1}],
+        [{"price": 40, "items_in_stock": 1}],
+    ]
+
+
+def test_storage_is_abstract():
+    class Incomplete(Storage):
+        def commit(self) -> None:
+            pass
+
+    with raises(TypeError):
+        Incomplete()
+
+
+def test_errors_and_generations(storage):
+    first = storage.add_product("Product 1", "Description", None)
+    storage.add_product("Product 2", None, None)
+    storage.commit()
+
+    with raises(ProductAlreadyExists):
+        storage.add_product("Product 1", None, None)
+
+    with raises(ProductAlreadyExists):
+        storage.update_product(first, name="Product 2")
+
+    for change in (storage.activate_product, storage.deactivate_product):
+        with raises(ProductDoesntExist):
+            change(42)
+
+    with raises(ProductDoesntExist):
+        storage.update_product(42, name="Product 42")
+
+    with raises(ProductDoesntExist):
+        storage.add_snapshot(42, START, [(10, 1)], [])
+
+    storage.rollback()
+
+    assert storage.get_product(42) is None
+    assert storage.active_offers(42) == []
+    assert storage.price_history(42, START, START + datetime.timedelta(minutes=1)) == []
+
+    storage.publish_product(first, "created", name="Product 1", description="Description")
+    storage.commit()
+    generation, changed, product = storage.generations()
+
+    # the same offers - new event, but neither the offers nor the product changed
+    storage.add_snapshot(first, START, [], [])
+    storage.commit()
+    assert storage.generations()[0] > generation
+    assert storage.generations()[1:] == (changed, product)
+
+    generation, changed, product = storage.generations()
+
+    storage.add_snapshot(first, START + datetime.timedelta(minutes=1), [(10, 1)], [])
+    storage.commit()
+    assert storage.generations()[1] > changed
+    assert storage.generations()[2] == product
+
+    storage.update_product(first, description="Changed")
+    storage.publish_product(first, "updated", name="Product 1", description="Changed")
+    storage.commit()
+    assert storage.generations()[2] > product
+
+
+@pytest.mark.parametrize("client", [MemoryStorage], indirect=True)
+@patch("requests.post")
+def test_memory_storage_behind_api(requests_post, client, api_engine):
+    # credentials are still coordinated through the database
+    with api_engine.begin() as database:
+        database.execute(Instance.__table__.insert(), [{"access_token": "AC_TOKEN", "date": datetime.datetime.now()}])
+
+    requests_post.return_value = MagicMock(status_code=201)
+
+    assert client.post("/create-product", json={"name": "Product 1", "description": "Description"}) \
+        .status_code == 201
+
+    response = client.get("/list-all")
+    tag = response.headers["etag"]
+    assert [product["name"] for product in response.json()] == ["Product 1"]
+
+    assert client.get("/list-all", headers={"If-None-Match": tag}).status_code == 304
+
+    assert client.post("/create-product", json={"name": "Product 1", "description": "Other"}).status_code == 400
+    assert client.post("/create-product", json={"name": "Product 2", "description": "Description"}).status_code == 201
+
+    response = client.get("/list-all", headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert [product["name"] for product in response.json()] == ["Product 1", "Product 2"]
+
+    # the default range isn't served from the trend cache, which needs the database
+    response = client.post("/product-offer-history/1", json={})
+    assert response.status_code == 200
+    assert response.json() == []
+
+    assert client.post("/change-product", json={"product_id": 42, "name": "Product 42"}).status_code == 400
+
+    assert client.delete("/delete-product/1").status_code == 200
+    assert client.delete("/delete-product/1").status_code == 400
+    assert [product["name"] for product in client.get("/list-all").json()] == ["Product 2"]
@@ -0,0 +1,74 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+from pytest import raises
+
+import feed
+from apihandler import APIHandler, ProductDoesntExist
+from model import Instance, Product
+from trends import RingBuffer, TrendCache, to_micros, from_micros
+from .fixtures import session, create_structure, connection, offers
+
+
+def test_ring_buffer_keeps_the_last_points():
+    buffer = RingBuffer(3, covered_since=0)
+
+    for time, price in [(10, 1), (20, 2), (20, 2), (30, 3), (40, 4)]:
+        buffer.append(time, price)
+
+    # the first point was overwritten, duplicate was ignored
+    assert [point["price"] for point in buffer.between(0, 100)] == [2, 3, 4]
+    assert [point["price"] for point in buffer.between(25, 35)] == [3]
+    assert buffer.covered_since == 11
+
+    moment = datetime.datetime(2021, 6, 1, 12, 30, 15, 123457)
+    assert from_micros(to_micros(moment)) == moment
+
+
+@patch("requests.delete")
+@patch("requests.get")
+def test_default_trend_is_served_from_cache(requests_get, requests_delete, session):
+    session.add(Instance(access_token="AC_TOKEN", date=datetime.datetime.now()))
+    session.add(Product(name="Product 1", description="Description"))
+    session.commit()
+
+    handler = APIHandler(session, "URL")
+    handler.start("AC_TOKEN")
+
+    cache = TrendCache(max_lag=0.0)
+    handler.use_trend_cache(cache)
+
+    requests_get.side_effect = [offers((100, 1), (90, 0)), offers((80, 2)), offers((80, 0)), offers((70, 5))]
+
+    handler.refresh_product(1)
+    first = handler.get_price_trend(1)  # computed from the database and cached
+
+    assert [point["price"] for point in first] == [100]
+    assert len(cache) == 1
+
+    handler.refresh_product(1)
+    handler.refresh_product(1)  # nothing in stock
+    handler.refresh_product(1)
+
+    expected = APIHandler(session, "URL").get_price_trend(1)
+    assert [point["price"] for point in expected] == [100, 80, 70]
+
+    with patch.object(session, "query", side_effect=AssertionError("no ORM query expected")):
+        assert handler.get_price_trend(1) == expected
+        assert handler.get_history(1)["rise_or_fall"] == -30.0
+
+    # imported offers can fall into the cached range
+    feed.publish_product(session, 1, "imported", offers=1)
+    session.commit()
+
+    cache.position(session)
+    assert len(cache) == 0
+    assert handler.get_price_trend(1) == expected
+
+    requests_delete.return_value = MagicMock(status_code=204)
+    handler.delete_product(1)
+
+    with raises(ProductDoesntExist):
+        handler.get_price_trend(1)
+
+    assert len(cache) == 0
@@ -0,0 +1,188 @@
+"""
+In-memory cache of recent best prices of products, serving the default (last 5 minutes) price trend without queries.
+
+Every cached product has a fixed-size ring buffer of (time, best price) points in typed arrays. A product is cached
+after its trend was computed from the database once (see APIHandler.get_price_trend(...)), from then on new snapshots
+are appended from the change feed (change_event table), which is tailed at most once per `max_lag` seconds by a single
+small query. The number of cached products is bounded (least recently used ones are evicted), so memory is bounded
+by max_products * capacity * 16 bytes.
+"""
+import array
+import datetime
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import session
+
+from model import ChangeEvent, ChangeKind
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+change_event = ChangeEvent.__table__
+
+
+def to_micros(moment: datetime.datetime) -> int:
+    # integer microseconds keep the times exact, floats would not
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class RingBuffer:
+    """
+    The last `capacity` points (time in microseconds, price) in insertion order.
+    """
+    __slots__ = ("times", "prices", "start", "size", "covered_since")
+
+    times: array.array  # 'q'
+    prices: array.array  # 'q'
+    start: int  # index of the oldest point
+    size: int
+    covered_since: int  # all points at or after this time are in the buffer
+
+    def __init__(self, capacity: int, covered_since: int) -> None:
+        self.times = array.array("q", bytes(8 * capacity))
+        self.prices = array.array("q", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+        self.covered_since = covered_since
+
+    def append(self, time: int, price: int) -> None:
+        capacity = len(self.times)
+
+        if self.size and time <= self.times[(self.start + self.size - 1) % capacity]:
+            return  # already known
+
+        if self.size < capacity:
+            index = (self.start + self.size) % capacity
+            self.size += 1
+        else:
+            # the oldest point is overwritten, nothing is known up to it anymore
+            index = self.start
+            self.covered_since = max(self.covered_since, self.times[index] + 1)
+            self.start = (self.start + 1) % capacity
+
+        self.times[index] = time
+        self.prices[index] = price
+
+    def between(self, start: int, end: int) -> List[Dict[str, Any]]:
+        capacity = len(self.times)
+        result = []
+
+        for offset in range(self.size):
+            index = (self.start + offset) % capacity
+            if start <= self.times[index] <= end:
+                result.append({
+                    "price": self.prices[index],
+                    "acquired_on": from_micros(self.times[index])
+                })
+
+        return result
+
+
+class TrendCache:
+    """
+    Thread-safe, one instance is shared by all requests of a process.
+    """
+    _capacity: int  # points per product
+    _max_products: int
+    _max_lag: datetime.timedelta  # how old can the view of the change feed be
+    _buffers: "OrderedDict[int, RingBuffer]"  # product ID -> buffer, the least recently used first
+    _last_id: Optional[int] = None  # ID of the last seen event
+    _synced_on: Optional[datetime.datetime] = None
+    _lock: threading.Lock
+
+    def __init__(self, capacity: int = 64, max_products: int = 10000, max_lag: float = 1.0) -> None:
+        self._capacity = capacity
+        self._max_products = max_products
+        self._max_lag = datetime.timedelta(seconds=max_lag)
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buffers)
+
+    def _sync(self, db_session: session, now: datetime.datetime) -> None:
+        if self._synced_on is not None and now - self._synced_on <= self._max_lag:
+            return
+
+        if self._last_id is None or self._synced_on is None or now - self._synced_on > datetime.timedelta(minutes=5):
+            # (re)start - events could have been pruned in the meantime, so the buffers can't be trusted
+            self._buffers.clear()
+            self._last_id = db_session.execute(select([func.max(change_event.c.id)])).scalar() or 0
+        else:
+            rows = db_session.execute(
+                select([change_event.c.id, change_event.c.kind, change_event.c.product_id, change_event.c.created_on,
+                        change_event.c.best_price, change_event.c.payload]).where(
+                    change_event.c.id > self._last_id
+                ).order_by(change_event.c.id)
+            )
+
+            for event_id, kind, product_id, created_on, best_price, payload in rows:
+                self._last_id = event_id
+
+                if product_id not in self._buffers:
+                    continue
+
+                if kind == ChangeKind.snapshot:
+                    if best_price is not None:
+                        self._buffers[product_id].append(to_micros(created_on), best_price)
+                elif json.loads(payload).get("action") in ("deleted", "imported"):
+                    del self._buffers[product_id]
+
+        self._synced_on = now
+
+    def position(self, db_session: session, now: Optional[datetime.datetime] = None) -> int:
+        """
+        Catch up with the change feed.
+
+        :return: ID of the last seen event, to be passed to .seed(...)
+        """
+        with self._lock:
+            self._sync(db_session, now or datetime.datetime.now())
+
+            return self._last_id
+
+    def trend(self, db_session: session, product_id: int, start: datetime.datetime,
+              end: datetime.datetime) -> Optional[List[Dict[str, Any]]]:
+        """
+        :return: best prices of snapshots within the time range in the format of APIHandler.get_price_trend(...) or
+                 None, if the product isn't cached or the range starts before the cached points
+        """
+        with self._lock:
+            self._sync(db_session, datetime.datetime.now())
+
+            buffer = self._buffers.get(product_id)
+            if buffer is None or to_micros(start) < buffer.covered_since:
+                return None
+
+            self._buffers.move_to_end(product_id)
+
+            return buffer.between(to_micros(start), to_micros(end))
+
+    def seed(self, product_id: int, start: datetime.datetime, trend: List[Dict[str, Any]], position: int) -> None:
+        """
+        Cache trend of existing product computed from the database.
+
+        :param start: the trend is complete from this time on
+        :param trend: result of APIHandler.get_price_trend(...) up to now
+        :param position: result of .position(...) taken before the trend was read
+        """
+        with self._lock:
+            if position != self._last_id or product_id in self._buffers:
+                return  # events could have been missed in the meantime, next request will try again
+
+            buffer = RingBuffer(self._capacity, to_micros(start))
+            for point in trend:
+                buffer.append(to_micros(point["acquired_on"]), point["price"])
+
+            self._buffers[product_id] = buffer
+
+            while len(self._buffers) > self._max_products:
+                self._buffers.popitem(last=False)
@@ -1,24 +1,43 @@
+import datetime
+import logging
+import math
 import os
 
-from apihandler import APIHandler
+import feed
+from alerts import AlertIndex
+from bootstrap import Bootstrap
+from refresh import run_sharded, prune_failures
+from scheduler import RefreshScheduler
 
-from database import engine, SessionLocal
-from model import Instance, Base
 
-Base.metadata.create_all(bind=engine)
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
-db_session = SessionLocal()
+    # all updater processes have to use the same number of shards
+    shard_count = int(os.getenv("UPDATER_SHARDS", "1"))
 
-api_url = os.getenv("APPLIFTING_API_URL")
-if api_url is None:
-    raise RuntimeError("No APPLIFTING_API_URL is set.")
+    bootstrap = Bootstrap()
 
-handler = APIHandler(db_session, api_url)
+    db_session = bootstrap.new_session()
+    try:
+        handler = bootstrap.authenticated_handler(db_session)
+        handler.watch_alerts(AlertIndex.load(db_session))
 
-instance = db_session.query(Instance).first()
-if instance is None:  # first time start
-    handler.start()
-else:  # we already have a access token
-    handler.start(instance.access_token)
+        scheduler = None
+        if os.getenv("UPDATER_CALLS_PER_MINUTE") is not None:
+            # budget is split evenly among shards, each of them is refreshed once a minute
+            budget = math.ceil(int(os.getenv("UPDATER_CALLS_PER_MINUTE")) / shard_count)
+            max_staleness = float(os.getenv("UPDATER_MAX_STALENESS", "600"))
 
-handler.update_offers()
+            scheduler = RefreshScheduler(db_session, budget, max_staleness)
+
+        run_sharded(handler, db_session, shard_count, scheduler=scheduler)
+
+        feed.prune(db_session, datetime.timedelta(seconds=float(os.getenv("CHANGE_FEED_RETENTION", "3600"))))
+        prune_failures(db_session, datetime.timedelta(days=float(os.getenv("REFRESH_FAILURE_RETENTION_DAYS", "7"))))
+    finally:
+        db_session.close()
+
+
+if __name__ == "__main__":
+    main()